@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Sort, bgzip and tabix-index GWAS result files in one pass per file.
+
+Each input (e.g. PLINK `{name}.assoc.linear`) is read in chunks, with runs of whitespace
+normalised to tabs and the header prefixed with '#'. Rows are sorted by chromosome (numeric
+ones first, as `sort -k1,1n`) and position, in memory if the file fits in --chunk_rows,
+otherwise as an external merge sort of sorted runs in --tmpdir. The sorted rows are written
+straight into BGZF blocks compressed in a thread pool (gwas_compressed_io.py), and the `.tbi`
+index is built from the offsets of the written rows, without bgzip/tabix or temporary copies.
+Files are processed in parallel, and the thinned subset of the browser is written next to them.
+
+Output: `{name}.sorted.assoc.linear.gz` and `.tbi` (as compress_and_index_gwas.sh).
+
+Usage:
+    compress_and_index_gwas.py --file_list files_to_compress.txt --workers 8 --threads 4
+    compress_and_index_gwas.py gwas/gwas_outputs_20/*.assoc.linear --chr_col 1 --pos_col 3
+"""
+import argparse
+import heapq
+import io
+import itertools
+import logging
+import os
+import struct
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from gwas_browser_helpers import INDEXED_SUFFIX, strip_suffix, write_thinned
+from gwas_compressed_io import ParallelCompressedWriter
+from gwas_metrics import add_rows, instrumented, stage
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+
+# Tabix: 16 kb linear-index windows, bins of the finest level for point features
+TBI_LINEAR_SHIFT = 14
+TBI_LEVEL5_OFFSET = 4681
+WRITE_BATCH = 100_000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Sort, bgzip and tabix-index GWAS result files.")
+    parser.add_argument("files", nargs="*")
+    parser.add_argument("--file_list", default=None, help="File with one input path per line.")
+    parser.add_argument("--chr_col", default=1, type=int, help="Chromosome column (1-based).")
+    parser.add_argument("--pos_col", default=3, type=int, help="Position column (1-based).")
+    parser.add_argument("--chunk_rows", default=2_000_000, type=int, help="Rows sorted in memory at once.")
+    parser.add_argument("--tmpdir", default=None, help="Directory of the sorted runs (default: $TMPDIR).")
+    parser.add_argument("--workers", default=4, type=int, help="Files processed in parallel.")
+    parser.add_argument("--threads", default=4, type=int, help="Compression threads per file.")
+    parser.add_argument("--no_thinned", action="store_true", help="Don't write the browser's thinned subset.")
+    return parser.parse_args()
+
+
+def _chrom_key(chrom):
+    """Sort key of a chromosome: numeric chromosomes first, in numeric order, then the others."""
+    try:
+        return 0, int(chrom), ""
+    except ValueError:
+        return 1, 0, chrom
+
+
+def _read_chunks(path, chr_col, pos_col, chunk_rows):
+    """Sorted chunks of `path` as (header, rows as strings, chromosome column name, positions)."""
+    reader = pd.read_csv(path, sep=r"\s+", dtype=str, keep_default_na=False, chunksize=chunk_rows, engine="c")
+    for chunk in reader:
+        chr_name, pos_name = chunk.columns[chr_col - 1], chunk.columns[pos_col - 1]
+        pos = pd.to_numeric(chunk[pos_name], errors="coerce")
+        if pos.isna().any():
+            logging.warning(f"{path}: {int(pos.isna().sum())} rows without a valid position dropped")
+            chunk, pos = chunk[pos.notna()], pos[pos.notna()]
+        codes, chroms = pd.factorize(chunk[chr_name])
+        chrom_rank = np.empty(len(chroms), dtype=np.int64)
+        chrom_rank[sorted(range(len(chroms)), key=lambda i: _chrom_key(chroms[i]))] = np.arange(len(chroms))
+        pos = pos.to_numpy(dtype=np.int64)
+        order = np.lexsort((pos, chrom_rank[codes]))
+        yield list(chunk.columns), chunk.iloc[order], chr_name, pos[order]
+
+
+def _frame_records(df, chr_name, pos):
+    """(chromosomes, positions, lines) of a sorted chunk."""
+    text = df.to_csv(sep="\t", header=False, index=False, lineterminator="\n")
+    return df[chr_name].to_numpy(), pos, text.encode().splitlines(keepends=True)
+
+
+def _run_records(run_files, chr_idx, pos_idx):
+    """Merge sorted run files into batches of (chromosomes, positions, lines)."""
+    def parse(line):
+        fields = line.split(b"\t", max(chr_idx, pos_idx) + 1)
+        chrom = fields[chr_idx].decode()
+        return _chrom_key(chrom), int(fields[pos_idx])
+
+    handles = [open(f, "rb") for f in run_files]
+    try:
+        merged = heapq.merge(*handles, key=parse)
+        while True:
+            lines = list(itertools.islice(merged, WRITE_BATCH))
+            if not lines:
+                break
+            fields = [line.split(b"\t", max(chr_idx, pos_idx) + 1) for line in lines]
+            chroms = np.array([f[chr_idx].decode() for f in fields], dtype=object)
+            pos = np.array([int(f[pos_idx]) for f in fields], dtype=np.int64)
+            yield chroms, pos, lines
+    finally:
+        for h in handles:
+            h.close()
+
+
+class TabixIndexBuilder:
+    """Collects (chromosome, position, uncompressed offset) of written rows and writes the .tbi."""
+
+    def __init__(self, chr_col, pos_col, meta="#"):
+        self.chr_col = chr_col
+        self.pos_col = pos_col
+        self.meta = meta
+        self.names = []
+        self._ref_ids = {}
+        self._refs, self._pos, self._starts = [], [], []
+
+    def add(self, chroms, pos, starts):
+        ids = np.empty(len(chroms), dtype=np.int32)
+        for i, chrom in enumerate(chroms):
+            ref = self._ref_ids.get(chrom)
+            if ref is None:
+                ref = self._ref_ids[chrom] = len(self.names)
+                self.names.append(chrom)
+            ids[i] = ref
+        self._refs.append(ids)
+        self._pos.append(np.asarray(pos, dtype=np.int64))
+        self._starts.append(np.asarray(starts, dtype=np.int64))
+
+    def write(self, path, writer, data_end):
+        """Write the index of the data written by `writer` (closed; data ends at uncompressed `data_end`)."""
+        refs = np.concatenate(self._refs) if self._refs else np.empty(0, dtype=np.int32)
+        pos = np.concatenate(self._pos) if self._pos else np.empty(0, dtype=np.int64)
+        starts = np.concatenate(self._starts) if self._starts else np.empty(0, dtype=np.int64)
+        vbeg = writer.virtual_offsets(starts)
+        vend = writer.virtual_offsets(np.append(starts[1:], data_end))
+        window = (pos - 1) >> TBI_LINEAR_SHIFT
+
+        names = b"".join(n.encode() + b"\0" for n in self.names)
+        out = io.BytesIO()
+        out.write(b"TBI\1")
+        out.write(struct.pack("<8i", len(self.names), 0, self.chr_col, self.pos_col, self.pos_col, ord(self.meta), 0, len(names)))
+        out.write(names)
+
+        bounds = np.searchsorted(refs, np.arange(len(self.names) + 1))
+        for ref in range(len(self.names)):
+            lo, hi = bounds[ref], bounds[ref + 1]
+            w, vb, ve = window[lo:hi], vbeg[lo:hi], vend[lo:hi]
+
+            # Rows are sorted, so the rows of a bin (one 16 kb window) are contiguous: one chunk per bin
+            firsts = np.flatnonzero(np.diff(w, prepend=-1))
+            lasts = np.append(firsts[1:], len(w)) - 1
+            out.write(struct.pack("<i", len(firsts)))
+            for f, l in zip(firsts, lasts):
+                out.write(struct.pack("<IiQQ", TBI_LEVEL5_OFFSET + int(w[f]), 1, int(vb[f]), int(ve[l])))
+
+            # Linear index: offset of the first row of every window, holes filled from the left
+            ioff = np.full(int(w[-1]) + 1, -1, dtype=np.int64)
+            ioff[w[firsts]] = vb[firsts]
+            ioff[:w[0]] = vb[0]
+            ioff = np.maximum.accumulate(ioff)
+            out.write(struct.pack("<i", len(ioff)))
+            out.write(ioff.astype("<u8").tobytes())
+
+        with ParallelCompressedWriter(path, "bgzip", threads=1) as f:
+            f.write(out.getvalue())
+
+
+def compress_and_index(path, out_file=None, chr_col=1, pos_col=3, chunk_rows=2_000_000, tmpdir=None, threads=4):
+    """Sort, bgzip and index one file. Returns the output path."""
+    out_file = strip_suffix(path) + INDEXED_SUFFIX if out_file is None else out_file
+    index = TabixIndexBuilder(chr_col, pos_col)
+
+    with tempfile.TemporaryDirectory(dir=tmpdir) as tmp:
+        chunks = _read_chunks(path, chr_col, pos_col, chunk_rows)
+        first = next(chunks, None)
+        if first is None:
+            raise ValueError(f"{path} is empty")
+        header, df, chr_name, pos = first
+        second = next(chunks, None)
+
+        if second is None:
+            batches = [_frame_records(df, chr_name, pos)]
+        else:
+            # External merge sort: every sorted chunk becomes a run file
+            run_files = []
+            for _, df, chr_name, pos in itertools.chain([first, second], chunks):
+                run_files.append(os.path.join(tmp, f"run{len(run_files)}.tsv"))
+                df.to_csv(run_files[-1], sep="\t", header=False, index=False, lineterminator="\n")
+            batches = _run_records(run_files, chr_col - 1, pos_col - 1)
+
+        writer = ParallelCompressedWriter(f"{out_file}.tmp", "bgzip", threads)
+        try:
+            offset = writer.write(("#" + "\t".join(header) + "\n").encode())
+            for chroms, pos, lines in batches:
+                lengths = np.fromiter(map(len, lines), dtype=np.int64, count=len(lines))
+                index.add(chroms, pos, offset + np.concatenate([[0], np.cumsum(lengths)[:-1]]))
+                writer.write(b"".join(lines))
+                add_rows(len(lines))
+                offset += int(lengths.sum())
+        finally:
+            writer.close()
+
+    index.write(f"{out_file}.tbi.tmp", writer, offset)
+    os.replace(f"{out_file}.tmp", out_file)
+    os.replace(f"{out_file}.tbi.tmp", f"{out_file}.tbi")
+    return out_file
+
+
+@instrumented()
+def process_file(path, args):
+    out_file = compress_and_index(path, None, args.chr_col, args.pos_col, args.chunk_rows, args.tmpdir, args.threads)
+    if not args.no_thinned:
+        write_thinned(out_file)
+    return out_file
+
+
+def main():
+    args = parse_args()
+
+    files = list(args.files)
+    if args.file_list is not None:
+        with open(args.file_list) as f:
+            files += [line.strip() for line in f if line.strip()]
+    logging.info(f"Sorting, compressing and indexing {len(files)} files")
+
+    n_failed = 0
+    with stage("compress_index", n_files=len(files)), ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(process_file, path, args): path for path in files}
+        for future in as_completed(futures):
+            try:
+                logging.info(f"Finished: {future.result()}")
+            except Exception as e:
+                n_failed += 1
+                logging.error(f"Failed {futures[future]}: {e}")
+
+    if n_failed:
+        raise SystemExit(f"{n_failed} files failed")
+
+
+if __name__ == "__main__":
+    main()
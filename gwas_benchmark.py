@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the post-GWAS stages on synthetic data (gwas_synthetic_data.py).
+
+Every stage runs as its own process, through the same scripts and options as on the cluster,
+with inputs from --data and outputs in --workdir (default: {data}/bench). For each run:
+  - wall time,
+  - peak RSS: the largest single process of the stage (getrusage of the children, so pool
+    workers are included), and the sampled sum over the process tree if psutil is installed,
+  - throughput: stage units (rows, samples) per second.
+
+Results are appended to --results (TSV), with the git commit and the data scale, so runs
+before and after a change can be compared. The log of every stage is in {workdir}/logs, and
+the exit status is non-zero if any stage failed.
+
+Stages: gather, signif_snps, subset, qc, remove_related, adj_covariates, compress_index,
+browser_region, browser_overview (later stages read the outputs of earlier ones).
+
+Usage:
+    gwas_synthetic_data.py --outdir bench --n_samples 50000 --n_variants 1000000
+    gwas_benchmark.py --data bench --results bench_results.tsv --workers 8
+    gwas_benchmark.py --data bench --stages qc --repeat 3
+"""
+import argparse
+import datetime
+import glob
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import pandas as pd
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STAGES = ["gather", "signif_snps", "subset", "qc", "remove_related", "adj_covariates",
+          "compress_index", "browser_region", "browser_overview"]
+RESULT_COLUMNS = ["timestamp", "commit", "stage", "repeat", "n_samples", "n_variants", "n_phenotypes",
+                  "seconds", "peak_rss_mb", "tree_rss_mb", "units", "unit", "units_per_s", "returncode"]
+POLL_INTERVAL = 0.1
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Time the post-GWAS stages on synthetic data.")
+    sub = parser.add_subparsers(dest="command")
+
+    run = sub.add_parser("run", help="Run the benchmark (default).")
+    _add_run_args(run)
+
+    measure = sub.add_parser("_measure", help=argparse.SUPPRESS)
+    measure.add_argument("--log", required=True)
+    measure.add_argument("cmd", nargs=argparse.REMAINDER)
+
+    stage = sub.add_parser("_stage", help=argparse.SUPPRESS)
+    stage.add_argument("stage")
+    stage.add_argument("--data", required=True)
+    stage.add_argument("--workdir", required=True)
+
+    argv = sys.argv[1:]
+    if not argv or argv[0] not in ("run", "_measure", "_stage", "-h", "--help"):
+        argv = ["run"] + argv
+    return parser.parse_args(argv)
+
+
+def _add_run_args(parser):
+    parser.add_argument("--data", required=True, help="Output directory of gwas_synthetic_data.py.")
+    parser.add_argument("--workdir", default=None, help="Stage outputs (default: {data}/bench).")
+    parser.add_argument("--results", default="bench_results.tsv")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--repeat", default=1, type=int)
+    parser.add_argument("--workers", default=os.cpu_count(), type=int)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "-C", HERE, "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def _tree_rss(proc):
+    try:
+        procs = [proc] + proc.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return 0
+    total = 0
+    for p in procs:
+        try:
+            total += p.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return total
+
+
+def measure_child(cmd, log):
+    """
+    Run `cmd` (in the `_measure` process, so getrusage only covers this stage) and print
+    its wall time, return code and peak RSS as JSON.
+    """
+    with open(log, "w") as f:
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, stdout=f, stderr=subprocess.STDOUT, cwd=HERE)
+        tree_peak = 0
+        if psutil is not None:
+            ps = psutil.Process(proc.pid)
+            while proc.poll() is None:
+                tree_peak = max(tree_peak, _tree_rss(ps))
+                time.sleep(POLL_INTERVAL)
+        returncode = proc.wait()
+        seconds = time.perf_counter() - start
+
+    # ru_maxrss (KiB on Linux): largest process among the reaped descendants
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    print(json.dumps({
+        "seconds": seconds,
+        "returncode": returncode,
+        "peak_rss_mb": peak / 1024,
+        "tree_rss_mb": tree_peak / 1024**2 if psutil is not None else None,
+    }))
+
+
+def measure(cmd, log):
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), "_measure", "--log", log, *cmd],
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+class Benchmark:
+    """Commands and unit counts of the stages, from the manifest of the synthetic data."""
+
+    def __init__(self, data, workdir, workers):
+        self.data = os.path.abspath(data)
+        self.workdir = os.path.abspath(workdir or os.path.join(data, "bench"))
+        self.workers = workers
+        with open(os.path.join(self.data, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        self.phenos = self.manifest["phenotypes"]
+        self.ages = self.manifest["ages"]
+        kinds = self.manifest["kinds"]
+        # Merged results: gathered from the step-2 files if there are any, else the generated ones
+        self.merged = os.path.join(self.workdir, "merged") if "step2" in kinds else os.path.join(self.data, "merged")
+        self.has = {
+            "gather": "step2" in kinds,
+            "signif_snps": "step2" in kinds or "merged" in kinds,
+            "subset": "step2" in kinds or "merged" in kinds,
+            "qc": "step2" in kinds or "merged" in kinds,
+            "remove_related": {"sample", "kinship", "phenotypes"} <= set(kinds),
+            "adj_covariates": "phenotypes" in kinds,
+            "compress_index": "assoc" in kinds,
+            "browser_region": "assoc" in kinds,
+            "browser_overview": "assoc" in kinds,
+        }
+
+    def path(self, *parts):
+        return os.path.join(self.workdir, *parts)
+
+    def script(self, name, *args):
+        return [sys.executable, os.path.join(HERE, name), *map(str, args)]
+
+    def assoc_files(self):
+        return sorted(glob.glob(os.path.join(self.data, "assoc", "*.assoc.linear")))
+
+    def command(self, stage):
+        n_embeddings = self.manifest["n_embeddings"]
+        if stage == "gather":
+            return self.script("regenie_gather_output.py", "--regions_file", os.path.join(self.data, "regions.bed"),
+                               "--indir", os.path.join(self.data, "step2"), "--outdir", self.merged,
+                               "--prefix", "emb120", "--workers", self.workers, "--phenotypes", *self.phenos)
+        if stage == "signif_snps":
+            return self.script("regenie_signif_snps.py", "--indir", self.merged,
+                               "--output_prefix", self.path("signif_snps"), "--workers", self.workers)
+        if stage == "subset":
+            return self.script("regenie_subset.py", "--indir", self.merged, "--outdir", self.path("subsetted"),
+                               "--snplist", self.path("signif_snps.txt"), "--workers", self.workers,
+                               "--embeddings", *range(n_embeddings), "--ages", *self.ages)
+        if stage == "qc":
+            return self.script("gwas_qc.py", "--indir", self.merged, "--output", self.path("qc_table.tsv"),
+                               "--workers", self.workers)
+        if stage == "remove_related":
+            return self.script("remove_related.py",
+                               "-p", *[os.path.join(self.data, f"embeddings_{age}.csv") for age in self.ages],
+                               "-o", *[f"embeddings_{age}" for age in self.ages],
+                               "--relatedness_file", os.path.join(self.data, "rel.dat"),
+                               "--bgen_sample_file", os.path.join(self.data, "ukb.sample"),
+                               "--output_dir", self.path("unrelated"), "--tmpdir", self.path("tmp"),
+                               "--overwrite_output", "--workers", self.workers)
+        if stage == "compress_index":
+            # No thinned subsets: browser_overview has to compute them, as on first use in the browser
+            return self.script("compress_and_index_gwas.py", *self.assoc_files(), "--no_thinned",
+                               "--workers", self.workers, "--tmpdir", self.path("tmp"))
+        return [sys.executable, os.path.abspath(__file__), "_stage", stage, "--data", self.data, "--workdir", self.workdir]
+
+    def units(self, stage):
+        n_samples, n_variants = self.manifest["n_samples"], self.manifest["n_variants"]
+        if stage in ("gather", "signif_snps", "subset", "qc"):
+            return n_variants * len(self.phenos), "rows"
+        if stage == "remove_related":
+            return n_samples * len(self.ages), "samples"
+        if stage == "adj_covariates":
+            return n_samples * len(self.phenos), "values"
+        if stage in ("compress_index", "browser_overview"):
+            return n_variants * len(self.assoc_files()), "rows"
+        if stage == "browser_region":
+            # Chromosome 1 holds about 8% of the variants
+            return int(0.08 * n_variants) * len(self.assoc_files()), "rows"
+        raise ValueError(stage)
+
+    def run_stage(self, stage, repeat, commit):
+        os.makedirs(self.path("logs"), exist_ok=True)
+        os.makedirs(self.path("tmp"), exist_ok=True)
+        log = self.path("logs", f"{stage}.{repeat}.log")
+        result = measure(self.command(stage), log)
+        units, unit = self.units(stage)
+        if result["returncode"] != 0:
+            logging.error(f"{stage} failed (exit {result['returncode']}), see {log}")
+        return {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": commit,
+            "stage": stage,
+            "repeat": repeat,
+            "n_samples": self.manifest["n_samples"],
+            "n_variants": self.manifest["n_variants"],
+            "n_phenotypes": len(self.phenos),
+            "seconds": round(result["seconds"], 3),
+            "peak_rss_mb": round(result["peak_rss_mb"], 1),
+            "tree_rss_mb": None if result["tree_rss_mb"] is None else round(result["tree_rss_mb"], 1),
+            "units": units,
+            "unit": unit,
+            "units_per_s": round(units / result["seconds"]) if result["returncode"] == 0 else None,
+            "returncode": result["returncode"],
+        }
+
+
+def run_in_process_stage(stage, data, workdir):
+    """Stages without a command line of their own: library calls, as made by the notebooks and the browser."""
+    sys.path.insert(0, HERE)
+    if stage == "adj_covariates":
+        from gwas_covariates_helpers import adj_by_covariates
+        covariates = pd.read_csv(os.path.join(data, "covariates.csv"))
+        for path in sorted(glob.glob(os.path.join(data, "embeddings_*.csv"))):
+            adj = adj_by_covariates(pd.read_csv(path), covariates)["adj_pheno_df"]
+            logging.info(f"{os.path.basename(path)}: {adj.shape[0]} samples x {adj.shape[1] - 1} phenotypes adjusted")
+        return
+
+    from gwas_browser_helpers import load_genome_overview, load_region, thinned_path
+    for path in sorted(glob.glob(os.path.join(data, "assoc", "*.assoc.linear"))):
+        if stage == "browser_region":
+            df = load_region(path, 1)
+        else:
+            # Time the thinning of the full results, not the read of a subset left by an earlier run
+            if os.path.exists(thinned_path(path)):
+                os.remove(thinned_path(path))
+            df = load_genome_overview(path)
+        logging.info(f"{os.path.basename(path)}: {len(df)} rows")
+
+
+def append_results(rows, path):
+    df = pd.DataFrame(rows, columns=RESULT_COLUMNS).astype({"units_per_s": "Int64"})
+    df.to_csv(path, sep="\t", index=False, mode="a", header=not os.path.exists(path))
+
+
+def main():
+    args = parse_args()
+    if args.command == "_measure":
+        measure_child([c for c in args.cmd if c != "--"], args.log)
+        return
+    if args.command == "_stage":
+        run_in_process_stage(args.stage, args.data, args.workdir)
+        return
+
+    bench = Benchmark(args.data, args.workdir, args.workers)
+    commit = git_commit()
+    if psutil is None:
+        logging.info("psutil is not installed: only the peak RSS of the largest process is recorded")
+
+    rows = []
+    for stage in args.stages:
+        if not bench.has[stage]:
+            logging.info(f"{stage}: no input in {args.data} (see --kinds of gwas_synthetic_data.py), skipped")
+            continue
+        for repeat in range(args.repeat):
+            row = bench.run_stage(stage, repeat, commit)
+            logging.info(f"{stage}: {row['seconds']:.2f} s, peak RSS {row['peak_rss_mb']:.0f} MB, "
+                         f"{row['units_per_s'] or 0:,} {row['unit']}/s")
+            rows.append(row)
+
+    append_results(rows, args.results)
+    logging.info(f"{len(rows)} results appended to {args.results}")
+    failed = sorted({row["stage"] for row in rows if row["returncode"] != 0})
+    if failed:
+        logging.error(f"Failed stages: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,23 +2,43 @@ import pandas as pd
 import numpy as np
 import glob
 import os
-import re
 import streamlit as st
 import matplotlib.pyplot as plt
 
+from gwas_browser_helpers import (
+    RAW_SUFFIX, INDEXED_SUFFIX, strip_suffix, indexed_path, prepare_gwas_df, read_full,
+    load_region, load_genome_overview, genome_positions, thin_points, ResultCache,
+    update_summary_index,
+)
+
+# Points above this -log10(P) are always drawn; the rest are binned per pixel
+MANHATTAN_KEEP_ABOVE = 5
+
+# Memory bound (MB) of the shared result cache, and optional local directory (bounded, MB) to spill evicted entries to
+CACHE_MB = int(os.environ.get("GWAS_BROWSER_CACHE_MB", 2048))
+CACHE_SPILL_DIR = os.environ.get("GWAS_BROWSER_SPILL_DIR")
+CACHE_SPILL_MB = int(os.environ.get("GWAS_BROWSER_SPILL_MB", 8192))
+
+# Seconds before the summary tab checks the summary folder for new or modified files again
+SUMMARY_TTL_S = int(os.environ.get("GWAS_BROWSER_SUMMARY_TTL", 600))
+
 def list_available_files(folder):
-    files = glob.glob(os.path.join(folder, "*.assoc.linear"))
+    files = glob.glob(os.path.join(folder, "*" + RAW_SUFFIX)) + glob.glob(os.path.join(folder, "*" + INDEXED_SUFFIX))
     info = []
+    seen = set()
 
-    for f in files:
-        base = os.path.basename(f).replace(".assoc.linear", "")
+    for f in sorted(files):
+        base = os.path.basename(strip_suffix(f))
+        if base in seen:
+            continue
         parts = base.split("_")
         if parts[0] != "embedding":
             continue
         try:
             component = int(parts[1])
             group = "_".join(parts[2:])
-            info.append({"file": f, "component": component, "group": group})
+            info.append({"file": f, "component": component, "group": group, "indexed": indexed_path(f) is not None})
+            seen.add(base)
         except:
             continue
 
@@ -26,41 +46,33 @@ def list_available_files(folder):
     return df
 
 def load_single_gwas(path):
-    df = pd.read_csv(path, sep='\s+')
-    df = df[df["P"] > 0].dropna(subset=["P", "CHR", "BP"])
-    df["-log10(P)"] = -np.log10(df["P"])
-    df["chrom_numeric"] = pd.to_numeric(df["CHR"], errors="coerce")
-    df = df.dropna(subset=["chrom_numeric", "BP", "-log10(P)"])
-    return df
+    return prepare_gwas_df(read_full(path))
 
 def manhattan_and_qq(df):
-    df = df.copy()
     df = df[df["P"] > 0].dropna(subset=["P", "CHR", "BP"])
-    df["-log10(P)"] = -np.log10(df["P"])
-    df["CHR"] = pd.to_numeric(df["CHR"], errors="coerce").astype(int)
-    df = df.sort_values(["CHR", "BP"])
+    df = df.assign(
+        **{"-log10(P)": -np.log10(df["P"]), "CHR": pd.to_numeric(df["CHR"], errors="coerce").astype(int)}
+    ).sort_values(["CHR", "BP"])
+    logp = df["-log10(P)"].to_numpy()
+    chrom = df["CHR"].to_numpy()
 
     # Manhattan: calcular posición acumulada
-    chr_offsets = {}
-    offset = 0
-    ticks = []
-    labels = []
-
-    for chrom in sorted(df["CHR"].unique()):
-        chr_df = df[df["CHR"] == chrom]
-        chr_offsets[chrom] = offset
-        max_bp = chr_df["BP"].max()
-        midpoint = offset + max_bp / 2
-        ticks.append(midpoint)
-        labels.append(str(chrom))
-        offset += max_bp
-
-    df["genome_pos"] = df.apply(lambda row: row["BP"] + chr_offsets[row["CHR"]], axis=1)
+    genome_pos, ticks, labels = genome_positions(chrom, df["BP"].to_numpy())
+    keep = thin_points(genome_pos, logp, keep_above=MANHATTAN_KEEP_ABOVE)
+    genome_pos, logp, chrom = genome_pos[keep], logp[keep], chrom[keep]
 
     # QQ plot: valores esperados vs observados
-    pvals = df["P"].sort_values()
-    expected = -np.log10(np.linspace(1 / len(pvals), 1, len(pvals)))
-    observed = -np.log10(pvals.values)
+    if "QQ_EXPECTED" in df.columns:
+        # Thinned subset: expected values were computed on the full set of variants
+        qq_df = df.sort_values("P")
+        expected = qq_df["QQ_EXPECTED"].to_numpy()
+        observed = qq_df["-log10(P)"].to_numpy()
+    else:
+        pvals = np.sort(df["P"].to_numpy())
+        expected = -np.log10(np.linspace(1 / len(pvals), 1, len(pvals)))
+        observed = -np.log10(pvals)
+    keep = thin_points(expected, observed, keep_above=MANHATTAN_KEEP_ABOVE, x_bins=400, y_bins=400)
+    expected, observed = expected[keep], observed[keep]
 
     # Layout en columnas
     col1, col2 = st.columns([2.5, 1])
@@ -68,7 +80,7 @@ def manhattan_and_qq(df):
     with col1:
         st.subheader("Manhattan Plot")
         fig1, ax1 = plt.subplots(figsize=(10, 4))
-        ax1.scatter(df["genome_pos"], df["-log10(P)"], c=df["CHR"] % 2, cmap="coolwarm", s=3)
+        ax1.scatter(genome_pos, logp, c=chrom % 2, cmap="coolwarm", s=3)
         ax1.axhline(-np.log10(5e-8), color='grey', linestyle='--', linewidth=1)
         ax1.set_xlabel("Chromosome")
         ax1.set_ylabel("-log10(P)")
@@ -85,6 +97,10 @@ def manhattan_and_qq(df):
         ax2.set_ylabel("Observed -log10(P)")
         st.pyplot(fig2)
 
+@st.cache_resource
+def get_result_cache():
+    return ResultCache(max_bytes=CACHE_MB * 1024**2, spill_dir=CACHE_SPILL_DIR, spill_max_bytes=CACHE_SPILL_MB * 1024**2)
+
 # === Streamlit app ===
 
 st.set_page_config(layout="wide")
@@ -97,6 +113,7 @@ SUMMARY_FOLDER = os.path.join(FOLDER, "summaries")
 
 # Cargar índice de archivos disponibles
 available = list_available_files(FOLDER)
+cache = get_result_cache()
 
 tab1, tab2 = st.tabs(["📈 Visualización por archivo", "🌍 Panorama general por embedding"])
 
@@ -114,51 +131,35 @@ with tab1:
         else:
             path = selected_row.iloc[0]["file"]
             st.success(f"Archivo seleccionado: {os.path.basename(path)}")
-    
-            df = load_single_gwas(path)
-    
-            manhattan_and_qq(df)
-    
-            st.subheader("Top SNPs")
-            st.dataframe(df.sort_values("P").head(20))
 
-@st.cache_data
+            if selected_row.iloc[0]["indexed"]:
+                view = st.selectbox("Región", ["Genoma completo"] + [str(c) for c in range(1, 23)])
+                if view == "Genoma completo":
+                    df = cache.get(load_genome_overview, path)
+                else:
+                    start, end = st.slider("Ventana (Mb)", 0, 250, (0, 250))
+                    df = cache.get(load_region, path, view, start * 1_000_000, end * 1_000_000)
+            else:
+                df = cache.get(load_single_gwas, path)
+
+            if df.empty:
+                st.warning("No variants in the selected region.")
+            else:
+                manhattan_and_qq(df)
+
+                st.subheader("Top SNPs")
+                st.dataframe(df.sort_values("P").head(20))
+
+@st.cache_data(ttl=SUMMARY_TTL_S, max_entries=10)
 def collect_summaries(summary_folder):
-    files = glob.glob(os.path.join(summary_folder, "embedding_*_chr*.csv"))
-    summary_rows = []
-
-    pattern = re.compile(r"embedding_(\d+)_white_([^_]+)_(chr\d+)_1Mb\.csv")
-    from tqdm import tqdm
-
-    for f in tqdm(files):
-        match = pattern.search(os.path.basename(f))
-        if not match:
-            continue
-
-        component = int(match.group(1))
-        group = match.group(2)
-        chr_label = match.group(3)
-
-        try:
-            df = pd.read_csv(f)
-            num_significant = (df["P"] < 5e-8).sum()
-            summary_rows.append({
-                "component": component,
-                "group": group,
-                "chromosome": chr_label,
-                "n_sig_blocks": num_significant
-            })
-        except Exception as e:
-            print(f"❌ Error in {f}: {e}")
-
-    summary_df = pd.DataFrame(summary_rows)
+    summary_df = update_summary_index(summary_folder)
 
     if summary_df.empty:
         st.warning("No summary files found.")
-    else:
-        table = summary_df.groupby(["component", "group"]).agg({"n_sig_blocks": "sum"}).reset_index()
-        table = table.sort_values("n_sig_blocks", ascending=False)
-    
+        return summary_df
+
+    table = summary_df.groupby(["component", "group"]).agg({"n_sig_blocks": "sum"}).reset_index()
+    table = table.sort_values("n_sig_blocks", ascending=False)
     return table
 
 with tab2:
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+Data loading for the GWAS browser (gwas_browser_app.py).
+
+When `compress_and_index_gwas.sh` has produced `{name}.sorted.assoc.linear.gz` (+ `.tbi`),
+a chromosome or window is fetched through the tabix index, and the whole-genome view is
+read from a precomputed thinned subset (`{name}.thinned.tsv.gz`).
+
+Usage (precompute thinned subsets):
+    gwas_browser_helpers.py gwas/gwas_outputs_20/*.sorted.assoc.linear.gz
+"""
+import glob
+import gzip
+import hashlib
+import io
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+RAW_SUFFIX = ".assoc.linear"
+INDEXED_SUFFIX = ".sorted.assoc.linear.gz"
+THINNED_SUFFIX = ".thinned.tsv.gz"
+
+# Thinning: keep every variant with P below THIN_KEEP_P, and a fixed fraction of the rest
+THIN_KEEP_P = 1e-3
+THIN_FRACTION = 0.02
+
+# Columns kept by the result cache (those plotted or shown in the "Top SNPs" table), with their compact dtypes
+CACHE_COLUMNS = {
+    "CHR": "int8",
+    "SNP": "string",
+    "BP": "int32",
+    "A1": "category",
+    "TEST": "category",
+    "NMISS": "int32",
+    "BETA": "float32",
+    "SE": "float32",
+    "L95": "float32",
+    "U95": "float32",
+    "STAT": "float32",
+    "P": "float64",
+    "-log10(P)": "float32",
+    "QQ_EXPECTED": "float32",
+}
+
+
+def strip_suffix(path):
+    for suffix in (INDEXED_SUFFIX, RAW_SUFFIX):
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+
+def indexed_path(path):
+    """Path of the bgzipped, tabix-indexed version of `path`, or None if it doesn't exist."""
+    gz = strip_suffix(path) + INDEXED_SUFFIX
+    if os.path.exists(gz) and os.path.exists(gz + ".tbi"):
+        return gz
+    return None
+
+
+def thinned_path(path):
+    return strip_suffix(path) + THINNED_SUFFIX
+
+
+def prepare_gwas_df(df):
+    """Drop invalid rows and add -log10(P) and a numeric chromosome."""
+    df = df[df["P"] > 0].dropna(subset=["P", "CHR", "BP"])
+    df["-log10(P)"] = -np.log10(df["P"])
+    df["chrom_numeric"] = pd.to_numeric(df["CHR"], errors="coerce")
+    df = df.dropna(subset=["chrom_numeric", "BP", "-log10(P)"])
+    return df
+
+
+def read_full(path):
+    """Read a whole results file (raw whitespace-delimited or the sorted, bgzipped one)."""
+    if path.endswith(".gz"):
+        df = pd.read_csv(path, sep="\t")
+        return df.rename(columns={df.columns[0]: df.columns[0].lstrip("#")})
+    return pd.read_csv(path, sep=r"\s+")
+
+
+def _read_header(gz):
+    with gzip.open(gz, "rt") as f:
+        return f.readline().lstrip("#").rstrip("\n").split("\t")
+
+
+def load_region(path, chrom, start=None, end=None):
+    """Variants on `chrom` (optionally within [start, end]) fetched through the tabix index."""
+    gz = indexed_path(path)
+    if gz is None:
+        df = read_full(path)
+        df = df[df["CHR"].astype(str) == str(chrom)]
+        if start is not None:
+            df = df[df["BP"] >= start]
+        if end is not None:
+            df = df[df["BP"] <= end]
+        return prepare_gwas_df(df)
+
+    region = str(chrom) if start is None and end is None else f"{chrom}:{start or 1}-{end or 2**29}"
+    if pysam is not None:
+        with pysam.TabixFile(gz) as tbx:
+            lines = list(tbx.fetch(region=region)) if str(chrom) in tbx.contigs else []
+        text = "\n".join(lines)
+    elif shutil.which("tabix"):
+        text = subprocess.run(["tabix", gz, region], check=True, capture_output=True, text=True).stdout
+    else:
+        raise RuntimeError("Reading an indexed region requires pysam or the tabix executable")
+
+    columns = _read_header(gz)
+    if not text.strip():
+        return prepare_gwas_df(pd.DataFrame(columns=columns))
+    return prepare_gwas_df(pd.read_csv(io.StringIO(text), sep="\t", header=None, names=columns))
+
+
+def write_thinned(path, out_file=None, keep_p=THIN_KEEP_P, fraction=THIN_FRACTION, seed=0):
+    """
+    Write the thinned whole-genome subset of `path`: all variants with P < keep_p plus a random
+    `fraction` of the others. QQ_EXPECTED holds each variant's expected -log10(P) from its rank
+    among all variants, so the QQ plot can be drawn from the subset.
+    """
+    out_file = thinned_path(path) if out_file is None else out_file
+    df = prepare_gwas_df(read_full(path))
+
+    rank = df["P"].rank(method="first").to_numpy()
+    df["QQ_EXPECTED"] = -np.log10(rank / len(df))
+
+    rng = np.random.default_rng(seed)
+    keep = (df["P"] < keep_p).to_numpy() | (rng.random(len(df)) < fraction)
+    df = df[keep]
+
+    df.to_csv(out_file, sep="\t", index=False)
+    return out_file
+
+
+def load_genome_overview(path):
+    """Thinned whole-genome subset of `path` (computed and saved next to it on first use)."""
+    thinned = thinned_path(path)
+    if not os.path.exists(thinned):
+        write_thinned(indexed_path(path) or path, thinned)
+    return pd.read_csv(thinned, sep="\t")
+
+
+def genome_positions(chrom, bp):
+    """
+    Cumulative genome-wide positions for a Manhattan plot.
+    Returns (positions, chromosome tick positions, chromosome labels).
+    """
+    chrom = np.asarray(chrom)
+    bp = np.asarray(bp, dtype=np.int64)
+    chroms, inverse = np.unique(chrom, return_inverse=True)
+    max_bp = np.zeros(len(chroms), dtype=np.int64)
+    np.maximum.at(max_bp, inverse, bp)
+    offsets = np.concatenate([[0], np.cumsum(max_bp)[:-1]])
+    return bp + offsets[inverse], offsets + max_bp / 2, [str(c) for c in chroms]
+
+
+def thin_points(x, y, keep_above, x_bins=2000, y_bins=400):
+    """
+    Indices of the points to draw: every point with y >= keep_above, and one point per
+    (x, y) pixel bin among the rest, so the number of points drawn is bounded by the figure size.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    above = np.flatnonzero(y >= keep_above)
+    below = np.flatnonzero(y < keep_above)
+    if len(below) == 0:
+        return above
+
+    def to_bin(v, n):
+        lo, hi = v.min(), v.max()
+        return np.minimum(((v - lo) / (hi - lo or 1) * n).astype(np.int64), n - 1)
+
+    cell = to_bin(x[below], x_bins) * y_bins + to_bin(y[below], y_bins)
+    _, first = np.unique(cell, return_index=True)
+    return np.sort(np.concatenate([above, below[first]]))
+
+
+def compact_gwas_df(df):
+    """Keep only the columns the browser uses, with downcast dtypes."""
+    if "chrom_numeric" in df.columns:
+        df = df.assign(CHR=df["chrom_numeric"])
+    columns = [c for c in CACHE_COLUMNS if c in df.columns]
+    df = df[columns].astype({c: CACHE_COLUMNS[c] for c in columns})
+    return df.reset_index(drop=True)
+
+
+class ResultCache:
+    """
+    LRU cache of loaded GWAS results, bounded by memory (in bytes).
+
+    Entries are keyed by (path, mtime, loader, arguments) and stored in compact form
+    (see `compact_gwas_df`). If `spill_dir` is given, evicted entries are written there
+    as Parquet and read back on the next request instead of re-parsing the source file.
+    A spill file is deleted when its entry is read back, and the oldest ones are deleted
+    when the directory grows past `spill_max_bytes` (entries of since-modified sources are
+    never requested again). Safe to share between Streamlit sessions.
+    """
+
+    def __init__(self, max_bytes=2 * 1024**3, spill_dir=None, spill_max_bytes=8 * 1024**3):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _key(self, loader, path, args):
+        return (os.path.abspath(path), os.path.getmtime(path), loader.__name__) + tuple(args)
+
+    def _spill_file(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.spill_dir, f"{digest}.parquet")
+
+    def _put(self, key, df):
+        size = int(df.memory_usage(deep=True).sum())
+        self._entries[key] = (df, size)
+        self._nbytes += size
+        while self._nbytes > self.max_bytes and len(self._entries) > 1:
+            old_key, (old_df, old_size) = self._entries.popitem(last=False)
+            self._nbytes -= old_size
+            if self.spill_dir is not None:
+                try:
+                    old_df.to_parquet(self._spill_file(old_key), index=False)
+                except ImportError:
+                    logging.warning("Spilling the result cache requires pyarrow; disabling it.")
+                    self.spill_dir = None
+                else:
+                    self._prune_spill()
+
+    def _prune_spill(self):
+        """Delete the least recently written spill files above `spill_max_bytes`."""
+        files = []
+        for entry in os.scandir(self.spill_dir):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, spill_file in sorted(files):
+            if total <= self.spill_max_bytes:
+                break
+            try:
+                os.remove(spill_file)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def _unspill(self, key):
+        """The spilled entry of `key` (deleting its file), or None."""
+        if self.spill_dir is None:
+            return None
+        spill_file = self._spill_file(key)
+        try:
+            df = pd.read_parquet(spill_file)
+            os.remove(spill_file)
+        except FileNotFoundError:
+            # Not spilled, or read back (or pruned) by another session meanwhile
+            return None
+        return compact_gwas_df(df)
+
+    def get(self, loader, path, *args):
+        """`loader(path, *args)`, compacted, served from the cache when possible."""
+        key = self._key(loader, path, args)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+
+        df = self._unspill(key)
+        if df is None:
+            df = compact_gwas_df(loader(path, *args))
+
+        with self._lock:
+            if key not in self._entries:
+                self._put(key, df)
+        return df
+
+
+SUMMARY_PATTERN = re.compile(r"embedding_(\d+)_white_([^_]+)_(chr\d+)_1Mb\.csv")
+# Summary indexes live in a per-user cache directory (one per summary folder), not in the shared data folder
+SUMMARY_INDEX_DIR = os.path.expanduser(os.environ.get("GWAS_SUMMARY_INDEX_CACHE", "~/.cache/gwas_browser"))
+
+
+def summary_index_path(summary_folder, cache_dir=SUMMARY_INDEX_DIR):
+    digest = hashlib.sha1(os.path.abspath(summary_folder).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"summary_index_{digest}.sqlite")
+
+
+def _read_summary(path):
+    """
+    (path, mtime, component, group, chromosome, n_sig_blocks) for one summary file. Files with
+    an unexpected name or that cannot be read get null fields, so they are not re-read until modified.
+    """
+    mtime = os.path.getmtime(path)
+    match = SUMMARY_PATTERN.search(os.path.basename(path))
+    if not match:
+        return path, mtime, None, None, None, None
+    try:
+        n_sig = int((pd.read_csv(path, usecols=["P"])["P"] < 5e-8).sum())
+    except Exception as e:
+        logging.error(f"Error in {path}: {e}")
+        n_sig = None
+    return path, mtime, int(match.group(1)), match.group(2), match.group(3), n_sig
+
+
+def update_summary_index(summary_folder, index_file=None, workers=16):
+    """
+    Per-file significant-block counts of the `embedding_*_chr*.csv` summaries, kept in a
+    SQLite index (by default in SUMMARY_INDEX_DIR, see `summary_index_path`). Only new or
+    modified files are read, in a thread pool. Returns the index as a DataFrame.
+    """
+    if not os.path.isdir(summary_folder):
+        return pd.DataFrame(columns=["component", "group", "chromosome", "n_sig_blocks"])
+
+    if index_file is None:
+        index_file = summary_index_path(summary_folder)
+        os.makedirs(os.path.dirname(index_file), exist_ok=True)
+    files = {f: os.path.getmtime(f) for f in glob.glob(os.path.join(summary_folder, "embedding_*_chr*.csv"))}
+
+    con = sqlite3.connect(index_file)
+    with con:
+        con.execute("""CREATE TABLE IF NOT EXISTS summaries (path TEXT PRIMARY KEY, mtime REAL, component INTEGER,
+                       "group" TEXT, chromosome TEXT, n_sig_blocks INTEGER)""")
+        known = dict(con.execute("SELECT path, mtime FROM summaries"))
+        con.executemany("DELETE FROM summaries WHERE path = ?", [(p,) for p in known if p not in files])
+
+        stale = [f for f, mtime in files.items() if known.get(f) != mtime]
+        if stale:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                rows = list(pool.map(_read_summary, stale))
+            con.executemany("INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?, ?, ?)", rows)
+            n_skipped = sum(r[-1] is None for r in rows)
+            logging.info(f"Summary index: {len(rows)} new or updated files ({n_skipped} unreadable or unmatched)")
+
+    df = pd.read_sql_query('SELECT component, "group", chromosome, n_sig_blocks FROM summaries '
+                           'WHERE n_sig_blocks IS NOT NULL', con)
+    con.close()
+    return df
+
+
+def main():
+    for path in sys.argv[1:]:
+        print(f"Thinned {path} → {write_thinned(path)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Streaming compressed output with multi-threaded block compression.
+
+Data written to the handle is cut into blocks that are compressed in a thread pool (zlib
+releases the GIL) and written to disk in order, so a table is compressed while it is being
+formatted, without an uncompressed intermediate file.
+
+Two formats:
+  - "gzip":  one gzip member per block (a multi-member gzip file, readable by gzip, zcat, pandas),
+  - "bgzip": BGZF blocks with the end-of-file marker (as written by `bgzip`, usable with tabix).
+
+Usage:
+    with open_compressed("pheno.tsv.gz", "bgzip", threads=8) as f:
+        df.to_csv(f, sep="\\t", index=False)
+"""
+import io
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+COMPRESSIONS = ("gzip", "bgzip")
+
+GZIP_BLOCK_SIZE = 4 * 1024**2
+# BGZF blocks hold at most 64 KiB compressed; bgzip fills them with 0xff00 bytes of input
+BGZF_BLOCK_SIZE = 0xff00
+# Uncompressed bytes handed to a worker at a time in bgzip mode (several BGZF blocks)
+BGZF_TASK_SIZE = 64 * BGZF_BLOCK_SIZE
+
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def _gzip_member(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def bgzf_block(data, level=6):
+    """One BGZF block (gzip member with the BC extra field) holding `data` (at most 64 KiB)."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    bsize = len(cdata) + 25
+    header = struct.pack("<4BI2BH2BHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord("B"), ord("C"), 2, bsize)
+    return header + cdata + struct.pack("<II", zlib.crc32(data), len(data))
+
+
+def _bgzf_blocks(data, level):
+    return b"".join(bgzf_block(data[i:i + BGZF_BLOCK_SIZE], level) for i in range(0, len(data), BGZF_BLOCK_SIZE))
+
+
+class ParallelCompressedWriter(io.RawIOBase):
+    """
+    Binary file object compressing its input in a thread pool and writing the blocks in order.
+    At most `2 * threads` blocks are held in memory.
+    """
+
+    def __init__(self, path, compression="gzip", threads=None, level=6):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression: {compression} (expected one of {COMPRESSIONS})")
+        self.path = path
+        self.compression = compression
+        self.level = level
+        self.threads = threads or min(8, os.cpu_count())
+        self._compress = _bgzf_blocks if compression == "bgzip" else _gzip_member
+        self._block_size = BGZF_TASK_SIZE if compression == "bgzip" else GZIP_BLOCK_SIZE
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._pool = ThreadPoolExecutor(max_workers=self.threads)
+        self._file = open(path, "wb")
+        self._offset = 0
+        self.block_offsets = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            self._submit(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+        return len(data)
+
+    def _submit(self, data):
+        self._pending.append(self._pool.submit(self._compress, data, self.level))
+        while len(self._pending) > 2 * self.threads:
+            self._write_compressed(self._pending.popleft().result())
+
+    def _write_compressed(self, data):
+        if self.compression == "bgzip":
+            # Compressed offset of every BGZF block (BSIZE is the total block size minus 1)
+            i = 0
+            while i < len(data):
+                self.block_offsets.append(self._offset + i)
+                i += struct.unpack_from("<H", data, i + 16)[0] + 1
+        self._file.write(data)
+        self._offset += len(data)
+
+    def virtual_offsets(self, positions):
+        """
+        BGZF virtual offsets (compressed block offset << 16 | offset within the block) of
+        uncompressed `positions`. bgzip mode only, once the writer is closed.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        block, within = np.divmod(positions, BGZF_BLOCK_SIZE)
+        offsets = np.append(np.asarray(self.block_offsets, dtype=np.int64), self._offset - len(BGZF_EOF))
+        return (offsets[block] << 16) | within
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            while self._pending:
+                self._write_compressed(self._pending.popleft().result())
+            if self.compression == "bgzip":
+                self._file.write(BGZF_EOF)
+                self._offset += len(BGZF_EOF)
+        finally:
+            self._pool.shutdown()
+            self._file.close()
+            super().close()
+
+
+def open_compressed(path, compression="gzip", threads=None, level=6):
+    """Text handle writing to `path`, compressed in parallel (or plain if `compression` is None)."""
+    if compression is None:
+        return open(path, "w", newline="")
+    raw = ParallelCompressedWriter(path, compression, threads, level)
+    return io.TextIOWrapper(io.BufferedWriter(raw, buffer_size=1024**2), encoding="utf-8", newline="")
+
+
+def compressed_path(path, compression):
+    """`path` with the `.gz` suffix if it is written compressed."""
+    return path if compression is None or path.endswith(".gz") else f"{path}.gz"
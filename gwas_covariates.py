@@ -3,6 +3,7 @@ import os, sys
 os.getcwd()
 sys.path.append("gwas")
 import pandas as pd
+import numpy as np
 
 from importlib import reload 
 import gwas_covariates_helpers
@@ -67,31 +68,22 @@ covariates_df = all_df[covariates]
 covariates_df.to_csv("covariates_for_gwas.csv", index=True)
 
 # %%
-from tqdm import tqdm
-
 covariates = (all_pcs := [f'pc{i}' for i in range(1, 41)]) + ['sex']
 embedding_col = lambda i: f'embedding_{str(i).zfill(3)}'
-import gc
-
-fit = {}
-fit_summaries = []
-residues = []
-
-for j in tqdm(range(0, 120)):
-    model = gcov.fit_linear_model(all_df, embedding_col(j), covariates)
-    fit_results_df = pd.DataFrame({
-      "coef": model.params,
-      "std_err": model.bse,
-      "t": model.tvalues,
-      "pval": model.pvalues,
-    })
-    fit_summaries.append(fit_results_df)
-    residues.append( model.resid )
 
-    gc.collect()
+fit = gcov.fit_linear_models(all_df, [embedding_col(j) for j in range(0, 120)], covariates)
+residues = fit["resid"]
 
 # %%
-fit_summary_df = pd.concat([df.assign(embedding=i) for i, df in enumerate(fit_summaries)], axis=0)
+fit_summary_df = pd.concat([
+    pd.DataFrame({
+      "coef": fit["coef"][col],
+      "std_err": fit["std_err"][col],
+      "t": fit["t"][col],
+      "pval": fit["pval"][col],
+    }).assign(embedding=i)
+    for i, col in enumerate(fit["coef"].columns)
+], axis=0)
 
 # %%
 pc_only_pvals = fit_summary_df[['pval', 'embedding']].pivot(columns="embedding", values="pval").drop(['const', 'sex']).loc[[f'pc{i}' for i in range(1, 41)]]
@@ -1,12 +1,20 @@
+import hashlib
+import os
 import pandas as pd
 import numpy as np
 import yaml
 import logging
 from pathlib import Path
 import statsmodels.api as sm
+from scipy import linalg, special, stats
+
+from gwas_compressed_io import compressed_path, open_compressed
 
 logging.basicConfig(level=logging.INFO)
 
+# Parquet extracts of the covariate source files (see `read_covariate_source`)
+COVARIATE_CACHE_DIR = os.path.expanduser(os.environ.get("GWAS_COVARIATE_CACHE", "~/.cache/gwas_covariates"))
+
 
 def ukb_gen_read_sample(file, col_names=("id_1", "id_2", "missing"), row_skip=2):
     """Read UKB sample file (equivalent to ukbtools)."""
@@ -14,7 +22,49 @@ def ukb_gen_read_sample(file, col_names=("id_1", "id_2", "missing"), row_skip=2)
     return df
 
 
-def generate_covariates_df(covariates_config, impute_with_mean_for=None, return_individual_dfs=False):
+def _spec_columns(spec):
+    """Columns of a source file referenced by its YAML spec (ID column first)."""
+    columns = [spec[0]["id"]]
+    for entry in spec[1:]:
+        if isinstance(entry, str):
+            columns.append(entry)
+        elif isinstance(entry, dict) and "reduce" in entry:
+            columns.extend(entry["reduce"]["columns"])
+        elif isinstance(entry, dict):
+            columns.append(list(entry)[0])
+        else:
+            raise ValueError(f"Unexpected spec entry: {entry}")
+    return list(dict.fromkeys(columns))
+
+
+def read_covariate_source(covfile, columns, cache_dir=COVARIATE_CACHE_DIR):
+    """
+    Read `columns` of a covariate source file. The extract is cached in `cache_dir` as Parquet,
+    keyed by path, mtime, size and column set, so later reads skip the CSV parse.
+    Set `cache_dir` to None to disable the cache.
+    """
+    cache_file = None
+    if cache_dir is not None:
+        stat = os.stat(covfile)
+        key = f"{os.path.abspath(covfile)}|{stat.st_mtime_ns}|{stat.st_size}|{sorted(columns)}"
+        cache_file = os.path.join(cache_dir, f"{hashlib.sha1(key.encode()).hexdigest()}.parquet")
+        if os.path.exists(cache_file):
+            return pd.read_parquet(cache_file)
+
+    df = pd.read_csv(covfile, sep=_infer_delim(covfile), usecols=columns)
+
+    if cache_file is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            df.to_parquet(cache_file + ".tmp", index=False)
+            os.replace(cache_file + ".tmp", cache_file)
+        except (ImportError, OSError) as e:
+            logging.warning(f"Not caching {covfile}: {e}")
+    return df
+
+
+def generate_covariates_df(covariates_config, impute_with_mean_for=None, return_individual_dfs=False,
+                           cache_dir=COVARIATE_CACHE_DIR):
     """
     Load covariates from a config dict (parsed from YAML).
     Columns can be specified as strings or as {original_name: new_name}.
@@ -28,13 +78,14 @@ def generate_covariates_df(covariates_config, impute_with_mean_for=None, return_
       - id: "ID"
       - PC1
       - PC2
+
+    Only the columns referenced in the spec are read; see `read_covariate_source` for the cache.
     """
     covariates_df = None
     covariate_names = []
     individual_dfs = []
     for covfile, spec in covariates_config.items():
-        delim = _infer_delim(covfile)
-        df_ = pd.read_csv(covfile, sep=delim)
+        df_ = read_covariate_source(covfile, _spec_columns(spec), cache_dir)
 
         id_colname = spec[0]["id"]
         df_ = df_.rename(columns={id_colname: "ID"})
@@ -148,11 +199,110 @@ def fit_linear_model(df, phenotype, covariates):
     return fit
 
 
-def inverse_normalise(x):
-    """Rank-based inverse normalisation."""
-    ranks = x.rank(method="average", na_option="keep")
-    normed = (ranks - 0.5) / ranks.notna().sum()
-    return pd.Series(normed).apply(lambda p: sm.distributions.norm.ppf(p))
+def fit_linear_models(df, phenotypes, covariates):
+    """
+    Fit phenotype ~ covariates for many phenotypes at once (batched OLS).
+
+    Equivalent to calling `fit_linear_model` on each phenotype (rows with missing
+    values are dropped per phenotype), but phenotypes sharing the same missingness
+    pattern are solved together against a single QR factorization of the design matrix.
+
+    Returns a dict with DataFrames `coef`, `std_err`, `t`, `pval` (parameters x phenotypes),
+    `resid` (samples x phenotypes, NaN for dropped rows) and a Series `nobs`.
+    """
+    phenotypes = list(phenotypes)
+    param_names = ["const"] + list(covariates)
+
+    X = df[covariates].to_numpy(dtype=np.float64)
+    X = np.column_stack([np.ones(X.shape[0]), X])
+    Y = df[phenotypes].to_numpy(dtype=np.float64)
+
+    coef = np.full((len(param_names), len(phenotypes)), np.nan)
+    std_err = np.full_like(coef, np.nan)
+    resid = np.full(Y.shape, np.nan)
+    nobs = np.zeros(len(phenotypes), dtype=int)
+    dof = np.zeros(len(phenotypes), dtype=int)
+
+    # Group phenotypes by the set of rows that are usable for them
+    usable = np.isfinite(Y) & np.isfinite(X).all(axis=1)[:, None]
+    patterns, group_of = np.unique(np.packbits(usable, axis=0).T, axis=0, return_inverse=True)
+    group_of = np.asarray(group_of).ravel()
+
+    for g in range(len(patterns)):
+        cols = np.flatnonzero(group_of == g)
+        rows = usable[:, cols[0]]
+        nobs[cols] = rows.sum()
+        # No usable rows (e.g. an all-NaN phenotype): statistics stay NaN
+        if not rows.any():
+            continue
+        Xg, Yg = X[rows], Y[np.ix_(rows, cols)]
+
+        beta, xtx_inv, rank = _ols_solve(Xg, Yg)
+        df_resid = Xg.shape[0] - rank
+        # No residual degrees of freedom: the variance is undefined, statistics stay NaN
+        if df_resid <= 0:
+            continue
+        res = Yg - Xg @ beta
+        sigma2 = (res ** 2).sum(axis=0) / df_resid
+
+        coef[:, cols] = beta
+        std_err[:, cols] = np.sqrt(np.outer(np.diag(xtx_inv), sigma2))
+        resid[np.ix_(rows, cols)] = res
+        dof[cols] = df_resid
+
+    tvalues = coef / std_err
+    pvalues = 2 * stats.t.sf(np.abs(tvalues), dof)
+
+    to_df = lambda a: pd.DataFrame(a, index=param_names, columns=phenotypes)
+    return {
+        "coef": to_df(coef),
+        "std_err": to_df(std_err),
+        "t": to_df(tvalues),
+        "pval": to_df(pvalues),
+        "resid": pd.DataFrame(resid, index=df.index, columns=phenotypes),
+        "nobs": pd.Series(nobs, index=phenotypes),
+    }
+
+
+def _ols_solve(X, Y):
+    """Least squares via QR (pseudo-inverse if X is rank deficient, as statsmodels does)."""
+    Q, R = np.linalg.qr(X)
+    diag = np.abs(np.diag(R))
+    if diag.min() > diag.max() * max(X.shape) * np.finfo(float).eps:
+        beta = linalg.solve_triangular(R, Q.T @ Y)
+        R_inv = linalg.solve_triangular(R, np.eye(R.shape[0]))
+        return beta, R_inv @ R_inv.T, X.shape[1]
+
+    pinv = np.linalg.pinv(X)
+    return pinv @ Y, pinv @ pinv.T, np.linalg.matrix_rank(X)
+
+
+def inverse_normalise(x, dtype=None):
+    """
+    Rank-based inverse normalisation.
+
+    Accepts a Series, a DataFrame or a 1-D/2-D array; 2-D inputs are transformed
+    column by column in a single vectorised pass. Ties get average ranks and NaNs
+    are kept. `dtype` (e.g. np.float32) sets the output precision.
+    """
+    values = x.to_numpy() if isinstance(x, (pd.Series, pd.DataFrame)) else np.asarray(x)
+    values = values.astype(np.float64, copy=False)
+    is_1d = values.ndim == 1
+    if is_1d:
+        values = values[:, None]
+
+    ranks = pd.DataFrame(values).rank(method="average", na_option="keep").to_numpy()
+    normed = special.ndtri((ranks - 0.5) / np.isfinite(ranks).sum(axis=0))
+    if dtype is not None:
+        normed = normed.astype(dtype, copy=False)
+    if is_1d:
+        normed = normed[:, 0]
+
+    if isinstance(x, pd.Series):
+        return pd.Series(normed, index=x.index, name=x.name)
+    if isinstance(x, pd.DataFrame):
+        return pd.DataFrame(normed, index=x.index, columns=x.columns)
+    return normed
 
 
 def adj_by_covariates(raw_pheno_df, covariates_df):
@@ -163,26 +313,38 @@ def adj_by_covariates(raw_pheno_df, covariates_df):
     adj_pheno_df = raw_pheno_df.copy()
     merged = raw_pheno_df.merge(covariates_df, on="ID", how="left")
 
-    fit_summaries = {}
+    logging.info(f"Fitting {len(pheno_names)} phenotypes on {len(covariate_names)} covariates...")
+    fits = fit_linear_models(merged, pheno_names, covariate_names)
 
-    for pheno in pheno_names:
-        logging.info(f"Processing phenotype {pheno}...")
-        fit = fit_linear_model(merged, pheno, covariate_names)
+    adj_pheno_df[pheno_names] = inverse_normalise(fits["resid"]).to_numpy()
 
-        adj_resid = fit.resid
-        adj_norm = inverse_normalise(pd.Series(adj_resid))
-        adj_pheno_df[pheno] = adj_norm
-
-        fit_summaries[pheno] = fit.summary().tables[1]  # coefficients
+    fit_summaries = {
+        pheno: pd.DataFrame({
+            "coef": fits["coef"][pheno],
+            "std_err": fits["std_err"][pheno],
+            "t": fits["t"][pheno],
+            "pval": fits["pval"][pheno],
+        })
+        for pheno in pheno_names
+    }
 
     return {"adj_pheno_df": adj_pheno_df, "fit_summaries": fit_summaries}
 
 
-def format_df_for_tool(pheno_df, gwas_software="plink", ukb_sample=None):
-    """Format phenotype DataFrame for PLINK or BGENIE."""
+def format_df_for_tool(pheno_df, gwas_software="plink", ukb_sample=None, apply_rint=False,
+                       out_file=None, compression=None, na_rep="NA"):
+    """
+    Format phenotype DataFrame for PLINK or BGENIE (optionally rank-inverse-normalising phenotypes).
+    If `out_file` is given, the table is also written there as TSV, streamed through the parallel
+    compressor when `compression` is "gzip" or "bgzip".
+    """
     pheno_names = [c for c in pheno_df.columns if c != "ID"]
     gwas_software = gwas_software.lower()
 
+    if apply_rint:
+        pheno_df = pheno_df.copy()
+        pheno_df[pheno_names] = inverse_normalise(pheno_df[pheno_names])
+
     if gwas_software == "plink":
         logging.info("Formatting table for Plink...")
         pheno_df = pheno_df.rename(columns={"ID": "IID"})
@@ -201,6 +363,10 @@ def format_df_for_tool(pheno_df, gwas_software="plink", ukb_sample=None):
         logging.info("Ordering table according to BGEN samples file...")
         pheno_df = sample_df.merge(pheno_df, on="ID", how="left")[["ID"] + pheno_names]
 
+    if out_file is not None:
+        with open_compressed(compressed_path(out_file, compression), compression) as f:
+            pheno_df.to_csv(f, sep="\t", index=False, na_rep=na_rep)
+
     return pheno_df
 
 
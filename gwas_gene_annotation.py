@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Offline gene annotation (TSS per gene) and a position index of the genotyped variants.
+
+The annotation store is built once from a GTF (Ensembl/GENCODE, `gene` records) or a TSV
+with one row per gene or transcript (e.g. a BioMart export: gene name, chromosome, TSS,
+strand), and saved as Parquet. The TSS of a gene is its most upstream one: the smallest on
+the + strand, the largest on the - strand. Only chromosomes 1-22, X, Y and MT are kept.
+
+Variants of a PLINK `.bim` file are loaded on first use and kept sorted by position per
+chromosome, so window queries are binary searches.
+
+Usage:
+    gwas_gene_annotation.py --gtf Homo_sapiens.GRCh37.87.gtf.gz --out gene_annotation_grch37.parquet
+    gwas_gene_annotation.py --tsv mart_export.txt --out gene_annotation_grch37.parquet
+"""
+import argparse
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+
+# Path of the annotation store; no cwd-relative default (scripts resolve it, e.g. next to their genotypes)
+GENE_ANNOTATION = os.environ.get("GWAS_GENE_ANNOTATION")
+CHROMOSOMES = [str(c) for c in range(1, 23)] + ["X", "Y", "MT"]
+BIM_COLUMNS = ["chrom", "snp", "cm", "pos", "a1", "a2"]
+STORE_COLUMNS = ["gene_name", "gene_id", "chrom", "tss", "strand", "start", "end"]
+
+# Column names accepted in TSV inputs (lower case), by store column
+TSV_ALIASES = {
+    "gene_name": ["gene_name", "external_gene_name", "gene name", "gene"],
+    "gene_id": ["gene_id", "ensembl_gene_id", "gene stable id"],
+    "chrom": ["chrom", "chromosome", "chromosome_name", "chromosome/scaffold name", "chr"],
+    "tss": ["tss", "transcription_start_site", "transcription start site (tss)"],
+    "strand": ["strand"],
+    "start": ["start", "start_position", "gene start (bp)"],
+    "end": ["end", "end_position", "gene end (bp)"],
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build the offline gene annotation store (TSS per gene).")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--gtf", help="GTF file (optionally gzipped).")
+    source.add_argument("--tsv", help="Tab-separated file with gene name, chromosome, TSS (or start/end) and strand.")
+    parser.add_argument("--out", default=GENE_ANNOTATION, required=GENE_ANNOTATION is None,
+                        help="Store path (default: $GWAS_GENE_ANNOTATION).")
+    return parser.parse_args()
+
+
+def normalize_chrom(chrom):
+    """Chromosome names without the `chr` prefix (chrM -> MT), as strings."""
+    chrom = pd.Series(chrom).astype(str).str.replace(r"^chr", "", regex=True)
+    return chrom.replace({"M": "MT", "23": "X", "24": "Y", "26": "MT"})
+
+
+def _strand(values):
+    return pd.Series(values).astype(str).map({"+": 1, "1": 1, "-": -1, "-1": -1}).astype("Int8")
+
+
+def read_gtf(path):
+    """Gene records of a GTF as (gene_name, gene_id, chrom, strand, start, end)."""
+    gtf = pd.read_csv(path, sep="\t", comment="#", header=None, usecols=[0, 2, 3, 4, 6, 8],
+                      names=["chrom", "feature", "start", "end", "strand", "attributes"], dtype={"chrom": str})
+    feature = "gene" if (gtf["feature"] == "gene").any() else "transcript"
+    gtf = gtf[gtf["feature"] == feature]
+    attributes = gtf["attributes"]
+    return pd.DataFrame({
+        "gene_name": attributes.str.extract(r'gene_name "([^"]+)"', expand=False)
+                     .fillna(attributes.str.extract(r'gene_id "([^"]+)"', expand=False)),
+        "gene_id": attributes.str.extract(r'gene_id "([^"]+)"', expand=False),
+        "chrom": gtf["chrom"].to_numpy(),
+        "strand": gtf["strand"].to_numpy(),
+        "start": gtf["start"].to_numpy(),
+        "end": gtf["end"].to_numpy(),
+    })
+
+
+def read_tsv(path):
+    """Gene or transcript rows of a TSV, with the columns renamed to the store names."""
+    df = pd.read_csv(path, sep="\t", dtype=str)
+    lower = {c.lower(): c for c in df.columns}
+    renames = {}
+    for name, aliases in TSV_ALIASES.items():
+        for alias in aliases:
+            if alias in lower:
+                renames[lower[alias]] = name
+                break
+    df = df.rename(columns=renames)
+    missing = {"gene_name", "chrom", "strand"} - set(df.columns)
+    if missing or ("tss" not in df.columns and not {"start", "end"} <= set(df.columns)):
+        raise ValueError(f"{path}: needs gene name, chromosome, strand and TSS (or start and end) columns, got {list(df.columns)}")
+    return df[[c for c in STORE_COLUMNS if c in df.columns]]
+
+
+def build_gene_table(df):
+    """One row per (gene, chromosome) with its most upstream TSS, sorted by chromosome and TSS."""
+    df = df.dropna(subset=["gene_name", "chrom", "strand"]).copy()
+    df["chrom"] = normalize_chrom(df["chrom"]).to_numpy()
+    df["strand"] = _strand(df["strand"]).to_numpy()
+    df = df[df["chrom"].isin(CHROMOSOMES) & df["strand"].notna()]
+    for col in ("tss", "start", "end"):
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors="coerce")
+    if "tss" not in df.columns:
+        df["tss"] = np.where(df["strand"] > 0, df["start"], df["end"])
+    df = df.dropna(subset=["tss"])
+    if "gene_id" not in df.columns:
+        df["gene_id"] = ""
+
+    # Most upstream TSS: the minimum of strand * tss, per gene
+    df["_upstream"] = df["strand"].astype(np.int64) * df["tss"]
+    genes = (
+        df.groupby(["gene_name", "chrom"], sort=False)
+        .agg(gene_id=("gene_id", "first"), strand=("strand", "first"), _upstream=("_upstream", "min"),
+             start=("start" if "start" in df.columns else "tss", "min"), end=("end" if "end" in df.columns else "tss", "max"))
+        .reset_index()
+    )
+    genes["tss"] = genes["strand"].astype(np.int64) * genes["_upstream"]
+    genes = genes.astype({"tss": "int64", "start": "int64", "end": "int64", "strand": "int8"})
+    genes["_chrom_order"] = genes["chrom"].map({c: i for i, c in enumerate(CHROMOSOMES)})
+    return genes.sort_values(["_chrom_order", "tss"])[STORE_COLUMNS].reset_index(drop=True)
+
+
+class GeneAnnotation:
+    """TSS coordinates of genes, from the store written by this script."""
+
+    def __init__(self, genes):
+        self.genes = genes.reset_index(drop=True)
+        # First (primary-chromosome-ordered) record of each name
+        first = ~self.genes["gene_name"].duplicated()
+        self._row = dict(zip(self.genes.loc[first, "gene_name"], self.genes.index[first]))
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No gene annotation store at {path}: build it with gwas_gene_annotation.py --gtf/--tsv")
+        return cls(pd.read_parquet(path))
+
+    def tss(self, gene_name):
+        """(chrom, tss, strand) of `gene_name`, or None if unknown."""
+        row = self._row.get(gene_name)
+        if row is None:
+            return None
+        gene = self.genes.iloc[row]
+        return gene["chrom"], int(gene["tss"]), int(gene["strand"])
+
+    def lookup(self, gene_names):
+        """Store rows of `gene_names` (in that order; unknown names are skipped)."""
+        rows = [self._row[g] for g in gene_names if g in self._row]
+        return self.genes.iloc[rows].reset_index(drop=True)
+
+
+class VariantIndex:
+    """Variants of a `.bim` file sorted by position per chromosome, loaded on first use."""
+
+    def __init__(self, bim_path):
+        self.bim_path = bim_path
+        self._df = None
+        self._bounds = None
+
+    @property
+    def df(self):
+        if self._df is None:
+            df = pd.read_csv(self.bim_path, sep=r"\s+", header=None, names=BIM_COLUMNS, dtype={"chrom": str, "snp": str})
+            df["chrom"] = normalize_chrom(df["chrom"]).to_numpy()
+            df = df.sort_values(["chrom", "pos"], kind="stable").reset_index(drop=True)
+            # Sorted by chromosome name, so the first rows of the chromosomes are increasing
+            chroms, first = np.unique(df["chrom"].to_numpy(), return_index=True)
+            last = np.append(first[1:], len(df))
+            self._bounds = {c: (int(lo), int(hi)) for c, lo, hi in zip(chroms, first, last)}
+            self._pos = df["pos"].to_numpy(dtype=np.int64)
+            self._df = df
+        return self._df
+
+    def chromosome(self, chrom):
+        """(first row, positions) of `chrom` in `df`."""
+        self.df
+        lo, hi = self._bounds.get(str(chrom), (0, 0))
+        return lo, self._pos[lo:hi]
+
+    def window(self, chrom, start, end):
+        """Variants on `chrom` with start <= pos <= end."""
+        lo, pos = self.chromosome(normalize_chrom([chrom])[0])
+        i, j = np.searchsorted(pos, start, side="left"), np.searchsorted(pos, end, side="right")
+        return self.df.iloc[lo + i:lo + j]
+
+    def windows(self, chroms, starts, ends):
+        """
+        Variants in many windows at once: (window index, row of `df`) of every variant in
+        window k (chroms[k], [starts[k], ends[k]]), two binary searches per window.
+        """
+        chroms = normalize_chrom(chroms).to_numpy()
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        lo = np.zeros(len(chroms), dtype=np.int64)
+        hi = np.zeros(len(chroms), dtype=np.int64)
+        for chrom in np.unique(chroms):
+            k = np.flatnonzero(chroms == chrom)
+            first, pos = self.chromosome(chrom)
+            lo[k] = first + np.searchsorted(pos, starts[k], side="left")
+            hi[k] = first + np.searchsorted(pos, ends[k], side="right")
+        counts = hi - lo
+        window = np.repeat(np.arange(len(chroms)), counts)
+        rows = np.repeat(lo - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts) + np.arange(counts.sum())
+        return window, rows
+
+
+def window_join(left_chrom, left_pos, right_chrom, right_pos, window):
+    """
+    All pairs (i, j) with left_chrom[i] == right_chrom[j] and |left_pos[i] - right_pos[j]| <= window:
+    per chromosome, the right positions are sorted once and every left position is matched to
+    a contiguous range of them by two binary searches. Returns the (i, j) index arrays.
+    """
+    left_chrom = normalize_chrom(left_chrom).to_numpy()
+    right_chrom = normalize_chrom(right_chrom).to_numpy()
+    left_pos = np.asarray(left_pos, dtype=np.int64)
+    right_pos = np.asarray(right_pos, dtype=np.int64)
+
+    lefts, rights = [], []
+    for chrom in np.intersect1d(left_chrom, right_chrom):
+        li = np.flatnonzero(left_chrom == chrom)
+        rj = np.flatnonzero(right_chrom == chrom)
+        rj = rj[np.argsort(right_pos[rj], kind="stable")]
+        pos = right_pos[rj]
+        lo = np.searchsorted(pos, left_pos[li] - window, side="left")
+        hi = np.searchsorted(pos, left_pos[li] + window, side="right")
+        counts = hi - lo
+        lefts.append(np.repeat(li, counts))
+        rights.append(rj[np.repeat(lo - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts) + np.arange(counts.sum())])
+    if not lefts:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(lefts), np.concatenate(rights)
+
+
+def main():
+    args = parse_args()
+    raw = read_gtf(args.gtf) if args.gtf else read_tsv(args.tsv)
+    genes = build_gene_table(raw)
+    genes.to_parquet(args.out, index=False)
+    logging.info(f"{len(genes)} genes on {genes['chrom'].nunique()} chromosomes → {args.out}")
+
+
+if __name__ == "__main__":
+    main()
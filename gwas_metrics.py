@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Stage timing and resource metrics of the pipeline scripts, as JSON lines.
+
+Scripts mark their stages with `stage(name)` (context manager) or `@instrumented(name)`, and
+count the rows they process with `add_rows(n)`. When $GWAS_METRICS_DIR is set, every stage
+appends one record to `$GWAS_METRICS_DIR/{job}.jsonl` ({job}: SLURM array job and task, job
+ID, or "local"), with:
+  - wall and CPU time (of the process and its reaped children, e.g. pool workers),
+  - peak RSS of the process and of its children so far (high-water marks),
+  - bytes read and written by the process (/proc/self/io, Linux),
+  - rows processed, status ("ok" or the exception type) and extra fields given by the script.
+Without $GWAS_METRICS_DIR, stages cost two clock reads and nothing is written. Stages run in
+pool workers (decorated worker functions) are recorded by the workers.
+
+`summarize` aggregates the records of a directory (optionally of one array job) per stage:
+total and median wall time, CPU use, peak RSS, I/O, rows per second, and the slowest tasks.
+
+Usage:
+    export GWAS_METRICS_DIR=$NB/metrics
+    sbatch --array=1-600 regenie_step_2.slurm
+    gwas_metrics.py summarize --dir $NB/metrics --job 123456 --output metrics_summary.tsv
+"""
+import argparse
+import datetime
+import functools
+import glob
+import json
+import logging
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_DIR_ENV = "GWAS_METRICS_DIR"
+
+_local = threading.local()
+_write_lock = threading.Lock()
+
+
+def metrics_dir():
+    return os.environ.get(METRICS_DIR_ENV) or None
+
+
+def job_info():
+    """SLURM identifiers of the current process (empty outside SLURM)."""
+    return {
+        "job_id": os.environ.get("SLURM_JOB_ID", ""),
+        "array_job_id": os.environ.get("SLURM_ARRAY_JOB_ID", ""),
+        "array_task_id": os.environ.get("SLURM_ARRAY_TASK_ID", ""),
+    }
+
+
+def job_key(info=None):
+    info = job_info() if info is None else info
+    if info["array_job_id"]:
+        return f"{info['array_job_id']}_{info['array_task_id']}"
+    return info["job_id"] or "local"
+
+
+def _io_counters():
+    """(bytes read, bytes written) by this process, from /proc/self/io (None if unavailable)."""
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return own / 1024, children / 1024
+
+
+class Stage:
+    """Counters of one running stage (see `stage`)."""
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.rows = 0
+
+    def add_rows(self, n):
+        self.rows += int(n)
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def add_rows(n):
+    """Add `n` processed rows to the innermost running stage of this thread (no-op outside stages)."""
+    stack = _stack()
+    if stack:
+        stack[-1].add_rows(n)
+
+
+def _write(record, directory):
+    os.makedirs(directory, exist_ok=True)
+    line = json.dumps(record) + "\n"
+    with _write_lock, open(os.path.join(directory, f"{job_key()}.jsonl"), "a") as f:
+        f.write(line)
+
+
+@contextmanager
+def stage(name, **fields):
+    """Record the wall/CPU time, memory, I/O and rows of the enclosed block as stage `name`."""
+    st = Stage(name, fields)
+    directory = metrics_dir()
+    stack = _stack()
+    stack.append(st)
+    if directory is None:
+        try:
+            yield st
+        finally:
+            stack.pop()
+        return
+
+    start = datetime.datetime.now()
+    wall0, cpu0, io0 = time.perf_counter(), _cpu_seconds(), _io_counters()
+    status = "ok"
+    try:
+        yield st
+    except BaseException as e:
+        status = type(e).__name__
+        raise
+    finally:
+        stack.pop()
+        wall = time.perf_counter() - wall0
+        io1 = _io_counters()
+        rss, children_rss = _peak_rss_mb()
+        record = {
+            "stage": name,
+            "script": os.path.basename(sys.argv[0]),
+            **job_info(),
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "start": start.isoformat(timespec="seconds"),
+            "wall_s": round(wall, 4),
+            "cpu_s": round(_cpu_seconds() - cpu0, 4),
+            "peak_rss_mb": round(rss, 1),
+            "children_peak_rss_mb": round(children_rss, 1),
+            "read_bytes": io1[0] - io0[0] if io0 and io1 else None,
+            "write_bytes": io1[1] - io0[1] if io0 and io1 else None,
+            "rows": st.rows,
+            "status": status,
+            **st.fields,
+        }
+        try:
+            _write(record, directory)
+        except OSError as e:
+            logging.warning(f"Could not write metrics of {name}: {e}")
+
+
+def instrumented(name=None):
+    """Decorator running the function as a stage (named after the function by default)."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name or fn.__name__):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def read_records(directory, job=None):
+    """All records of `directory` (of array job / job ID `job` if given), as a DataFrame."""
+    import pandas as pd
+
+    records = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.jsonl"))):
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # Truncated last line of a killed task
+                    continue
+    df = pd.DataFrame(records)
+    if job is not None and not df.empty:
+        df = df[(df["array_job_id"].astype(str) == str(job)) | (df["job_id"].astype(str) == str(job))]
+    return df
+
+
+def summarize(df, top=5):
+    """Per-stage totals, sorted by total wall time, and the `top` slowest records of every stage."""
+    import pandas as pd
+
+    df = df.assign(task=[job_key(r) for r in df[["job_id", "array_job_id", "array_task_id"]].astype(str).to_dict("records")])
+    grouped = df.groupby("stage")
+    summary = pd.DataFrame({
+        "n_records": grouped.size(),
+        "n_tasks": grouped["task"].nunique(),
+        "n_failed": grouped["status"].apply(lambda s: int((s != "ok").sum())),
+        "wall_s_total": grouped["wall_s"].sum(),
+        "wall_s_median": grouped["wall_s"].median(),
+        "wall_s_max": grouped["wall_s"].max(),
+        "cpu_s_total": grouped["cpu_s"].sum(),
+        "peak_rss_mb_max": grouped[["peak_rss_mb", "children_peak_rss_mb"]].max().max(axis=1),
+        "read_gb": grouped["read_bytes"].sum() / 1024**3,
+        "write_gb": grouped["write_bytes"].sum() / 1024**3,
+        "rows": grouped["rows"].sum(),
+    })
+    summary["cpu_per_wall"] = summary["cpu_s_total"] / summary["wall_s_total"]
+    summary["rows_per_s"] = summary["rows"] / summary["wall_s_total"]
+    summary = summary.sort_values("wall_s_total", ascending=False).round(3).reset_index()
+
+    slowest = df.sort_values("wall_s", ascending=False).groupby("stage", sort=False).head(top)
+    return summary, slowest[["stage", "task", "host", "wall_s", "cpu_s", "peak_rss_mb", "rows", "status"]]
+
+
+def main():
+    import pandas as pd
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+    parser = argparse.ArgumentParser(description="Summarize the stage metrics of pipeline runs.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("summarize", help="Per-stage hot spots of the records in a directory.")
+    p.add_argument("--dir", default=metrics_dir())
+    p.add_argument("--job", default=None, help="Only the records of this (array) job ID.")
+    p.add_argument("--top", default=5, type=int, help="Slowest records listed per stage.")
+    p.add_argument("--output", default=None, help="Per-stage summary (TSV).")
+    args = parser.parse_args()
+
+    if args.dir is None:
+        parser.error(f"--dir is required (or set ${METRICS_DIR_ENV})")
+    df = read_records(args.dir, args.job)
+    if df.empty:
+        sys.exit(f"No metrics in {args.dir}" + (f" for job {args.job}" if args.job else ""))
+
+    summary, slowest = summarize(df, args.top)
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(summary.to_string(index=False))
+        print(f"\nSlowest records per stage (top {args.top}):")
+        print(slowest.to_string(index=False))
+    if args.output:
+        summary.to_csv(args.output, sep="\t", index=False)
+        logging.info(f"Summary of {len(summary)} stages → {args.output}")
+
+
+if __name__ == "__main__":
+    main()
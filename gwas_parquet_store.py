@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Partitioned Parquet store for merged regenie step-2 results.
+
+Layout (hive partitioning): `{store}/age={age}/embedding={embedding}/CHROM={chrom}/{embedding}_{age}-{i}.parquet`,
+with rows sorted by GENPOS and row-group statistics, so that queries by region, SNP list
+or LOG10P threshold only read the needed columns and row groups. Chromosomes are kept as
+names (1-22, X, XY, MT, ...), not numbers.
+
+Usage:
+    gwas_parquet_store.py --indir $NB/merged_retry --store $NB/gwas_parquet --all --workers 16
+"""
+import argparse
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.dataset as ds
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+
+AGES = [20, 30, 40, 50, 60]
+EMBEDDING_SIZE = 120
+ROW_GROUP_SIZE = 100_000
+
+COLUMN_TYPES = {
+    "CHROM": pa.string(),
+    "GENPOS": pa.int32(),
+    "ID": pa.string(),
+    "ALLELE0": pa.string(),
+    "ALLELE1": pa.string(),
+    "A1FREQ": pa.float32(),
+    "INFO": pa.float32(),
+    "N": pa.int32(),
+    "BETA": pa.float32(),
+    "SE": pa.float32(),
+    "LOG10P": pa.float32(),
+}
+
+PARTITIONING = ds.partitioning(
+    pa.schema([("age", pa.int16()), ("embedding", pa.string()), ("CHROM", pa.string())]),
+    flavor="hive",
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Convert merged regenie outputs into a partitioned Parquet store.")
+    parser.add_argument("--indir", default=os.path.expandvars("$NB/merged_retry"))
+    parser.add_argument("--store", default=os.path.expandvars("$NB/gwas_parquet"))
+    parser.add_argument("--embeddings", nargs="+", type=int, default=None)
+    parser.add_argument("--ages", nargs="+", type=int, default=None)
+    parser.add_argument("--all", action="store_true", help="Convert every (embedding, age) pair.")
+    parser.add_argument("--row_group_size", default=ROW_GROUP_SIZE, type=int)
+    parser.add_argument("--workers", default=os.cpu_count(), type=int)
+    return parser.parse_args()
+
+
+def read_regenie(infile, columns=None):
+    """Read a (merged) regenie file as an Arrow table with compact dtypes."""
+    columns = list(COLUMN_TYPES) if columns is None else columns
+    with open(infile) as f:
+        header = f.readline().split()
+    columns = [c for c in columns if c in header]
+
+    return pv.read_csv(
+        infile,
+        parse_options=pv.ParseOptions(delimiter=" ", invalid_row_handler=lambda row: "skip"),
+        convert_options=pv.ConvertOptions(
+            include_columns=columns,
+            column_types={c: t for c, t in COLUMN_TYPES.items() if c in columns},
+            null_values=["NA", "nan", ""],
+        ),
+    )
+
+
+def convert_regenie_to_parquet(infile, store, embedding, age, row_group_size=ROW_GROUP_SIZE):
+    """Write one merged regenie file into the store, sorted by chromosome and position."""
+    table = read_regenie(infile)
+    table = table.sort_by([("CHROM", "ascending"), ("GENPOS", "ascending")])
+    table = table.append_column("age", pa.array([age] * table.num_rows, pa.int16()))
+    table = table.append_column("embedding", pa.array([embedding] * table.num_rows, pa.string()))
+
+    ds.write_dataset(
+        table,
+        store,
+        format="parquet",
+        partitioning=PARTITIONING,
+        basename_template=f"{embedding}_{age}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        min_rows_per_group=row_group_size,
+        max_rows_per_group=row_group_size,
+        max_rows_per_file=0,
+    )
+    return table.num_rows
+
+
+def open_store(store):
+    return ds.dataset(store, format="parquet", partitioning=PARTITIONING)
+
+
+def _partition_filter(ages=None, embeddings=None):
+    expr = None
+    if ages is not None:
+        expr = ds.field("age").isin(list(ages))
+    if embeddings is not None:
+        emb = ds.field("embedding").isin([e if isinstance(e, str) else f"embedding_{e:03d}" for e in embeddings])
+        expr = emb if expr is None else expr & emb
+    return expr
+
+
+def query(store, filter=None, columns=None, ages=None, embeddings=None):
+    """Read rows matching `filter` (a pyarrow expression), restricted to the given ages/embeddings."""
+    partition_expr = _partition_filter(ages, embeddings)
+    if partition_expr is not None:
+        filter = partition_expr if filter is None else filter & partition_expr
+    return open_store(store).to_table(columns=columns, filter=filter).to_pandas()
+
+
+def query_region(store, chrom, start, end, columns=None, ages=None, embeddings=None):
+    """Variants in chrom:start-end (inclusive)."""
+    expr = (ds.field("CHROM") == str(chrom)) & (ds.field("GENPOS") >= start) & (ds.field("GENPOS") <= end)
+    return query(store, expr, columns, ages, embeddings)
+
+
+def query_snps(store, snp_list, columns=None, ages=None, embeddings=None):
+    """Variants whose ID is in `snp_list`."""
+    return query(store, ds.field("ID").isin(list(snp_list)), columns, ages, embeddings)
+
+
+def query_threshold(store, min_log10p=7.3, columns=None, ages=None, embeddings=None):
+    """Variants with LOG10P above `min_log10p`."""
+    return query(store, ds.field("LOG10P") > min_log10p, columns, ages, embeddings)
+
+
+def main():
+    args = parse_args()
+
+    embeddings = range(EMBEDDING_SIZE) if args.all or args.embeddings is None else args.embeddings
+    ages = AGES if args.all or args.ages is None else args.ages
+
+    jobs = []
+    for age in ages:
+        for e in embeddings:
+            infile = os.path.join(args.indir, f"embedding_{e:03d}_{age}.regenie")
+            if os.path.exists(infile):
+                jobs.append((infile, f"embedding_{e:03d}", age))
+            else:
+                logging.warning(f"Missing input: {infile}")
+
+    os.makedirs(args.store, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {
+            pool.submit(convert_regenie_to_parquet, infile, args.store, emb, age, args.row_group_size): infile
+            for infile, emb, age in jobs
+        }
+        for future in as_completed(futures):
+            logging.info(f"Converted {futures[future]} ({future.result()} variants)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+"""
+Dependency-driven runner for the regenie workflow described in the README.
+
+Stages and their units (each unit runs the existing script of the stage):
+  l0_split   (age, half)         regenie --split-l0             regenie_step_1_l0.slurm
+  l0_run     (age, half, job)    regenie --run-l0, one l0 job   regenie_step_1_l0.slurm
+  linkify    (age,)              per-phenotype l0 tree          regenie_linkify.py
+  l1         (age, embedding)    regenie --run-l1               regenie_step_1_l1.slurm
+  pred_list  ()                  --pred list for step 2         gwas_pipeline.py write-pred-list
+  step2      (region,)           regenie step 2 on one region   regenie_step_2.slurm
+  gather     ()                  one merged file per phenotype  regenie_gather_output.py
+
+A unit is done when all its output files exist. `run` plans the missing units of every stage
+and submits only those. With the SLURM executor, each stage becomes a packed job array (array
+index -> unit, through a JSON manifest) that depends on its upstream stages (afterany), so the
+whole graph is queued at once. A unit whose inputs are missing when it starts exits without
+running; gather has no file inputs and merges whatever step 2 produced, listing the missing
+regions of each phenotype in `{pheno}.failed_regions.txt`. After each round the outputs are
+checked again and missing units are resubmitted, up to --max_rounds (the step-2 regions that
+keep gather from completing are logged). The local executor runs the same units in a process
+pool, stage by stage.
+
+Usage:
+    gwas_pipeline.py status
+    gwas_pipeline.py run --executor slurm --max_rounds 3
+    gwas_pipeline.py run --executor local --workers 8 --stages l1 pred_list
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import shlex
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+
+AGES = [20, 30, 40, 50, 60]
+EMBEDDING_SIZE = 120
+HALF_SIZE = 60
+N_L0_JOBS = 1000
+
+STAGES = ["l0_split", "l0_run", "linkify", "l1", "pred_list", "step2", "gather"]
+UPSTREAM = {
+    "l0_split": [],
+    "l0_run": ["l0_split"],
+    "linkify": ["l0_run"],
+    "l1": ["linkify"],
+    "pred_list": ["l1"],
+    "step2": ["pred_list"],
+    "gather": ["step2"],
+}
+# Script whose #SBATCH header gives the resources of each stage
+STAGE_SCRIPTS = {
+    "l0_split": "regenie_step_1_l0.slurm",
+    "l0_run": "regenie_step_1_l0.slurm",
+    "l1": "regenie_step_1_l1.slurm",
+    "step2": "regenie_step_2.slurm",
+    "gather": "regenie_gather_output.slurm",
+}
+DEFAULT_RESOURCES = {"time": "1:00:00", "mem": "4G", "cpus": 1}
+
+# Exit codes of `run-task`
+EXIT_MISSING_INPUTS = 3
+EXIT_MISSING_OUTPUTS = 4
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the missing parts of the regenie workflow.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for name in ("status", "run"):
+        sub = subparsers.add_parser(name)
+        sub.add_argument("--workdir", default=os.path.expandvars("$HOME/Delphi/gwas"), help="Directory the stage scripts run in.")
+        sub.add_argument("--nobackup", default=os.path.expandvars("$NB"))
+        sub.add_argument("--regions_file", default=None, help="Default: {workdir}/data/regions_2mb_hg19.bed")
+        sub.add_argument("--pred_list", default=None, help="Default: {nobackup}/loco/all_pred_with_age.list")
+        sub.add_argument("--ages", nargs="+", type=int, default=AGES)
+        sub.add_argument("--embeddings", nargs="+", type=int, default=list(range(EMBEDDING_SIZE)))
+        sub.add_argument("--n_l0_jobs", default=N_L0_JOBS, type=int)
+        sub.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+
+    run = subparsers.choices["run"]
+    run.add_argument("--executor", default="slurm", choices=["slurm", "local"])
+    run.add_argument("--max_rounds", default=3, type=int, help="Rounds of (re)submission of the missing units.")
+    run.add_argument("--workers", default=os.cpu_count(), type=int, help="Local executor: units run in parallel.")
+    run.add_argument("--state_dir", default=None, help="Manifests and logs. Default: {workdir}/.pipeline")
+    run.add_argument("--max_array_size", default=1000, type=int)
+    run.add_argument("--array_throttle", default=None, type=int, help="Maximum simultaneously running tasks per array.")
+    run.add_argument("--poll_interval", default=60, type=int, help="Seconds between SLURM queue checks.")
+
+    task = subparsers.add_parser("run-task", help="Run one unit of a manifest (used inside job arrays).")
+    task.add_argument("--manifest", required=True)
+    task.add_argument("--index", required=True, type=int)
+    task.add_argument("--offset", default=0, type=int)
+
+    pred = subparsers.add_parser("write-pred-list", help="Write the step-2 --pred list from the level-1 outputs.")
+    pred.add_argument("--workdir", required=True)
+    pred.add_argument("--ages", nargs="+", type=int, required=True)
+    pred.add_argument("--embeddings", nargs="+", type=int, required=True)
+    pred.add_argument("--out", required=True)
+
+    return parser.parse_args()
+
+
+class Unit:
+    """One schedulable piece of work: a command with its input and output files."""
+
+    def __init__(self, stage, key, command, outputs, inputs=(), env=None, cwd=None, absent=()):
+        self.stage = stage
+        self.key = tuple(key)
+        self.command = [str(c) for c in command]
+        self.outputs = list(outputs)
+        self.inputs = list(inputs)
+        self.env = {k: str(v) for k, v in (env or {}).items()}
+        self.cwd = cwd
+        # Files whose presence means the unit has to be run again (e.g. a list of failed regions)
+        self.absent = list(absent)
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in ("stage", "key", "command", "outputs", "inputs", "env", "cwd", "absent")}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**d)
+
+    def __repr__(self):
+        return f"Unit({self.stage}, {self.key})"
+
+
+class FileCache:
+    """`exists` backed by one directory listing per directory, for checking many outputs at once."""
+
+    def __init__(self):
+        self._listings = {}
+
+    def exists(self, path):
+        directory, name = os.path.split(os.path.abspath(path))
+        if directory not in self._listings:
+            try:
+                self._listings[directory] = set(os.listdir(directory))
+            except (FileNotFoundError, NotADirectoryError):
+                self._listings[directory] = set()
+        return name in self._listings[directory]
+
+    def done(self, unit):
+        return all(self.exists(p) for p in unit.outputs) and not any(self.exists(p) for p in unit.absent)
+
+
+def slurm_resources(script):
+    """time / mem / cpus from the #SBATCH header of `script`."""
+    resources = dict(DEFAULT_RESOURCES)
+    if script is None or not os.path.exists(script):
+        return resources
+    patterns = {"time": r"(?:--time=|-t\s+)(\S+)", "mem": r"--mem=(\S+)", "cpus": r"(?:--cpus-per-task=|-c\s+)(\d+)"}
+    with open(script) as f:
+        for line in f:
+            if not line.startswith("#SBATCH"):
+                continue
+            for name, pattern in patterns.items():
+                match = re.search(pattern, line)
+                if match:
+                    resources[name] = match.group(1)
+    resources["cpus"] = int(resources["cpus"])
+    return resources
+
+
+# ——— Paths of the workflow (as used by the stage scripts) ———
+
+def half_of(embedding):
+    return "head" if embedding < HALF_SIZE else "tail"
+
+
+def y_index(embedding):
+    """Index of the phenotype in the level-0 outputs of its half (regenie starts at Y1)."""
+    return embedding + 1 if embedding < HALF_SIZE else embedding - HALF_SIZE + 1
+
+
+def pheno_name(embedding):
+    return f"embedding_{embedding:03d}"
+
+
+def step2_pheno_name(embedding, age):
+    return f"embedding_{embedding:03d}_{age}"
+
+
+def l0_dir(cfg, age, half):
+    return os.path.join(cfg.workdir, f"split_jobs_age{age}_emb{EMBEDDING_SIZE}_stage1_l0_{half}")
+
+
+def linked_dir(cfg, age, embedding):
+    return os.path.join(cfg.workdir, "split_jobs_stage1_l0", f"age{age}", pheno_name(embedding))
+
+
+def loco_file(workdir, age, embedding):
+    return os.path.join(workdir, "loco", f"emb{EMBEDDING_SIZE}_{age}_{pheno_name(embedding)}_1.loco")
+
+
+def read_regions(regions_file):
+    with open(regions_file) as f:
+        return [tuple(line.split()[:3]) for line in f if line.strip()]
+
+
+# ——— Units of each stage ———
+
+def build_units(stage, cfg, files):
+    """Units of `stage` for the configured ages and embeddings (done or not)."""
+    halves = sorted({half_of(e) for e in cfg.embeddings})
+    script = lambda name: ["bash", os.path.join(cfg.workdir, name)]
+
+    if stage == "l0_split":
+        return [
+            Unit(stage, (age, half), script("regenie_step_1_l0.slurm"),
+                 outputs=[os.path.join(l0_dir(cfg, age, half), "split.master")],
+                 env={"AGE": age, "WHICH_HALF": half}, cwd=cfg.workdir)
+            for age in cfg.ages for half in halves
+        ]
+
+    if stage == "l0_run":
+        units = []
+        for age in cfg.ages:
+            for half in halves:
+                ys = [y_index(e) for e in cfg.embeddings if half_of(e) == half]
+                indir = l0_dir(cfg, age, half)
+                for job in range(1, cfg.n_l0_jobs + 1):
+                    units.append(Unit(
+                        stage, (age, half, job), script("regenie_step_1_l0.slurm"),
+                        outputs=[os.path.join(indir, f"split_job{job}_l0_Y{y}") for y in ys],
+                        inputs=[os.path.join(indir, "split.master")],
+                        env={"AGE": age, "WHICH_HALF": half, "SLURM_ARRAY_TASK_ID": job}, cwd=cfg.workdir))
+        return units
+
+    if stage == "linkify":
+        jobs = range(1, cfg.n_l0_jobs + 1)
+        units = []
+        for age in cfg.ages:
+            command = [sys.executable, os.path.join(cfg.workdir, "regenie_linkify.py"), "--workdir", cfg.workdir,
+                       "--ages", age, "--embeddings", *cfg.embeddings]
+            outputs, inputs = [], []
+            for e in cfg.embeddings:
+                outputs += [os.path.join(linked_dir(cfg, age, e), f"split_job{j}_l0_Y1") for j in jobs]
+                outputs.append(os.path.join(linked_dir(cfg, age, e), "split.master"))
+                inputs += [os.path.join(l0_dir(cfg, age, half_of(e)), f"split_job{j}_l0_Y{y_index(e)}") for j in jobs]
+            inputs += [os.path.join(l0_dir(cfg, age, half), "split.master") for half in halves]
+            units.append(Unit(stage, (age,), command, outputs=outputs, inputs=inputs, cwd=cfg.workdir))
+        return units
+
+    if stage == "l1":
+        return [
+            Unit(stage, (age, e), script("regenie_step_1_l1.slurm"),
+                 outputs=[loco_file(cfg.workdir, age, e)],
+                 inputs=[os.path.join(linked_dir(cfg, age, e), "split.master")],
+                 env={"AGE": age, "SLURM_ARRAY_TASK_ID": e}, cwd=cfg.workdir)
+            for age in cfg.ages for e in cfg.embeddings
+        ]
+
+    if stage == "pred_list":
+        command = [sys.executable, os.path.abspath(__file__), "write-pred-list", "--workdir", cfg.workdir, "--out", cfg.pred_list,
+                   "--ages", *cfg.ages, "--embeddings", *cfg.embeddings]
+        return [Unit(stage, (), command, outputs=[cfg.pred_list],
+                     inputs=[loco_file(cfg.workdir, age, e) for age in cfg.ages for e in cfg.embeddings], cwd=cfg.workdir)]
+
+    step2_dir = os.path.join(cfg.nobackup, f"emb{EMBEDDING_SIZE}_regenie2")
+    phenos = [step2_pheno_name(e, age) for age in cfg.ages for e in cfg.embeddings]
+    regions = read_regions(cfg.regions_file)
+
+    if stage == "step2":
+        units = []
+        for i, (chrom, start, end) in enumerate(regions, start=1):
+            prefix = os.path.join(step2_dir, f"emb{EMBEDDING_SIZE}_chr{chrom}_{start}-{end}")
+            units.append(Unit(stage, (i,), script("regenie_step_2.slurm"),
+                              outputs=[f"{prefix}_{pheno}.regenie" for pheno in phenos],
+                              inputs=[cfg.pred_list], env={"SLURM_ARRAY_TASK_ID": i, "REGIONS_FILE": cfg.regions_file},
+                              cwd=cfg.workdir))
+        return units
+
+    if stage == "gather":
+        # Only the phenotypes not merged yet (or merged with missing regions)
+        outdir = os.path.join(cfg.nobackup, "merged_retry")
+        todo = [p for p in phenos if not files.exists(os.path.join(outdir, f"{p}.regenie"))
+                or files.exists(os.path.join(outdir, f"{p}.failed_regions.txt"))]
+        if not todo:
+            todo = phenos
+        cpus = slurm_resources(os.path.join(cfg.workdir, STAGE_SCRIPTS["gather"]))["cpus"]
+        command = [sys.executable, os.path.join(cfg.workdir, "regenie_gather_output.py"),
+                   "--regions_file", cfg.regions_file, "--indir", step2_dir, "--outdir", outdir,
+                   "--prefix", f"emb{EMBEDDING_SIZE}", "--workers", cpus, "--phenotypes", *todo]
+        # No file inputs: gather is ready once the step-2 units have run (afterany dependency, or
+        # stage order locally), whether or not they all succeeded. Regions still missing then are
+        # listed in {pheno}.failed_regions.txt, and the unit is run again after step 2 is retried.
+        return [Unit(stage, (), command,
+                     outputs=[os.path.join(outdir, f"{p}.regenie") for p in todo],
+                     absent=[os.path.join(outdir, f"{p}.failed_regions.txt") for p in todo],
+                     cwd=cfg.workdir)]
+
+    raise ValueError(f"Unknown stage: {stage}")
+
+
+def plan(cfg):
+    """{stage: missing units} for the selected stages, in workflow order."""
+    files = FileCache()
+    missing = {}
+    for stage in STAGES:
+        if stage in cfg.stages:
+            missing[stage] = [u for u in build_units(stage, cfg, files) if not files.done(u)]
+    return missing
+
+
+def blocking_regions(cfg, missing):
+    """`chrom:start-end` of the missing step-2 units, which keep gather from completing."""
+    regions = read_regions(cfg.regions_file)
+    return [f"{chrom}:{start}-{end}" for chrom, start, end in (regions[u.key[0] - 1] for u in missing.get("step2", []))]
+
+
+def _log_blocking_regions(cfg, missing, level=logging.INFO):
+    if missing.get("gather") and missing.get("step2"):
+        regions = blocking_regions(cfg, missing)
+        shown = ", ".join(regions[:20]) + (f", ... ({len(regions) - 20} more)" if len(regions) > 20 else "")
+        logging.log(level, f"gather: {len(regions)} step-2 regions without all outputs: {shown}")
+
+
+def run_unit(unit):
+    """Run one unit. Returns 0 on success, or the exit code of the failed step."""
+    if not all(os.path.exists(p) for p in unit.inputs):
+        logging.warning(f"{unit}: inputs missing, not running")
+        return EXIT_MISSING_INPUTS
+
+    env = dict(os.environ)
+    # The stage scripts tell array tasks from plain runs by SLURM_ARRAY_TASK_ID
+    env.pop("SLURM_ARRAY_TASK_ID", None)
+    env.update(unit.env)
+    logging.info(f"{unit}: {shlex.join(unit.command)}")
+    returncode = subprocess.run(unit.command, cwd=unit.cwd, env=env).returncode
+    if returncode != 0:
+        return returncode
+
+    if not all(os.path.exists(p) for p in unit.outputs) or any(os.path.exists(p) for p in unit.absent):
+        logging.error(f"{unit}: command succeeded but outputs are missing")
+        return EXIT_MISSING_OUTPUTS
+    return 0
+
+
+def write_manifest(path, units):
+    with open(path, "w") as f:
+        json.dump([u.to_dict() for u in units], f)
+
+
+def read_manifest(path):
+    with open(path) as f:
+        return [Unit.from_dict(d) for d in json.load(f)]
+
+
+class LocalExecutor:
+    """Runs the stages in order, the units of each stage in a process pool."""
+
+    def __init__(self, workers=None):
+        self.workers = workers
+
+    def run_round(self, missing, state_dir, round_no):
+        for stage, units in missing.items():
+            if not units:
+                continue
+            logging.info(f"Round {round_no}, {stage}: running {len(units)} units")
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                codes = list(pool.map(run_unit, units))
+            n_failed = sum(c != 0 for c in codes)
+            if n_failed:
+                logging.warning(f"Round {round_no}, {stage}: {n_failed} of {len(units)} units failed")
+
+
+class SlurmExecutor:
+    """
+    Submits every stage with missing units as packed job arrays (split at `max_array_size`),
+    chained with afterany dependencies, then waits until they have all left the queue.
+    """
+
+    def __init__(self, max_array_size=1000, throttle=None, poll_interval=60):
+        self.max_array_size = max_array_size
+        self.throttle = throttle
+        self.poll_interval = poll_interval
+
+    def _sbatch(self, stage, manifest, offset, n, resources, dependencies, log_dir):
+        array = f"0-{n - 1}" + (f"%{self.throttle}" if self.throttle else "")
+        wrap = (f"{shlex.quote(sys.executable)} {shlex.quote(os.path.abspath(__file__))} run-task "
+                f"--manifest {shlex.quote(manifest)} --offset {offset} --index $SLURM_ARRAY_TASK_ID")
+        command = [
+            "sbatch", "--parsable", f"--job-name=gwas_{stage}", f"--array={array}",
+            f"--time={resources['time']}", f"--mem={resources['mem']}", f"--cpus-per-task={resources['cpus']}",
+            f"--output={log_dir}/{stage}_%A_%a.out",
+        ]
+        if dependencies:
+            command.append("--dependency=afterany:" + ":".join(dependencies))
+        command += ["--wrap", wrap]
+        out = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        return out.strip().split(";")[0]
+
+    def _wait(self, job_ids):
+        while job_ids:
+            result = subprocess.run(["squeue", "-h", "-o", "%A", "-j", ",".join(job_ids)], capture_output=True, text=True)
+            queued = set(result.stdout.split()) if result.returncode == 0 else set()
+            job_ids = [j for j in job_ids if j in queued]
+            if job_ids:
+                time.sleep(self.poll_interval)
+
+    def run_round(self, missing, state_dir, round_no):
+        log_dir = os.path.join(state_dir, "logs")
+        os.makedirs(log_dir, exist_ok=True)
+
+        stage_jobs = {}
+        for stage, units in missing.items():
+            if not units:
+                continue
+            manifest = os.path.join(state_dir, f"round{round_no}_{stage}.json")
+            write_manifest(manifest, units)
+            workdir = units[0].cwd or "."
+            resources = slurm_resources(os.path.join(workdir, STAGE_SCRIPTS[stage])) if stage in STAGE_SCRIPTS else dict(DEFAULT_RESOURCES)
+            dependencies = [j for up in UPSTREAM[stage] for j in stage_jobs.get(up, [])]
+
+            stage_jobs[stage] = [
+                self._sbatch(stage, manifest, offset, min(self.max_array_size, len(units) - offset), resources, dependencies, log_dir)
+                for offset in range(0, len(units), self.max_array_size)
+            ]
+            logging.info(f"Round {round_no}, {stage}: {len(units)} units submitted as job(s) {', '.join(stage_jobs[stage])}")
+
+        self._wait([j for jobs in stage_jobs.values() for j in jobs])
+
+
+def run_pipeline(cfg, executor, state_dir, max_rounds=3):
+    """Plan and run the missing units until none are left (or `max_rounds` is reached)."""
+    os.makedirs(state_dir, exist_ok=True)
+    for round_no in range(1, max_rounds + 1):
+        missing = plan(cfg)
+        n_missing = sum(len(u) for u in missing.values())
+        if n_missing == 0:
+            logging.info("All outputs present")
+            return True
+        logging.info(f"Round {round_no}: " + ", ".join(f"{s}={len(u)}" for s, u in missing.items() if u))
+        if round_no > 1:
+            _log_blocking_regions(cfg, missing)
+        executor.run_round(missing, state_dir, round_no)
+
+    missing = plan(cfg)
+    for stage, units in missing.items():
+        if units:
+            logging.error(f"{stage}: {len(units)} units still missing after {max_rounds} rounds, e.g. {units[0].key}")
+    _log_blocking_regions(cfg, missing, logging.ERROR)
+    return not any(missing.values())
+
+
+def write_pred_list(workdir, ages, embeddings, out):
+    """--pred list of step 2: one `{phenotype} {loco file}` line per (embedding, age)."""
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(f"{out}.tmp", "w") as f:
+        for age in ages:
+            for e in embeddings:
+                f.write(f"{step2_pheno_name(e, age)} {os.path.abspath(loco_file(workdir, age, e))}\n")
+    os.replace(f"{out}.tmp", out)
+
+
+def _complete_config(cfg):
+    cfg.workdir = os.path.abspath(cfg.workdir)
+    cfg.nobackup = os.path.abspath(cfg.nobackup)
+    if cfg.regions_file is None:
+        cfg.regions_file = os.path.join(cfg.workdir, "data", "regions_2mb_hg19.bed")
+    if cfg.pred_list is None:
+        cfg.pred_list = os.path.join(cfg.nobackup, "loco", "all_pred_with_age.list")
+    cfg.pred_list = os.path.abspath(cfg.pred_list)
+    return cfg
+
+
+def main():
+    args = parse_args()
+
+    if args.command == "run-task":
+        unit = read_manifest(args.manifest)[args.offset + args.index]
+        sys.exit(run_unit(unit))
+
+    if args.command == "write-pred-list":
+        write_pred_list(args.workdir, args.ages, args.embeddings, args.out)
+        return
+
+    cfg = _complete_config(args)
+    if args.command == "status":
+        files = FileCache()
+        for stage in STAGES:
+            if stage in cfg.stages:
+                units = build_units(stage, cfg, files)
+                n_missing = sum(not files.done(u) for u in units)
+                print(f"{stage:10s} {len(units) - n_missing:7d} done {n_missing:7d} missing")
+        return
+
+    if args.executor == "local":
+        executor = LocalExecutor(args.workers)
+    else:
+        executor = SlurmExecutor(args.max_array_size, args.array_throttle, args.poll_interval)
+    state_dir = args.state_dir or os.path.join(cfg.workdir, ".pipeline")
+    if not run_pipeline(cfg, executor, state_dir, args.max_rounds):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+QC statistics of the merged regenie results, one row per (embedding, age).
+
+Each `embedding_{dim}_{age}.regenie` file is streamed once (only LOG10P, A1FREQ and INFO are
+converted) and the files are processed in parallel. Per phenotype the table holds:
+  - n_variants, n_missing (no LOG10P), n_signif (LOG10P above --threshold), max_log10p,
+  - lambda_gc: median of qchisq(1 - P, 1) / qchisq(0.5, 1), as in plots.R,
+  - p_hist_*: histogram of P in equal-width bins over [0, 1],
+  - maf_* / info_*: variant counts per MAF and INFO bin, and mean_info.
+
+The chi-square statistic is monotone in LOG10P, so its median is taken from the median of
+LOG10P: exactly (all values kept in memory, as float32), or with --lambda_method sketch from
+a fixed-width histogram of LOG10P, whose bin width bounds the error of the median LOG10P.
+
+Usage:
+    gwas_qc.py --indir $NB/merged_retry --output qc_table.tsv --workers 16
+"""
+import argparse
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import pyarrow.csv as pv
+from scipy import stats
+
+from gwas_metrics import add_rows, instrumented, stage
+from gwas_parquet_store import COLUMN_TYPES
+from regenie_signif_snps import list_result_files
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+
+QC_COLUMNS = ["LOG10P", "A1FREQ", "INFO"]
+
+P_HIST_BINS = 20
+MAF_BINS = [0, 0.001, 0.01, 0.05, 0.1, 0.2, 0.5]
+INFO_BINS = [0, 0.3, 0.5, 0.8, 0.9, 1.0]
+
+# Quantile sketch: LOG10P histogram over [0, SKETCH_MAX] (larger values go to the last bin)
+SKETCH_BIN_WIDTH = 1e-4
+SKETCH_MAX = 10.0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="QC statistics (lambda GC, hit counts, histograms) of merged regenie results.")
+    parser.add_argument("--indir", default=os.path.expandvars("$NB/merged_retry"))
+    parser.add_argument("--output", default="qc_table.tsv")
+    parser.add_argument("--threshold", default=7.3, type=float, help="LOG10P threshold for n_signif.")
+    parser.add_argument("--lambda_method", default="exact", choices=["exact", "sketch"])
+    parser.add_argument("--block_size", default=64 * 1024**2, type=int, help="Bytes parsed per batch.")
+    parser.add_argument("--workers", default=os.cpu_count(), type=int)
+    return parser.parse_args()
+
+
+def _bin_labels(prefix, edges):
+    return [f"{prefix}_{lo:g}_{hi:g}" for lo, hi in zip(edges[:-1], edges[1:])]
+
+
+def _iter_batches(path, block_size):
+    with open(path) as f:
+        header = f.readline().split()
+    columns = [c for c in QC_COLUMNS if c in header]
+    reader = pv.open_csv(
+        path,
+        read_options=pv.ReadOptions(block_size=block_size),
+        parse_options=pv.ParseOptions(delimiter=" ", invalid_row_handler=lambda row: "skip"),
+        convert_options=pv.ConvertOptions(
+            include_columns=columns,
+            column_types={c: COLUMN_TYPES[c] for c in columns},
+            null_values=["NA", "nan", ""],
+        ),
+    )
+    for batch in reader:
+        yield {c: batch.column(c).to_numpy(zero_copy_only=False) for c in columns}
+
+
+def lambda_from_log10p(log10p_median):
+    """lambda GC for a median LOG10P (or an array of middle values, averaged on the chi-square scale)."""
+    chisq = stats.chi2.isf(np.power(10.0, -np.atleast_1d(log10p_median).astype(np.float64)), 1)
+    return float(chisq.mean() / stats.chi2.ppf(0.5, 1))
+
+
+def _exact_median_lambda(chunks):
+    values = np.concatenate(chunks) if chunks else np.empty(0, dtype=np.float32)
+    n = len(values)
+    if n == 0:
+        return np.nan
+    k = [(n - 1) // 2, n // 2]
+    middle = np.partition(values, k)[k]
+    return lambda_from_log10p(middle)
+
+
+def _sketch_median_lambda(counts):
+    n = counts.sum()
+    if n == 0:
+        return np.nan
+    cum = np.cumsum(counts)
+    ranks = np.array([(n - 1) // 2, n // 2])
+    bins = np.searchsorted(cum, ranks, side="right")
+    # Midpoint of each bin: error at most half a bin width in LOG10P
+    return lambda_from_log10p((bins + 0.5) * SKETCH_BIN_WIDTH)
+
+
+@instrumented()
+def qc_file(path, threshold=7.3, lambda_method="exact", block_size=64 * 1024**2):
+    """QC statistics of one merged regenie file (dict, one row of the QC table)."""
+    n_sketch_bins = int(round(SKETCH_MAX / SKETCH_BIN_WIDTH)) + 1
+    sketch = np.zeros(n_sketch_bins, dtype=np.int64) if lambda_method == "sketch" else None
+    kept = []
+
+    p_hist = np.zeros(P_HIST_BINS, dtype=np.int64)
+    maf_hist = np.zeros(len(MAF_BINS) - 1, dtype=np.int64)
+    info_hist = np.zeros(len(INFO_BINS) - 1, dtype=np.int64)
+    n_variants = n_missing = n_signif = n_info = 0
+    info_sum = 0.0
+    max_log10p = -np.inf
+
+    for batch in _iter_batches(path, block_size):
+        log10p = batch["LOG10P"]
+        n_variants += len(log10p)
+        add_rows(len(log10p))
+        valid = ~np.isnan(log10p)
+        n_missing += int((~valid).sum())
+        log10p = log10p[valid]
+        if len(log10p) == 0:
+            continue
+
+        n_signif += int((log10p > threshold).sum())
+        max_log10p = max(max_log10p, float(log10p.max()))
+        p_hist += np.histogram(np.power(10.0, -log10p.astype(np.float64)), bins=P_HIST_BINS, range=(0, 1))[0]
+
+        if sketch is not None:
+            bins = np.minimum((log10p / SKETCH_BIN_WIDTH).astype(np.int64), n_sketch_bins - 1)
+            sketch += np.bincount(np.maximum(bins, 0), minlength=n_sketch_bins)
+        else:
+            kept.append(log10p)
+
+        if "A1FREQ" in batch:
+            freq = batch["A1FREQ"][valid]
+            freq = freq[~np.isnan(freq)]
+            maf_hist += np.histogram(np.minimum(freq, 1 - freq), bins=MAF_BINS)[0]
+        if "INFO" in batch:
+            info = batch["INFO"][valid]
+            info = info[~np.isnan(info)]
+            info_hist += np.histogram(np.minimum(info, 1.0), bins=INFO_BINS)[0]
+            info_sum += float(info.sum(dtype=np.float64))
+            n_info += len(info)
+
+    row = {
+        "n_variants": n_variants,
+        "n_missing": n_missing,
+        "n_signif": n_signif,
+        "max_log10p": max_log10p if np.isfinite(max_log10p) else np.nan,
+        "lambda_gc": _sketch_median_lambda(sketch) if sketch is not None else _exact_median_lambda(kept),
+        "mean_info": info_sum / n_info if n_info else np.nan,
+    }
+    row.update(zip([f"p_hist_{i:02d}" for i in range(P_HIST_BINS)], p_hist.tolist()))
+    row.update(zip(_bin_labels("maf", MAF_BINS), maf_hist.tolist()))
+    row.update(zip(_bin_labels("info", INFO_BINS), info_hist.tolist()))
+    return row
+
+
+def main():
+    args = parse_args()
+
+    files = list_result_files(args.indir)
+    logging.info(f"Computing QC statistics of {len(files)} files ({args.lambda_method} lambda GC)")
+
+    rows = []
+    with stage("qc", n_files=len(files)), ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {
+            pool.submit(qc_file, path, args.threshold, args.lambda_method, args.block_size): (path, e, a)
+            for path, e, a in files
+        }
+        for future in as_completed(futures):
+            path, e, a = futures[future]
+            try:
+                rows.append({"embedding": f"embedding_{e:03d}", "age": a, **future.result()})
+            except Exception as exc:
+                logging.error(f"QC failed for {path}: {exc}")
+
+    qc_df = pd.DataFrame(rows)
+    if not qc_df.empty:
+        qc_df = qc_df.sort_values(["age", "embedding"])
+    qc_df.to_csv(args.output, sep="\t", index=False)
+    logging.info(f"QC table ({len(qc_df)} phenotypes) → {args.output}")
+
+
+if __name__ == "__main__":
+    main()
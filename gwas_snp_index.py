@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Persistent SNP-ID index over GWAS Parquet files (SQLite).
+
+The index has three tables:
+  - files:      indexed Parquet files with their mtime,
+  - row_groups: per file and row group, the chromosome and position range (from Parquet statistics),
+  - variants:   variant ID -> (chromosome, position), one row per distinct position of an ID.
+
+A lookup maps the IDs to positions and then to the row groups whose position range contains
+them, so only those row groups are read. The variants of every new or modified file are added
+to the catalog, so files with different variant sets are all covered.
+
+Usage:
+    gwas_snp_index.py --index snp_index.sqlite --files "parquets_*/gwas_summary*_optimized.parquet"
+"""
+import argparse
+import glob
+import logging
+import os
+import re
+import sqlite3
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (file_id INTEGER PRIMARY KEY, path TEXT UNIQUE, mtime REAL);
+CREATE TABLE IF NOT EXISTS row_groups (file_id INTEGER, row_group INTEGER, chrom TEXT, min_pos INTEGER, max_pos INTEGER);
+CREATE TABLE IF NOT EXISTS variants (snp TEXT, chrom TEXT, pos INTEGER, PRIMARY KEY (snp, chrom, pos)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS row_groups_pos ON row_groups (chrom, min_pos);
+"""
+# Bumped when SCHEMA changes; older indexes are dropped and rebuilt
+SCHEMA_VERSION = 2
+
+_CHROM_PARTITION = re.compile(r"CHROM=([^/]+)")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build or update the SNP-ID index of a set of Parquet files.")
+    parser.add_argument("--index", required=True)
+    parser.add_argument("--files", required=True, nargs="+", help="Parquet files or glob patterns.")
+    parser.add_argument("--id_column", default="SNP")
+    parser.add_argument("--chrom_column", default="CHR")
+    parser.add_argument("--pos_column", default="BP")
+    return parser.parse_args()
+
+
+def _connect(index_path):
+    con = sqlite3.connect(index_path)
+    version, = con.execute("PRAGMA user_version").fetchone()
+    if version != SCHEMA_VERSION:
+        con.executescript("DROP TABLE IF EXISTS files; DROP TABLE IF EXISTS row_groups; DROP TABLE IF EXISTS variants;")
+        con.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    con.executescript(SCHEMA)
+    return con
+
+
+def _row_group_ranges(pfile, path, chrom_column, pos_column):
+    """(row_group, chrom, min_pos, max_pos) for each row group, from the Parquet footer."""
+    names = pfile.schema_arrow.names
+    partition = _CHROM_PARTITION.search(path)
+    ranges = []
+    for i in range(pfile.metadata.num_row_groups):
+        rg = pfile.metadata.row_group(i)
+        stats = {rg.column(j).path_in_schema: rg.column(j).statistics for j in range(rg.num_columns)}
+
+        chrom = partition.group(1) if partition else None
+        chrom_stats = stats.get(chrom_column)
+        if chrom_column in names and chrom_stats is not None and chrom_stats.has_min_max and chrom_stats.min == chrom_stats.max:
+            chrom = str(chrom_stats.min)
+
+        pos_stats = stats.get(pos_column)
+        if pos_stats is None or not pos_stats.has_min_max:
+            ranges.append((i, chrom, None, None))
+        else:
+            ranges.append((i, chrom, int(pos_stats.min), int(pos_stats.max)))
+    return ranges
+
+
+def _catalog_variants(con, pfile, path, id_column, chrom_column, pos_column):
+    names = pfile.schema_arrow.names
+    columns = [id_column, pos_column] + ([chrom_column] if chrom_column in names else [])
+    df = pfile.read(columns=columns).to_pandas()
+    if chrom_column not in names:
+        partition = _CHROM_PARTITION.search(path)
+        df[chrom_column] = partition.group(1) if partition else None
+    rows = zip(df[id_column].astype(str), df[chrom_column].astype(str), df[pos_column].astype(int))
+    con.executemany("INSERT OR IGNORE INTO variants VALUES (?, ?, ?)", rows)
+
+
+def update_snp_index(index_path, parquet_files, id_column="SNP", chrom_column="CHR", pos_column="BP"):
+    """Index new or modified files (and drop entries of indexed files that no longer exist)."""
+    files = sorted({f for pattern in parquet_files for f in (glob.glob(pattern, recursive=True) or [pattern]) if os.path.exists(f)})
+
+    con = _connect(index_path)
+    with con:
+        known = dict(con.execute("SELECT path, mtime FROM files"))
+        for path in [p for p in known if not os.path.exists(p)]:
+            file_id, = con.execute("SELECT file_id FROM files WHERE path = ?", (path,)).fetchone()
+            con.execute("DELETE FROM row_groups WHERE file_id = ?", (file_id,))
+            con.execute("DELETE FROM files WHERE file_id = ?", (file_id,))
+
+        n_new = 0
+        for path in files:
+            mtime = os.path.getmtime(path)
+            if known.get(path) == mtime:
+                continue
+
+            pfile = pq.ParquetFile(path)
+            ranges = _row_group_ranges(pfile, path, chrom_column, pos_column)
+            _catalog_variants(con, pfile, path, id_column, chrom_column, pos_column)
+
+            con.execute("INSERT INTO files (path, mtime) VALUES (?, ?) "
+                        "ON CONFLICT (path) DO UPDATE SET mtime = excluded.mtime", (path, mtime))
+            file_id, = con.execute("SELECT file_id FROM files WHERE path = ?", (path,)).fetchone()
+            con.execute("DELETE FROM row_groups WHERE file_id = ?", (file_id,))
+            con.executemany("INSERT INTO row_groups VALUES (?, ?, ?, ?, ?)",
+                            [(file_id,) + r for r in ranges])
+            n_new += 1
+
+    con.close()
+    logging.info(f"SNP index {index_path}: {n_new} new or updated files")
+
+
+def lookup_snps(index_path, snp_list):
+    """DataFrame with the file and row group of every occurrence of the given SNPs."""
+    con = _connect(index_path)
+    con.execute("CREATE TEMP TABLE query (snp TEXT PRIMARY KEY)")
+    con.executemany("INSERT OR IGNORE INTO query VALUES (?)", ((str(s),) for s in snp_list))
+    df = pd.read_sql_query("""
+        SELECT v.snp, v.chrom, v.pos, f.path, r.row_group
+        FROM query q
+        JOIN variants v ON v.snp = q.snp
+        JOIN row_groups r ON (r.chrom = v.chrom OR r.chrom IS NULL)
+                         AND ((v.pos BETWEEN r.min_pos AND r.max_pos) OR r.min_pos IS NULL)
+        JOIN files f ON f.file_id = r.file_id
+    """, con)
+    con.close()
+    return df
+
+
+def read_snps(index_path, snp_list, id_column="SNP", columns=None):
+    """Read the rows for `snp_list`, touching only the row groups that contain them."""
+    hits = lookup_snps(index_path, snp_list)
+    snps = set(hits["snp"])
+    if columns is not None and id_column not in columns:
+        columns = [id_column] + list(columns)
+
+    dfs = []
+    for path, group in hits.groupby("path"):
+        table = pq.ParquetFile(path).read_row_groups(sorted(set(group["row_group"])), columns=columns)
+        df = table.to_pandas()
+        df = df[df[id_column].astype(str).isin(snps)]
+        if not df.empty:
+            df["source_file"] = path
+            dfs.append(df)
+
+    if not dfs:
+        return pd.DataFrame()
+    return pd.concat(dfs, ignore_index=True)
+
+
+def main():
+    args = parse_args()
+    update_snp_index(args.index, args.files, args.id_column, args.chrom_column, args.pos_column)
+
+
+if __name__ == "__main__":
+    main()
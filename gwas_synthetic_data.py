@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Synthetic inputs of the post-GWAS scripts, at a configurable scale, for offline benchmarks
+(gwas_benchmark.py).
+
+Writes into --outdir, with the file formats of the real data:
+  - `ukb.sample`: UKB BGEN sample file (2 header lines, ID_1 ID_2 missing sex),
+  - `rel.dat`: UKB kinship file (ID1 ID2 HetHet IBS0 Kinship), with related pairs above and below
+    the kinship threshold,
+  - `embeddings_{age}.csv`: phenotype files (ID, embedding_000, ...), and `covariates.csv` (ID, sex, pc1..pc20),
+  - `regions.bed` and `step2/emb120_chr{chr}_{start}-{end}_embedding_{e}_{age}.regenie`: per-region
+    regenie step-2 outputs (input of regenie_gather_output.py),
+  - `merged/embedding_{e}_{age}.regenie` (with --kinds merged): merged step-2 outputs,
+  - `assoc/embedding_{e}_{age}.assoc.linear`: PLINK results, whitespace-padded (browser inputs),
+  - `manifest.json`: scale and file lists.
+
+Association statistics are null (z ~ N(0, 1)) except for --n_signals planted variants per
+phenotype with |z| between 6 and 12.
+
+Usage:
+    gwas_synthetic_data.py --outdir bench --n_samples 50000 --n_variants 1000000 --n_embeddings 16 --ages 20 30
+"""
+import argparse
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from regenie_plan_regions import split_positions
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+
+KINDS = ["sample", "kinship", "phenotypes", "step2", "merged", "assoc"]
+DEFAULT_KINDS = ["sample", "kinship", "phenotypes", "step2", "assoc"]
+
+# hg19 chromosome lengths, for the number of variants per chromosome
+CHROM_LENGTHS = [
+    249250621, 243199373, 198022430, 191154276, 180915260, 171115067, 159138663, 146364022,
+    141213431, 135534747, 135006516, 133851895, 115169878, 107349540, 102531392, 90354753,
+    81195210, 78077248, 59128983, 63025520, 48129895, 51304566,
+]
+REGENIE_COLUMNS = ["CHROM", "GENPOS", "ID", "ALLELE0", "ALLELE1", "A1FREQ", "INFO", "N", "TEST", "BETA", "SE", "CHISQ", "LOG10P", "EXTRA"]
+N_PCS = 20
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Write synthetic GWAS inputs for benchmarking.")
+    parser.add_argument("--outdir", required=True)
+    parser.add_argument("--n_samples", default=10_000, type=int)
+    parser.add_argument("--n_variants", default=200_000, type=int)
+    parser.add_argument("--n_embeddings", default=8, type=int)
+    parser.add_argument("--ages", nargs="+", type=int, default=[20])
+    parser.add_argument("--n_regions", default=20, type=int, help="Step-2 regions (of equal variant counts).")
+    parser.add_argument("--n_signals", default=20, type=int, help="Planted significant variants per phenotype.")
+    parser.add_argument("--related_fraction", default=0.05, type=float, help="Related pairs per sample.")
+    parser.add_argument("--kinds", nargs="+", choices=KINDS, default=DEFAULT_KINDS)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--workers", default=os.cpu_count(), type=int)
+    return parser.parse_args()
+
+
+def phenotype_names(n_embeddings, ages):
+    return [f"embedding_{e:03d}_{age}" for age in ages for e in range(n_embeddings)]
+
+
+def make_variants(n_variants, n_samples, seed=0):
+    """Variant table (CHROM GENPOS ID ALLELE0 ALLELE1 A1FREQ INFO N), sorted by position."""
+    rng = np.random.default_rng(seed)
+    lengths = np.array(CHROM_LENGTHS, dtype=np.float64)
+    counts = rng.multinomial(n_variants, lengths / lengths.sum())
+
+    chrom = np.repeat(np.arange(1, 23), counts)
+    pos = np.concatenate([np.sort(rng.choice(int(length), size=n, replace=False)) + 1 for length, n in zip(CHROM_LENGTHS, counts)])
+    bases = np.array(list("ACGT"))
+    a0 = rng.integers(0, 4, n_variants)
+    a1 = (a0 + rng.integers(1, 4, n_variants)) % 4
+    return pd.DataFrame({
+        "CHROM": chrom,
+        "GENPOS": pos,
+        "ID": [f"rs{i + 1}" for i in range(n_variants)],
+        "ALLELE0": bases[a0],
+        "ALLELE1": bases[a1],
+        "A1FREQ": rng.beta(0.5, 0.5, n_variants).clip(0.005, 0.995).round(6),
+        "INFO": rng.uniform(0.3, 1.0, n_variants).round(4),
+        "N": n_samples,
+    })
+
+
+def association_stats(variants, n_signals, seed):
+    """BETA SE CHISQ LOG10P for one phenotype (null, with `n_signals` planted hits)."""
+    rng = np.random.default_rng(seed)
+    n = len(variants)
+    z = rng.standard_normal(n)
+    hits = rng.choice(n, size=min(n_signals, n), replace=False)
+    z[hits] = rng.choice([-1, 1], len(hits)) * rng.uniform(6, 12, len(hits))
+
+    freq = variants["A1FREQ"].to_numpy()
+    se = 1 / np.sqrt(2 * variants["N"].to_numpy() * freq * (1 - freq))
+    chisq = z ** 2
+    return pd.DataFrame({
+        "BETA": z * se,
+        "SE": se,
+        "CHISQ": chisq,
+        "LOG10P": -stats.chi2.logsf(chisq, 1) / np.log(10),
+    })
+
+
+def regenie_table(variants, pheno_seed, n_signals):
+    df = pd.concat([variants.reset_index(drop=True), association_stats(variants, n_signals, pheno_seed)], axis=1)
+    df.insert(8, "TEST", "ADD")
+    df["EXTRA"] = "NA"
+    return df[REGENIE_COLUMNS]
+
+
+def write_regenie(df, path):
+    df.to_csv(path, sep=" ", index=False, float_format="%.6g")
+
+
+def write_assoc_linear(variants, pheno_seed, n_signals, path):
+    """PLINK .assoc.linear, with the whitespace padding of PLINK 1.9."""
+    s = association_stats(variants, n_signals, pheno_seed)
+    columns = {
+        "CHR": variants["CHROM"].astype(str),
+        "SNP": variants["ID"],
+        "BP": variants["GENPOS"].astype(str),
+        "A1": variants["ALLELE1"],
+        "TEST": pd.Series("ADD", index=variants.index),
+        "NMISS": variants["N"].astype(str),
+        "BETA": pd.Series(np.char.mod("%.4g", s["BETA"].to_numpy()), index=variants.index),
+        "STAT": pd.Series(np.char.mod("%.4g", (s["BETA"] / s["SE"]).to_numpy()), index=variants.index),
+        "P": pd.Series(np.char.mod("%.4g", np.power(10.0, -s["LOG10P"].to_numpy())), index=variants.index),
+    }
+    widths = [4, 12, 12, 4, 10, 8, 10, 12, 12]
+    lines = None
+    for values, w in zip(columns.values(), widths):
+        padded = values.str.rjust(w + 1)
+        lines = padded if lines is None else lines + padded
+    with open(path, "w") as f:
+        f.write("".join(c.rjust(w + 1) for c, w in zip(columns, widths)) + "\n")
+        f.write("\n".join(lines) + "\n")
+
+
+def _write_step2_pheno(variants, regions, pheno, pheno_seed, n_signals, outdir):
+    df = regenie_table(variants, pheno_seed, n_signals)
+    for chrom, start, end in regions:
+        mask = (df["CHROM"] == chrom) & (df["GENPOS"] >= start) & (df["GENPOS"] <= end)
+        write_regenie(df[mask], os.path.join(outdir, f"emb120_chr{chrom}_{start}-{end}_{pheno}.regenie"))
+    return pheno
+
+
+def _write_merged_pheno(variants, pheno, pheno_seed, n_signals, outdir):
+    write_regenie(regenie_table(variants, pheno_seed, n_signals), os.path.join(outdir, f"{pheno}.regenie"))
+    return pheno
+
+
+def _write_assoc_pheno(variants, pheno, pheno_seed, n_signals, outdir):
+    write_assoc_linear(variants, pheno_seed, n_signals, os.path.join(outdir, f"{pheno}.assoc.linear"))
+    return pheno
+
+
+def write_samples(outdir, n_samples, seed=0):
+    ids = np.arange(1_000_001, 1_000_001 + n_samples)
+    rng = np.random.default_rng(seed)
+    sample = pd.DataFrame({"ID_1": ids, "ID_2": ids, "missing": 0, "sex": rng.integers(1, 3, n_samples)})
+    path = os.path.join(outdir, "ukb.sample")
+    with open(path, "w") as f:
+        f.write("ID_1 ID_2 missing sex\n0 0 0 D\n")
+        sample.to_csv(f, sep=" ", header=False, index=False)
+    return ids
+
+
+def write_kinship(outdir, ids, related_fraction, seed=0):
+    """Related pairs: ~1/2 first-degree (kinship 0.25), ~1/4 second-degree (0.125), ~1/4 below the threshold."""
+    rng = np.random.default_rng(seed)
+    n_pairs = int(len(ids) * related_fraction)
+    pairs = rng.choice(len(ids), size=(n_pairs, 2))
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    kinship = rng.choice([0.25, 0.125, 0.06], len(pairs), p=[0.5, 0.25, 0.25]) + rng.normal(0, 0.01, len(pairs))
+    pd.DataFrame({
+        "ID1": ids[pairs[:, 0]],
+        "ID2": ids[pairs[:, 1]],
+        "HetHet": rng.uniform(0.05, 0.2, len(pairs)).round(4),
+        "IBS0": rng.uniform(0, 0.01, len(pairs)).round(4),
+        "Kinship": kinship.round(4),
+    }).to_csv(os.path.join(outdir, "rel.dat"), sep=" ", index=False)
+
+
+def write_phenotypes(outdir, ids, n_embeddings, ages, seed=0):
+    """Embedding phenotypes per age (with a few missing values) and covariates."""
+    rng = np.random.default_rng(seed)
+    pcs = rng.standard_normal((len(ids), N_PCS))
+    covariates = pd.DataFrame(pcs, columns=[f"pc{i}" for i in range(1, N_PCS + 1)]).round(5)
+    covariates.insert(0, "sex", rng.integers(0, 2, len(ids)))
+    covariates.insert(0, "ID", ids)
+    covariates.to_csv(os.path.join(outdir, "covariates.csv"), index=False)
+
+    for age in ages:
+        values = pcs[:, :3] @ rng.normal(0, 0.2, (3, n_embeddings)) + rng.standard_normal((len(ids), n_embeddings))
+        values[rng.random(values.shape) < 0.01] = np.nan
+        df = pd.DataFrame(values, columns=[f"embedding_{e:03d}" for e in range(n_embeddings)]).round(5)
+        df.insert(0, "ID", ids)
+        df.to_csv(os.path.join(outdir, f"embeddings_{age}.csv"), index=False)
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.outdir, exist_ok=True)
+    phenos = phenotype_names(args.n_embeddings, args.ages)
+    manifest = {k: v for k, v in vars(args).items() if k not in ("outdir", "workers")}
+    manifest["phenotypes"] = phenos
+
+    if "sample" in args.kinds or "kinship" in args.kinds or "phenotypes" in args.kinds:
+        ids = write_samples(args.outdir, args.n_samples, args.seed)
+        if "kinship" in args.kinds:
+            write_kinship(args.outdir, ids, args.related_fraction, args.seed)
+        if "phenotypes" in args.kinds:
+            write_phenotypes(args.outdir, ids, args.n_embeddings, args.ages, args.seed)
+        logging.info(f"Samples, kinship and phenotypes of {args.n_samples} individuals written")
+
+    jobs = []
+    if {"step2", "merged", "assoc"} & set(args.kinds):
+        variants = make_variants(args.n_variants, args.n_samples, args.seed)
+        target = -(-args.n_variants // args.n_regions)
+        regions = [(c, s, e) for c, group in variants.groupby("CHROM")
+                   for s, e, _ in split_positions(group["GENPOS"].to_numpy(), target)]
+        manifest["regions"] = len(regions)
+        pd.DataFrame(regions).to_csv(os.path.join(args.outdir, "regions.bed"), sep="\t", header=False, index=False)
+
+        for kind, writer in (("step2", _write_step2_pheno), ("merged", _write_merged_pheno), ("assoc", _write_assoc_pheno)):
+            if kind not in args.kinds:
+                continue
+            outdir = os.path.join(args.outdir, kind)
+            os.makedirs(outdir, exist_ok=True)
+            for i, pheno in enumerate(phenos):
+                extra = (regions,) if kind == "step2" else ()
+                jobs.append((writer, (variants, *extra, pheno, args.seed + i + 1, args.n_signals, outdir)))
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for future in [pool.submit(fn, *fn_args) for fn, fn_args in jobs]:
+            future.result()
+    if jobs:
+        logging.info(f"{len(jobs)} association result sets of {args.n_variants} variants written")
+
+    with open(os.path.join(args.outdir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
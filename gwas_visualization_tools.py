@@ -1,73 +1,78 @@
+import os
+
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from biomart import BiomartServer
+from glob import glob
 from gprofiler.gprofiler import GProfiler
 
+from gwas_gene_annotation import GENE_ANNOTATION as _GENE_ANNOTATION_ENV, GeneAnnotation, VariantIndex, window_join
+from gwas_snp_index import update_snp_index, read_snps
+
 ### ----------------------------
 ### A. Gene TSS and Nearby SNPs
 ### ----------------------------
 
 BFILE = "/nfs/research/birney/projects/association/snp_gwas/regenie/resources/ukb22828_allChr_b0_v3_maf01_04_merge"
 bim_path = f"{BFILE}.bim"
-bim = pd.read_csv(bim_path, sep='\s+', header=None)
+# Gene annotation store (gwas_gene_annotation.py): $GWAS_GENE_ANNOTATION, else next to the genotypes
+GENE_ANNOTATION = _GENE_ANNOTATION_ENV or os.path.join(os.path.dirname(BFILE), "gene_annotation_grch37.parquet")
 
 parquet_files = glob("parquets_*/gwas_summary*_optimized.parquet")
+SNP_INDEX = "snp_index.sqlite"
 
-from biomart import BiomartServer
-import gzip
+# Loaded on first use (the .bim is large, the annotation is only needed for gene lookups)
+_variants = VariantIndex(bim_path)
+_genes = None
 
-def get_gene_tss(gene_name):
-    server = BiomartServer("http://grch37.ensembl.org/biomart")
-    dataset = server.datasets['hsapiens_gene_ensembl']
-
-    response = dataset.search({
-        'filters': {'external_gene_name': gene_name},
-        'attributes': [
-            'chromosome_name',
-            'transcription_start_site',
-            'strand',
-            'external_gene_name'
-        ]
-    })
 
-    lines = response.content.decode().strip().split("\n")
-    rows = [line.split("\t") for line in lines]
-    rows = [r for r in rows if r[0].isdigit() or r[0] in ['X', 'Y']]
-    rows.sort(key=lambda x: int(x[1]) * x[2])
+def __getattr__(name):
+    # `bim` (the .bim DataFrame) is read on first access, not at import
+    if name == "bim":
+        return _variants.df
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
-    if not rows:
-        return None
+def gene_annotation(path=GENE_ANNOTATION):
+    """The offline gene annotation store (see gwas_gene_annotation.py), loaded once."""
+    global _genes
+    if _genes is None:
+        _genes = GeneAnnotation.load(path)
+    return _genes
 
-    chrom, tss, strand, _ = rows[0]
-    return chrom, int(tss), int(strand)
+
+def get_gene_tss(gene_name):
+    """(chrom, tss, strand) of the most upstream TSS of `gene_name`, or None if unknown."""
+    return gene_annotation().tss(gene_name)
 
 
 def get_snps_near_tss(gene_name, window=50_000):
     """
-    Filter SNPs in a BIM file that fall within a window around the gene TSS.
+    Filter SNPs in a BIM file that fall within a window around the gene TSS
+    (none if the gene is not in the annotation store).
     """
+    gene = get_gene_tss(gene_name)
+    if gene is None:
+        return _variants.df.iloc[:0]
+    chrom, tss, strand = gene
+    return _variants.window(chrom, tss - window, tss + window)
 
-    chrom, tss, strand = get_gene_tss(gene_name)    
-    bim.columns = ['chrom', 'snp', 'cm', 'pos', 'a1', 'a2']
-    bim_chr = bim[bim['chrom'].astype(str) == str(chrom)]
-    mask = (bim_chr['pos'] >= tss - window) & (bim_chr['pos'] <= tss + window)
-    return bim_chr[mask]
 
+def snps_near_genes(gene_names, window=50_000):
+    """SNPs within `window` of the TSS of each gene, with a `gene_name` column (unknown genes are skipped)."""
+    genes = gene_annotation().lookup(gene_names)
+    idx, rows = _variants.windows(genes["chrom"], genes["tss"] - window, genes["tss"] + window)
+    return _variants.df.iloc[rows].assign(gene_name=genes["gene_name"].to_numpy()[idx]).reset_index(drop=True)
 
-def query_snps(snp_list):
 
-    dfs = []
-    for path in parquet_files:
-        dataset = ds.dataset(path, format="parquet")
-        table = dataset.to_table(filter=ds.field("SNP").isin(snp_list))
-        df = table.to_pandas()
-        if not df.empty:
-            df["source_file"] = path
-            dfs.append(df)
-    
-    df_final = pd.concat(dfs, ignore_index=True)
-    return(df_final)
+def query_snps(snp_list, index_path=SNP_INDEX):
+    """
+    Association results for the given SNPs across all Parquet files.
+    Uses the persistent SNP index (updated with any new or modified file), so only
+    the row groups containing the SNPs are read.
+    """
+    update_snp_index(index_path, parquet_files, id_column="SNP", chrom_column="CHR", pos_column="BP")
+    return read_snps(index_path, snp_list, id_column="SNP")
 
 ### -------------------------------
 ### B. Plot SNP association by age
@@ -136,29 +141,38 @@ def get_significant_snps(df_assoc, pval_thresh=5e-8):
     return df_assoc[df_assoc['P'] < pval_thresh]
 
 
-def map_snps_to_nearby_genes(signif_snps_df, bim_df, biomart_genes, window=100_000):
+def map_snps_to_nearby_genes(signif_snps_df, bim_df, biomart_genes=None, window=100_000,
+                             chrom_col="chromosome", pos_col="start"):
     """
-    Map significant SNPs to nearby genes using genomic distance.
+    Map significant SNPs to the genes within `window` bp (gene position: `pos_col` of
+    `biomart_genes`, or the TSS of the annotation store if `biomart_genes` is None).
+    Returns one row per (SNP, gene): SNP, chrom, pos, gene_name, distance (gene - SNP, bp),
+    sorted by SNP and absolute distance.
     """
-    merged = pd.merge(signif_snps_df[['SNP']], bim_df[['snp', 'chrom', 'pos']],
-                      left_on='SNP', right_on='snp')
-    results = []
-    for _, row in merged.iterrows():
-        snp_chr = str(row['chrom'])
-        snp_pos = int(row['pos'])
-        nearby = biomart_genes[
-            (biomart_genes['chromosome'] == snp_chr) &
-            (np.abs(biomart_genes['start'] - snp_pos) <= window)
-        ]
-        for _, gene in nearby.iterrows():
-            results.append(gene['gene_name'])
-    return list(set(results))
+    if biomart_genes is None:
+        biomart_genes, chrom_col, pos_col = gene_annotation().genes, "chrom", "tss"
+    snps = pd.merge(signif_snps_df[['SNP']].drop_duplicates(), bim_df[['snp', 'chrom', 'pos']],
+                    left_on='SNP', right_on='snp')
+
+    i, j = window_join(snps['chrom'], snps['pos'], biomart_genes[chrom_col], biomart_genes[pos_col], window)
+    pairs = pd.DataFrame({
+        'SNP': snps['SNP'].to_numpy()[i],
+        'chrom': snps['chrom'].astype(str).to_numpy()[i],
+        'pos': snps['pos'].to_numpy()[i],
+        'gene_name': biomart_genes['gene_name'].to_numpy()[j],
+        'distance': biomart_genes[pos_col].to_numpy()[j].astype(np.int64) - snps['pos'].to_numpy()[i],
+    })
+    return (pairs.assign(_abs=pairs['distance'].abs())
+            .sort_values(['SNP', '_abs'], kind='stable').drop(columns='_abs').reset_index(drop=True))
 
 
 def enrich_genes(gene_list, organism="hsapiens"):
     """
     Run gene set enrichment analysis using g:Profiler.
+    `gene_list` is a list of gene names or the table of map_snps_to_nearby_genes.
     """
+    if isinstance(gene_list, pd.DataFrame):
+        gene_list = gene_list['gene_name'].drop_duplicates().tolist()
     gp = GProfiler(return_dataframe=True)
     results = gp.profile(organism=organism, query=gene_list)
     return results
@@ -1,6 +1,11 @@
 import pandas as pd
 import sys
+
+from gwas_compressed_io import compressed_path, open_compressed
+
 phenotype_file = sys.argv[1]
+# Optional: "gzip" or "bgzip" to write the output compressed
+compression = sys.argv[2] if len(sys.argv) > 2 else None
 
 df = pd.read_csv(phenotype_file, sep='\t')
 if len(df.columns) == 1:
@@ -9,4 +14,6 @@ if len(df.columns) == 1:
 df.insert(0, "FID", df["ID"])
 df.rename(columns={"ID": "IID"}, inplace=True)
 
-df.to_csv(phenotype_file.replace(".csv", "")+"_plink.tsv", sep="\t", index=False, na_rep="NA")
+out_file = compressed_path(phenotype_file.removesuffix(".gz").replace(".csv", "") + "_plink.tsv", compression)
+with open_compressed(out_file, compression) as f:
+    df.to_csv(f, sep="\t", index=False, na_rep="NA")
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Merge per-region regenie step-2 outputs into one file per phenotype.
+
+For every phenotype, region files `{prefix}_chr{chr}_{start}-{end}_{pheno}.regenie` are
+concatenated (header kept once) in the order of the regions BED file. Missing regions are
+written to `{pheno}.failed_regions.txt`, and variants above the LOG10P threshold to
+`{pheno}_signif.regenie`, in the same pass: region files are streamed in blocks, and the
+significance column of each block is parsed in one vectorised call. Phenotypes are merged in parallel.
+"""
+import argparse
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from gwas_metrics import add_rows, instrumented, stage
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+
+BUFFER_SIZE = 16 * 1024 * 1024
+# Region files are read (and filtered) in blocks of this many bytes (small enough to stay in cache)
+BLOCK_SIZE = 256 * 1024
+# Bytes of the significance field inspected before parsing it as a float
+FIELD_SCAN = 12
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--regions_file", default=os.path.expandvars("$HOME/Delphi/gwas/data/regions_2mb_hg19.bed"))
+    parser.add_argument("--indir", default=os.path.expandvars("$NB/emb120_regenie2"))
+    parser.add_argument("--outdir", default=os.path.expandvars("$NB/merged_retry"))
+    parser.add_argument("--prefix", default="emb120", help="Prefix of the per-region files.")
+    parser.add_argument("--phenotypes", default=None, nargs="+")
+    parser.add_argument("--pheno_file", default=None, help="Phenotype file; its header (from the 3rd column on) lists the phenotypes.")
+    parser.add_argument("--signif_column", default="LOG10P")
+    parser.add_argument("--signif_threshold", default=7.3, type=float)
+    parser.add_argument("--workers", default=os.cpu_count(), type=int)
+    return parser.parse_args()
+
+
+def read_regions(regions_file):
+    regions = []
+    with open(regions_file) as f:
+        for line in f:
+            fields = line.split()
+            if fields:
+                regions.append(tuple(fields[:3]))
+    return regions
+
+
+def read_phenotypes(pheno_file):
+    with open(pheno_file) as f:
+        return f.readline().rstrip("\n").split("\t")[2:]
+
+
+def _read_blocks(f, block_size=BLOCK_SIZE):
+    """Blocks of whole lines of `f` (the last one gets a newline if the file lacks it)."""
+    rest = b""
+    while True:
+        data = f.read(block_size)
+        if not data:
+            break
+        data = rest + data
+        cut = data.rfind(b"\n") + 1
+        rest = data[cut:]
+        if cut:
+            yield data[:cut]
+    if rest:
+        yield rest + b"\n"
+
+
+def _above(line, col, threshold):
+    fields = line.split(None, col + 1)
+    try:
+        return float(fields[col]) > threshold
+    except (IndexError, ValueError):
+        return False
+
+
+def signif_lines(block, col, threshold):
+    """
+    Lines of `block` (whole lines) whose field `col` is above `threshold`.
+    The delimiters are located in one vectorised pass; when all lines have the same number of
+    single-space-separated fields, only the lines whose field `col` could exceed `threshold`
+    (by its integer part, or with an exponent) are parsed as floats. Other blocks are
+    parsed line by line.
+    """
+    n_lines = block.count(b"\n")
+    int_digits = len(str(int(threshold))) if 0 <= threshold < 1e15 else None
+    arr = np.frombuffer(block, dtype=np.uint8)
+    delims = np.flatnonzero(arr <= ord(" "))
+    n_fields = len(delims) // n_lines if n_lines else 0
+    # Same number of fields on every line, and no empty field (repeated delimiter)
+    uniform = (int_digits is not None and n_fields > col and len(delims) == n_lines * n_fields
+               and (arr[delims[n_fields - 1::n_fields]] == ord("\n")).all()
+               and delims[0] > 0 and np.diff(delims).min(initial=2) > 1)
+    if not uniform:
+        return b"".join(line for line in block.splitlines(keepends=True) if _above(line, col, threshold))
+
+    grid = delims.reshape(n_lines, n_fields)
+    ends = grid[:, -1]
+    field_start = grid[:, col - 1] + 1 if col > 0 else np.concatenate([[0], ends[:-1] + 1])
+    length = grid[:, col] - field_start
+
+    # First FIELD_SCAN bytes of the field: number of leading digits, and exponent
+    offsets = np.arange(FIELD_SCAN)
+    inside = offsets < length[:, None]
+    chars = arr[np.minimum(field_start[:, None] + offsets, len(arr) - 1)]
+    digits = chars - np.uint8(ord("0"))
+    is_digit = inside & (digits < 10)
+    n_int = np.argmin(is_digit, axis=1)
+    has_exp = (inside & ((chars | 0x20) == ord("e"))).any(axis=1)
+
+    # The value can exceed `threshold` only if its integer part has more digits than
+    # int(threshold), or as many and is not smaller; longer fields are parsed anyway
+    head = np.zeros(n_lines, dtype=np.int64)
+    for j in range(min(int_digits, FIELD_SCAN)):
+        head = head * 10 + digits[:, j]
+    candidate = (n_int > int_digits) | ((n_int == int_digits) & (head >= int(threshold)))
+    candidate |= has_exp | (length >= FIELD_SCAN)
+    candidates = np.flatnonzero(candidate)
+
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    return b"".join(block[starts[i]:ends[i] + 1] for i in candidates
+                    if _above(block[starts[i]:ends[i] + 1], col, threshold))
+
+
+@instrumented()
+def merge_phenotype(pheno, regions, indir, outdir, prefix, signif_column="LOG10P", signif_threshold=7.3):
+    """Merge all region files of `pheno`. Returns (pheno, number of missing regions)."""
+    outfile = os.path.join(outdir, f"{pheno}.regenie")
+    signif_file = os.path.join(outdir, f"{pheno}_signif.regenie")
+    fail_file = os.path.join(outdir, f"{pheno}.failed_regions.txt")
+
+    failed = []
+    header = None
+    col = None
+
+    with open(f"{outfile}.tmp", "wb", buffering=BUFFER_SIZE) as out, \
+         open(f"{signif_file}.tmp", "wb", buffering=BUFFER_SIZE) as signif:
+
+        for chrom, start, end in regions:
+            path = os.path.join(indir, f"{prefix}_chr{chrom}_{start}-{end}_{pheno}.regenie")
+            try:
+                f = open(path, "rb")
+            except FileNotFoundError:
+                failed.append(f"{chrom}\t{start}\t{end}\n")
+                continue
+
+            with f:
+                first = f.readline()
+                if not first.endswith(b"\n"):
+                    continue
+                if header is None:
+                    header = first
+                    col = header.split().index(signif_column.encode())
+                    out.write(header)
+                    signif.write(header)
+
+                for block in _read_blocks(f):
+                    out.write(block)
+                    add_rows(block.count(b"\n"))
+                    signif.write(signif_lines(block, col, signif_threshold))
+
+    os.replace(f"{outfile}.tmp", outfile)
+    os.replace(f"{signif_file}.tmp", signif_file)
+
+    if failed:
+        with open(fail_file, "w") as f:
+            f.writelines(failed)
+    elif os.path.exists(fail_file):
+        os.remove(fail_file)
+
+    return pheno, len(failed)
+
+
+def main():
+    args = parse_args()
+
+    if args.phenotypes is None and args.pheno_file is None:
+        raise ValueError("Either --phenotypes or --pheno_file is required")
+    phenotypes = args.phenotypes if args.phenotypes is not None else read_phenotypes(args.pheno_file)
+
+    regions = read_regions(args.regions_file)
+    os.makedirs(args.outdir, exist_ok=True)
+    logging.info(f"Merging {len(regions)} regions for {len(phenotypes)} phenotypes")
+
+    with stage("gather", n_phenotypes=len(phenotypes), n_regions=len(regions)), \
+         ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [
+            pool.submit(merge_phenotype, pheno, regions, args.indir, args.outdir, args.prefix,
+                        args.signif_column, args.signif_threshold)
+            for pheno in phenotypes
+        ]
+        for future in as_completed(futures):
+            pheno, n_failed = future.result()
+            outfile = os.path.join(args.outdir, f"{pheno}.regenie")
+            if n_failed == 0:
+                logging.info(f"Merged {pheno} → {outfile} (no missing regions)")
+            else:
+                fail_file = os.path.join(args.outdir, f"{pheno}.failed_regions.txt")
+                logging.info(f"Merged {pheno} → {outfile} (missing {n_failed} regions, see {fail_file})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Build the per-phenotype level-0 tree used by step 1 / level 1, for all ages in one process.
+
+Step 1 / level 0 runs on two halves of the phenotypes (`head`: embeddings 0-59, `tail`: 60-119),
+in `split_jobs_age{age}_emb120_stage1_l0_{half}`, where phenotype Y{y} of a half is
+embedding y - 1 (head) or y + 59 (tail). For every (age, embedding) this creates
+`split_jobs_stage1_l0/age{age}/embedding_{e:03d}/` with:
+  - `split_job{j}_l0_Y1`: symlink to `split_job{j}_l0_Y{y}` of the half, for every l0 job,
+  - `split.master`: the master file of the half, pointing to this directory.
+
+The l0 jobs are read from the master file of each half, and every expected `_l0_Y*` file is
+checked before anything is written. Running it again only fixes what differs.
+Replaces regenie_linkify.slurm, regenie_rename.sh and regenie_modify_master.sh.
+
+Usage:
+    regenie_linkify.py --workdir $HOME/Delphi/gwas --ages 20 30 40 50 60
+"""
+import argparse
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+
+AGES = [20, 30, 40, 50, 60]
+EMBEDDING_SIZE = 120
+HALF_SIZE = 60
+LINKED_BASE = "split_jobs_stage1_l0"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Per-phenotype level-0 symlinks and master files for step 1 / level 1.")
+    parser.add_argument("--workdir", default=".")
+    parser.add_argument("--ages", nargs="+", type=int, default=AGES)
+    parser.add_argument("--embeddings", nargs="+", type=int, default=list(range(EMBEDDING_SIZE)))
+    parser.add_argument("--allow_missing", action="store_true", help="Link the files that exist instead of failing.")
+    parser.add_argument("--workers", default=16, type=int)
+    return parser.parse_args()
+
+
+def half_of(embedding):
+    return "head" if embedding < HALF_SIZE else "tail"
+
+
+def y_index(embedding):
+    """Y index of the embedding in the l0 outputs of its half (regenie starts at Y1)."""
+    return embedding + 1 if embedding < HALF_SIZE else embedding - HALF_SIZE + 1
+
+
+def source_dir(age, half):
+    return f"split_jobs_age{age}_emb{EMBEDDING_SIZE}_stage1_l0_{half}"
+
+
+def linked_dir(age, embedding):
+    return os.path.join(LINKED_BASE, f"age{age}", f"embedding_{embedding:03d}")
+
+
+def read_master_jobs(master):
+    """Job prefixes listed in a regenie `--split-l0` master file (first field of each line after the header)."""
+    with open(master) as f:
+        lines = f.read().splitlines()[1:]
+    return [os.path.basename(line.split()[0]) for line in lines if line.strip()]
+
+
+def _write_if_changed(path, text):
+    if os.path.exists(path):
+        with open(path) as f:
+            if f.read() == text:
+                return False
+    with open(f"{path}.tmp", "w") as f:
+        f.write(text)
+    os.replace(f"{path}.tmp", path)
+    return True
+
+
+def _symlink(target, link):
+    """Point `link` at `target`, replacing a link to anything else. Returns True if changed."""
+    if os.path.islink(link) and os.readlink(link) == target:
+        return False
+    tmp = f"{link}.tmp"
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(target, tmp)
+    os.replace(tmp, link)
+    return True
+
+
+def link_phenotype(workdir, age, embedding, jobs, master_text, available):
+    """Create the tree of one (age, embedding). Returns (number of changed links, master changed)."""
+    src = source_dir(age, half_of(embedding))
+    dst = linked_dir(age, embedding)
+    os.makedirs(os.path.join(workdir, dst), exist_ok=True)
+
+    y = y_index(embedding)
+    n_changed = 0
+    for job in jobs:
+        name = f"{job}_l0_Y{y}"
+        if name not in available:
+            continue
+        n_changed += _symlink(os.path.join(workdir, src, name), os.path.join(workdir, dst, f"{job}_l0_Y1"))
+
+    master_changed = _write_if_changed(os.path.join(workdir, dst, "split.master"), master_text.replace(src, dst))
+    return n_changed, master_changed
+
+
+def main():
+    args = parse_args()
+    workdir = os.path.abspath(args.workdir)
+
+    # Jobs, master file and l0 outputs of every (age, half), and the expected files that are missing
+    halves = {}
+    missing = []
+    for age in args.ages:
+        for half in sorted({half_of(e) for e in args.embeddings}):
+            src = os.path.join(workdir, source_dir(age, half))
+            master = os.path.join(src, "split.master")
+            if not os.path.exists(master):
+                missing.append(master)
+                continue
+            jobs = read_master_jobs(master)
+            with open(master) as f:
+                master_text = f.read()
+            available = set(os.listdir(src))
+            halves[age, half] = (jobs, master_text, available)
+            for e in args.embeddings:
+                if half_of(e) == half:
+                    missing += [os.path.join(src, f"{job}_l0_Y{y_index(e)}") for job in jobs
+                                if f"{job}_l0_Y{y_index(e)}" not in available]
+
+    if missing:
+        for path in missing[:10]:
+            logging.error(f"Missing {path}")
+        logging.error(f"{len(missing)} expected level-0 files are missing")
+        if not args.allow_missing:
+            sys.exit(1)
+
+    jobs = [(age, e) for age in args.ages for e in args.embeddings if (age, half_of(e)) in halves]
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        results = list(pool.map(lambda job: link_phenotype(workdir, job[0], job[1], *halves[job[0], half_of(job[1])]), jobs))
+
+    n_links = sum(r[0] for r in results)
+    n_masters = sum(r[1] for r in results)
+    logging.info(f"{len(jobs)} phenotypes: {n_links} links and {n_masters} master files created or updated")
+
+
+if __name__ == "__main__":
+    main()
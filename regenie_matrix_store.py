@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Dense variant x phenotype store of regenie step-2 results.
+
+All phenotype files are aligned to one shared variant index (the union of the variants of all
+files), and LOG10P, BETA, SE and A1FREQ are kept as memory-mapped float32 arrays of shape
+(variants, phenotypes), row-major, so that the row of any SNP across all embeddings and ages
+is a single contiguous read. A1FREQ is kept per phenotype because allele frequencies differ
+between the age subsets; the export gives one value per (SNP, age).
+
+The build parses every file once: each is aligned to the variants of the first file and
+written as one contiguous row of temporary (phenotypes, variants) arrays (in --tmpdir),
+variants missing from the first file are kept aside, and the temporary arrays are then
+transposed into the store in blocks of --block_rows variants (bounded memory, sequential
+writes).
+
+Store layout:
+    {store}/store.json         phenotypes, number of variants, arrays, layout
+    {store}/variants.parquet   CHROM GENPOS ID ALLELE0 ALLELE1
+    {store}/{STAT}.npy         one memory-mapped (variants x phenotypes) array per statistic (.npy format)
+
+Usage:
+    regenie_matrix_store.py build --indir $NB/merged_retry --store $NB/matrix_store --workers 16 --tmpdir $TMPDIR
+    regenie_matrix_store.py export --store $NB/matrix_store --snplist $HOME/signif_snps.txt \\
+        --stat LOG10P --out gwas_only_significant_snps_delphi120_imputed_pvals.csv
+"""
+import argparse
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from gwas_parquet_store import read_regenie
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+
+AGES = [20, 30, 40, 50, 60]
+EMBEDDING_SIZE = 120
+STATS = ["LOG10P", "BETA", "SE"]
+ARRAYS = STATS + ["A1FREQ"]
+VARIANT_COLUMNS = ["CHROM", "GENPOS", "ID", "ALLELE0", "ALLELE1"]
+KEY_COLUMNS = ["ID", "ALLELE0", "ALLELE1"]
+LAYOUT = "variant_major"
+BLOCK_ROWS = 100_000
+
+_reference = None
+_tmp_arrays = None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Memory-mapped variant x phenotype store of regenie results.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build")
+    build.add_argument("--indir", default=os.path.expandvars("$NB/merged_retry"))
+    build.add_argument("--store", default=os.path.expandvars("$NB/matrix_store"))
+    build.add_argument("--embeddings", nargs="+", type=int, default=list(range(EMBEDDING_SIZE)))
+    build.add_argument("--ages", nargs="+", type=int, default=AGES)
+    build.add_argument("--block_rows", default=BLOCK_ROWS, type=int, help="Variants transposed into the store at once.")
+    build.add_argument("--tmpdir", default=None, help="Temporary phenotype-major arrays (default: the store directory).")
+    build.add_argument("--workers", default=os.cpu_count(), type=int)
+
+    export = subparsers.add_parser("export")
+    export.add_argument("--store", default=os.path.expandvars("$NB/matrix_store"))
+    export.add_argument("--snplist", default=None, help="Whitespace-delimited file, SNP IDs in the 3rd column (default: all variants).")
+    export.add_argument("--stat", default="LOG10P", choices=STATS)
+    export.add_argument("--out", required=True)
+
+    return parser.parse_args()
+
+
+def _init_worker(reference, tmp_arrays):
+    global _reference, _tmp_arrays
+    _reference = reference
+    _tmp_arrays = tmp_arrays
+
+
+def _align(j, df, reference, tmp_arrays):
+    """
+    Write the statistics of `df` (phenotype `j`) as row `j` of the temporary arrays, aligned
+    to `reference`. Returns the rows of the variants that are not in `reference`.
+    """
+    if len(df) == len(reference) and np.array_equal(df["ID"].to_numpy(), reference.get_level_values("ID").to_numpy()):
+        idx = None
+    else:
+        idx = reference.get_indexer(pd.MultiIndex.from_frame(df[KEY_COLUMNS]))
+    for stat in ARRAYS:
+        values = df[stat].to_numpy(dtype=np.float32, na_value=np.nan)
+        if idx is not None:
+            aligned = np.full(len(reference), np.nan, dtype=np.float32)
+            aligned[idx[idx >= 0]] = values[idx >= 0]
+            values = aligned
+        mm = np.load(tmp_arrays[stat], mmap_mode="r+")
+        mm[j] = values
+        mm.flush()
+        del mm
+    if idx is None:
+        return df.iloc[:0].assign(_pheno=j)
+    return df[idx < 0].assign(_pheno=j)
+
+
+def _read_aligned(job):
+    j, path = job
+    df = read_regenie(path, columns=VARIANT_COLUMNS + ARRAYS).to_pandas()
+    return _align(j, df, _reference, _tmp_arrays)
+
+
+def _union(variants, extra):
+    """
+    Variant index of the store: `variants` plus the distinct variants of `extra`, sorted by
+    position within each chromosome. Returns (index, reference row of each variant, -1 for
+    extra ones, extra row of each variant, -1 for reference ones).
+    """
+    n_ref = len(variants)
+    index = pd.concat([variants[VARIANT_COLUMNS], extra[VARIANT_COLUMNS]], ignore_index=True)
+    chrom_order = {c: i for i, c in enumerate(pd.unique(index["CHROM"]))}
+    order = np.lexsort((index["GENPOS"].to_numpy(), index["CHROM"].map(chrom_order).to_numpy()))
+    index = index.iloc[order].reset_index(drop=True)
+    ref_row = np.where(order < n_ref, order, -1)
+    extra_row = np.where(order >= n_ref, order - n_ref, -1)
+    return index, ref_row, extra_row
+
+
+def build_store(files, phenotypes, store, block_rows=BLOCK_ROWS, workers=None, tmpdir=None):
+    """Build the store from merged regenie `files` (one per phenotype, in column order)."""
+    os.makedirs(store, exist_ok=True)
+    tmpdir = store if tmpdir is None else tmpdir
+    os.makedirs(tmpdir, exist_ok=True)
+    n_phenos = len(phenotypes)
+
+    # Reference: the variants of the first file
+    first = read_regenie(files[0], columns=VARIANT_COLUMNS + ARRAYS).to_pandas()
+    variants = first[VARIANT_COLUMNS].drop_duplicates(subset=KEY_COLUMNS).reset_index(drop=True)
+    reference = pd.MultiIndex.from_frame(variants[KEY_COLUMNS])
+    n_ref = len(variants)
+
+    # Phenotype-major temporary arrays: each file is one contiguous row
+    tmp_arrays = {stat: os.path.join(tmpdir, f".{stat}.phenotype_major.npy") for stat in ARRAYS}
+    for path in tmp_arrays.values():
+        np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(n_phenos, n_ref)).flush()
+
+    extra = [_align(0, first, reference, tmp_arrays)]
+    del first
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(reference, tmp_arrays)) as pool:
+        for j, rows in enumerate(pool.map(_read_aligned, enumerate(files[1:], start=1)), start=1):
+            extra.append(rows)
+            if j % 50 == 0 or j == n_phenos - 1:
+                logging.info(f"Read phenotypes 1-{j + 1} of {n_phenos}")
+
+    # Variants missing from the first file: kept aside with their values, per phenotype
+    extra = pd.concat(extra, ignore_index=True)
+    extra_variants = extra.drop_duplicates(subset=KEY_COLUMNS).reset_index(drop=True)
+    if len(extra_variants):
+        logging.info(f"{len(extra_variants)} variants missing from {files[0]} added from the other files")
+    extra_pos = pd.MultiIndex.from_frame(extra_variants[KEY_COLUMNS]).get_indexer(pd.MultiIndex.from_frame(extra[KEY_COLUMNS]))
+    extra_values = {}
+    for stat in ARRAYS:
+        extra_values[stat] = np.full((len(extra_variants), n_phenos), np.nan, dtype=np.float32)
+        extra_values[stat][extra_pos, extra["_pheno"].to_numpy()] = extra[stat].to_numpy(dtype=np.float32, na_value=np.nan)
+
+    index, ref_row, extra_row = _union(variants, extra_variants)
+    index.to_parquet(os.path.join(store, "variants.parquet"), index=False)
+    n_variants = len(index)
+
+    # Transpose into the (variants, phenotypes) store, one block of variant rows at a time
+    for stat in ARRAYS:
+        tmp = np.load(tmp_arrays[stat], mmap_mode="r")
+        out = np.lib.format.open_memmap(os.path.join(store, f"{stat}.npy"), mode="w+", dtype=np.float32, shape=(n_variants, n_phenos))
+        for r0 in range(0, n_variants, block_rows):
+            src, xsrc = ref_row[r0:r0 + block_rows], extra_row[r0:r0 + block_rows]
+            block = np.empty((len(src), n_phenos), dtype=np.float32)
+            in_ref = src >= 0
+            if in_ref.all() and src[-1] - src[0] == len(src) - 1:
+                block[:] = tmp[:, src[0]:src[-1] + 1].T
+            else:
+                block[in_ref] = tmp[:, src[in_ref]].T
+                block[~in_ref] = extra_values[stat][xsrc[~in_ref]]
+            out[r0:r0 + len(src)] = block
+        out.flush()
+        del tmp, out
+        os.remove(tmp_arrays[stat])
+        logging.info(f"Stored {stat} ({n_variants} variants x {n_phenos} phenotypes)")
+
+    with open(os.path.join(store, "store.json"), "w") as f:
+        json.dump({"phenotypes": phenotypes, "n_variants": n_variants, "stats": STATS, "arrays": ARRAYS,
+                   "layout": LAYOUT}, f, indent=2)
+
+
+class MatrixStore:
+    """Read access to a store built with `build_store`."""
+
+    def __init__(self, store):
+        self.path = store
+        with open(os.path.join(store, "store.json")) as f:
+            meta = json.load(f)
+        # Stores without a layout entry predate it and are variant-major
+        if meta.get("layout", LAYOUT) != LAYOUT:
+            raise ValueError(f"{store} was built with the (phenotypes x variants) layout: rebuild it with `build`")
+        self.phenotypes = meta["phenotypes"]
+        self.arrays = meta.get("arrays", meta["stats"])
+        self.variants = pd.read_parquet(os.path.join(store, "variants.parquet"))
+        self._rows = pd.Index(self.variants["ID"])
+        self._arrays = {}
+
+    def array(self, stat="LOG10P"):
+        """(variants x phenotypes) memory-mapped array of `stat`."""
+        if stat not in self._arrays:
+            self._arrays[stat] = np.load(os.path.join(self.path, f"{stat}.npy"), mmap_mode="r")
+        return self._arrays[stat]
+
+    def row_indices(self, snp_list):
+        """Row positions of the given SNP IDs (unknown IDs are skipped)."""
+        idx = self._rows.get_indexer_for(pd.Index(snp_list).astype(str))
+        return np.sort(idx[idx >= 0])
+
+    def values(self, idx, stat="LOG10P"):
+        """(len(idx) x phenotypes) array of `stat` for the variant rows `idx`."""
+        return self.array(stat)[idx]
+
+    def rows(self, snp_list, stat="LOG10P"):
+        """DataFrame (SNPs x phenotypes) of `stat` for the given SNP IDs."""
+        idx = self.row_indices(snp_list)
+        return pd.DataFrame(self.values(idx, stat), index=self.variants["ID"].to_numpy()[idx], columns=self.phenotypes)
+
+    def get_snp(self, snp_id, stat="LOG10P"):
+        return self.rows([snp_id], stat).iloc[0]
+
+
+def export_wide(store, stat, out_file, snp_list=None):
+    """
+    Wide table with one row per (SNP, age) and one column per embedding dimension (dim1, dim2, ...),
+    as written by regenie_format_subsetted.R. LOG10P is exported as p-values. A1FREQ is the
+    frequency in the age's subset (of its first phenotype with the variant).
+    """
+    ms = MatrixStore(store) if isinstance(store, str) else store
+    idx = np.arange(len(ms.variants)) if snp_list is None else ms.row_indices(snp_list)
+    values = ms.values(idx, stat)
+    if stat == "LOG10P":
+        values = np.power(10.0, -values.astype(np.float64))
+
+    variants = ms.variants.iloc[idx].rename(columns={"ID": "SNP", "CHROM": "CHR", "GENPOS": "BP"}).reset_index(drop=True)
+    pheno_info = pd.Series(ms.phenotypes).str.extract(r"embedding_(\d+)_(\d+)").astype(int)
+
+    a1freq = ms.values(idx, "A1FREQ") if "A1FREQ" in ms.arrays else None
+
+    tables = []
+    for age, cols in pheno_info.groupby(1).groups.items():
+        cols = cols[np.argsort(pheno_info.loc[cols, 0].to_numpy())]
+        age_variants = variants.assign(age=age)
+        if a1freq is not None:
+            freq = a1freq[:, cols]
+            first = np.argmax(~np.isnan(freq), axis=1)
+            age_variants.insert(len(VARIANT_COLUMNS), "A1FREQ", freq[np.arange(len(freq)), first])
+        wide = pd.DataFrame(values[:, cols], columns=[f"dim{e + 1}" for e in pheno_info.loc[cols, 0]])
+        tables.append(pd.concat([age_variants, wide], axis=1))
+
+    pd.concat(tables, ignore_index=True).to_csv(out_file, index=False)
+
+
+def main():
+    args = parse_args()
+
+    if args.command == "build":
+        phenotypes, files = [], []
+        for age in args.ages:
+            for e in args.embeddings:
+                path = os.path.join(args.indir, f"embedding_{e:03d}_{age}.regenie")
+                if not os.path.exists(path):
+                    raise FileNotFoundError(path)
+                phenotypes.append(f"embedding_{e:03d}_{age}")
+                files.append(path)
+        build_store(files, phenotypes, args.store, args.block_rows, args.workers, args.tmpdir)
+        logging.info(f"Store written to {args.store}")
+
+    elif args.command == "export":
+        snps = None
+        if args.snplist is not None:
+            snps = pd.read_csv(args.snplist, header=None, sep=r"\s+", usecols=[2]).iloc[:, 0].astype(str)
+        export_wide(args.store, args.stat, args.out, snps)
+        logging.info(f"Exported {args.stat} → {args.out}")
+
+
+if __name__ == "__main__":
+    main()
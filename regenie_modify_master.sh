@@ -1,4 +1,5 @@
 #!/bin/bash
+# Superseded by regenie_linkify.py, which builds the per-phenotype tree and master files of all ages at once.
 AGES="20 30 40 50 60"          
 EMBEDDING_SIZE=120
 
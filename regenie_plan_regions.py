@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Plan the regions of regenie step 2 so that every array task tests about the same number of variants.
+
+Variants are read per chromosome from one of:
+  - the UKB imputation MFI files (`--mfi_pattern`), which have MAF and INFO, so the step-2
+    `--minMAC` / `--minINFO` filters can be applied (MAC is estimated as 2 * n_samples * MAF),
+  - the BGEN index (`--bgen_pattern`, reads `{bgen}.bgi`), or a PLINK `.bim` file (`--bim`),
+    which only have positions (no filtering).
+
+Each chromosome is cut into ceil(n_variants / target) regions of equal variant counts, never
+between two variants at the same position; chromosomes without variants are skipped.
+
+Outputs:
+  - `{out}`: CHROM START END (1-based, inclusive), the regions file read by regenie_step_2.slurm
+    (which takes the first three fields of each line) and regenie_gather_output.py,
+  - `{out}.summary.tsv`: per region, the number of variants and the predicted step-2 memory.
+
+Usage:
+    regenie_plan_regions.py --mfi_pattern "$UKB/imputed/ukb_mfi_chr{chrom}_v3.txt" \\
+        --target_variants 20000 --out data/regions_balanced_hg19.bed
+"""
+import argparse
+import logging
+import math
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+
+CHROMOSOMES = [str(c) for c in range(1, 23)]
+N_SAMPLES = 487276
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Regions of equal variant counts for regenie step 2.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--mfi_pattern", help="MFI file per chromosome, with a {chrom} placeholder.")
+    source.add_argument("--bgen_pattern", help="BGEN file per chromosome, with a {chrom} placeholder (its .bgi is read).")
+    source.add_argument("--bim", help="PLINK .bim file (all chromosomes).")
+    parser.add_argument("--chroms", nargs="+", default=CHROMOSOMES)
+    parser.add_argument("--out", required=True)
+    parser.add_argument("--target_variants", default=20000, type=int, help="Variants per region.")
+    parser.add_argument("--minMAC", default=6000, type=float)
+    parser.add_argument("--minINFO", default=0.3, type=float)
+    parser.add_argument("--n_samples", default=N_SAMPLES, type=int)
+    parser.add_argument("--n_phenotypes", default=600, type=int)
+    parser.add_argument("--bsize", default=2000, type=int, help="regenie step-2 --bsize.")
+    parser.add_argument("--threads", default=48, type=int, help="regenie step-2 --threads.")
+    parser.add_argument("--workers", default=8, type=int)
+    return parser.parse_args()
+
+
+def read_mfi(path, min_mac=None, min_info=None, n_samples=N_SAMPLES):
+    """Positions of the variants in a UKB MFI file passing the MAC and INFO filters."""
+    df = pd.read_csv(path, sep="\t", header=None, usecols=[2, 5, 7], names=["pos", "maf", "info"])
+    keep = np.ones(len(df), dtype=bool)
+    if min_mac is not None:
+        keep &= (2 * n_samples * df["maf"].to_numpy()) >= min_mac
+    if min_info is not None:
+        keep &= df["info"].to_numpy() >= min_info
+    return df["pos"].to_numpy()[keep]
+
+
+def read_bgi(bgen):
+    """Positions of the variants in the .bgi index of `bgen`."""
+    con = sqlite3.connect(f"file:{bgen}.bgi?mode=ro", uri=True)
+    positions = np.array([p for p, in con.execute("SELECT position FROM Variant")], dtype=np.int64)
+    con.close()
+    return positions
+
+
+def read_bim(path):
+    """{chrom: positions} of a PLINK .bim file."""
+    df = pd.read_csv(path, sep=r"\s+", header=None, usecols=[0, 3], names=["chrom", "pos"], dtype={"chrom": str})
+    return {chrom: group["pos"].to_numpy() for chrom, group in df.groupby("chrom")}
+
+
+def split_positions(positions, target):
+    """
+    (start, end, n_variants) of consecutive regions with about `target` variants each.
+    Boundaries fall between distinct positions, so multi-allelic sites stay in one region.
+    """
+    positions = np.sort(np.asarray(positions, dtype=np.int64))
+    if len(positions) == 0:
+        return []
+    unique, counts = np.unique(positions, return_counts=True)
+    cum = np.cumsum(counts)
+    n_regions = math.ceil(len(positions) / target)
+
+    # Last unique position of each region: where the cumulative count reaches k * n / n_regions
+    quotas = np.arange(1, n_regions) * len(positions) / n_regions
+    ends = np.unique(np.append(np.searchsorted(cum, quotas, side="left"), len(unique) - 1))
+
+    regions = []
+    first = 0
+    for last in ends:
+        n = int(cum[last] - (cum[first - 1] if first > 0 else 0))
+        regions.append((int(unique[first]), int(unique[last]), n))
+        first = last + 1
+    return regions
+
+
+def step2_memory_gb(n_variants, n_samples, n_phenotypes, bsize, threads):
+    """
+    Rough regenie step-2 memory: phenotypes, residuals and LOCO predictions (3 x N x P doubles),
+    the genotype block (N x min(bsize, variants) doubles, twice) and N doubles per thread.
+    """
+    block = min(bsize, n_variants)
+    doubles = 3 * n_samples * n_phenotypes + 2 * n_samples * block + threads * n_samples
+    return doubles * 8 / 1024**3
+
+
+def _chrom_positions(chrom, args):
+    path = args.mfi_pattern.format(chrom=chrom) if args.mfi_pattern else args.bgen_pattern.format(chrom=chrom) + ".bgi"
+    if not os.path.exists(path):
+        logging.warning(f"Missing {path}")
+        return chrom, np.empty(0, dtype=np.int64)
+    if args.mfi_pattern:
+        return chrom, read_mfi(path, args.minMAC, args.minINFO, args.n_samples)
+    return chrom, read_bgi(args.bgen_pattern.format(chrom=chrom))
+
+
+def main():
+    args = parse_args()
+
+    if args.bim:
+        by_chrom = read_bim(args.bim)
+        positions = {c: by_chrom.get(c, np.empty(0, dtype=np.int64)) for c in args.chroms}
+        logging.info("No MAF/INFO in a .bim file: variants are not filtered")
+    else:
+        if args.bgen_pattern:
+            logging.info("No MAF/INFO in the BGEN index: variants are not filtered")
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            positions = dict(pool.map(_chrom_positions, args.chroms, [args] * len(args.chroms)))
+
+    rows = []
+    for chrom in args.chroms:
+        pos = positions[chrom]
+        if len(pos) == 0:
+            logging.warning(f"chr{chrom}: no variants left, skipped")
+            continue
+        for start, end, n in split_positions(pos, args.target_variants):
+            mem = step2_memory_gb(n, args.n_samples, args.n_phenotypes, args.bsize, args.threads)
+            rows.append((chrom, start, end, n, round(mem, 2)))
+
+    regions = pd.DataFrame(rows, columns=["CHROM", "START", "END", "N_VARIANTS", "MEM_GB"])
+    regions[["CHROM", "START", "END"]].to_csv(args.out, sep="\t", header=False, index=False)
+    regions.to_csv(f"{args.out}.summary.tsv", sep="\t", index=False)
+
+    logging.info(f"{len(regions)} regions, {regions['N_VARIANTS'].sum()} variants "
+                 f"({regions['N_VARIANTS'].min()}-{regions['N_VARIANTS'].max()} per region) → {args.out}")
+    logging.info(f"Predicted step-2 memory: up to {regions['MEM_GB'].max():.1f} GB per task (--bsize {args.bsize})")
+
+
+if __name__ == "__main__":
+    main()
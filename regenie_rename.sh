@@ -1,4 +1,5 @@
 #!/bin/bash
+# Superseded by regenie_linkify.py, which builds the per-phenotype tree and master files of all ages at once.
 AGE=20
 EMBEDDING_SIZE=120
 
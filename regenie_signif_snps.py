@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Find the SNPs that are significant for at least one (embedding, age) pair.
+
+Streams every merged `embedding_{dim}_{age}.regenie` file in parallel and writes:
+  - `{output_prefix}.txt`: deduplicated union of significant variants, whitespace-delimited
+    without header (CHROM GENPOS ID ALLELE0 ALLELE1 N_HITS MAX_LOG10P), the SNP list read by
+    regenie_subset.py,
+  - `{output_prefix}_counts.tsv`: number of significant variants per (embedding, age).
+
+With --use_signif_files, the `_signif.regenie` files written by regenie_gather_output.py
+are scanned instead of the full results (the threshold must not be below the one used there).
+"""
+import argparse
+import glob
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from gwas_metrics import add_rows, instrumented, stage
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+
+COLUMNS = ["CHROM", "GENPOS", "ID", "ALLELE0", "ALLELE1", "LOG10P"]
+PATTERN = re.compile(r"embedding_(\d+)_(\d+)(_signif)?\.regenie$")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Union of genome-wide significant SNPs across all phenotypes.")
+    parser.add_argument("--indir", default=os.path.expandvars("$NB/merged_retry"))
+    parser.add_argument("--output_prefix", default=os.path.expandvars("$HOME/signif_snps"))
+    parser.add_argument("--threshold", default=7.3, type=float, help="LOG10P threshold.")
+    parser.add_argument("--use_signif_files", action="store_true")
+    parser.add_argument("--chunksize", default=2 * 10**6, type=int)
+    parser.add_argument("--workers", default=os.cpu_count(), type=int)
+    return parser.parse_args()
+
+
+def list_result_files(indir, use_signif_files=False):
+    """[(path, embedding_dim, age)] for the merged (or `_signif`) result files in `indir`."""
+    files = []
+    for path in sorted(glob.glob(os.path.join(indir, "embedding_*.regenie"))):
+        match = PATTERN.search(os.path.basename(path))
+        if match and bool(match.group(3)) == use_signif_files:
+            files.append((path, int(match.group(1)), int(match.group(2))))
+    return files
+
+
+@instrumented()
+def scan_file(path, threshold, chunksize=2 * 10**6):
+    """Rows of `path` with LOG10P above `threshold` (none if the file is empty)."""
+    hits = []
+    try:
+        # No `usecols`: with it, pandas stops skipping lines with a wrong field count
+        reader = pd.read_csv(path, sep=r"\s+", dtype={"ID": str, "CHROM": str},
+                             chunksize=chunksize, engine="c", on_bad_lines="skip")
+    except pd.errors.EmptyDataError:
+        logging.error(f"Empty result file, skipped: {path}")
+        return pd.DataFrame(columns=COLUMNS)
+    for chunk in reader:
+        add_rows(len(chunk))
+        log10p = pd.to_numeric(chunk["LOG10P"], errors="coerce")
+        hits.append(chunk.loc[log10p > threshold, COLUMNS].assign(LOG10P=log10p))
+    return pd.concat(hits, ignore_index=True) if hits else pd.DataFrame(columns=COLUMNS)
+
+
+def main():
+    args = parse_args()
+
+    files = list_result_files(args.indir, args.use_signif_files)
+    logging.info(f"Scanning {len(files)} files for LOG10P > {args.threshold}")
+
+    all_hits = []
+    counts = []
+    with stage("signif_snps", n_files=len(files)), ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(scan_file, path, args.threshold, args.chunksize): (path, e, a) for path, e, a in files}
+        for future in as_completed(futures):
+            path, e, a = futures[future]
+            hits = future.result()
+            counts.append({"embedding": f"embedding_{e:03d}", "age": a, "n_hits": len(hits)})
+            all_hits.append(hits)
+
+    hits = pd.concat(all_hits, ignore_index=True) if all_hits else pd.DataFrame(columns=COLUMNS)
+    union = (
+        hits.groupby("ID", sort=False)
+        .agg(CHROM=("CHROM", "first"), GENPOS=("GENPOS", "first"), ALLELE0=("ALLELE0", "first"),
+             ALLELE1=("ALLELE1", "first"), N_HITS=("LOG10P", "size"), MAX_LOG10P=("LOG10P", "max"))
+        .reset_index()
+    )
+    union["CHROM_NUM"] = pd.to_numeric(union["CHROM"], errors="coerce")
+    union = union.sort_values(["CHROM_NUM", "GENPOS"])[["CHROM", "GENPOS", "ID", "ALLELE0", "ALLELE1", "N_HITS", "MAX_LOG10P"]]
+
+    union.to_csv(f"{args.output_prefix}.txt", sep=" ", index=False, header=False)
+    counts_df = pd.DataFrame(counts, columns=["embedding", "age", "n_hits"]).sort_values(["age", "embedding"])
+    counts_df.to_csv(f"{args.output_prefix}_counts.tsv", sep="\t", index=False)
+
+    logging.info(f"{len(union)} significant variants → {args.output_prefix}.txt")
+    logging.info(f"Hit counts per (embedding, age) → {args.output_prefix}_counts.tsv")
+
+
+if __name__ == "__main__":
+    main()
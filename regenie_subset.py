@@ -1,53 +1,153 @@
 #!/usr/bin/env python3
-import sys
+"""
+Extract a subset of SNPs from merged regenie step-2 outputs.
+
+Usage:
+    regenie_subset.py <embedding_dim> <age>                   # one phenotype file
+    regenie_subset.py --all [--workers 16]                    # all (embedding, age) pairs
+    regenie_subset.py --embeddings 0 1 2 --ages 20 30         # any subset of pairs
+
+Each file is filtered chunk by chunk while streaming, keeping only the needed columns.
+With several phenotype files, results are written to a single long-format table
+(`merged_embeddings.filtered`) and malformed lines are collected in a report file.
+"""
+import argparse
 import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 from tqdm import tqdm
 
-bad_lines = []
-def log_bad_line(line):
-    print("Bad line:", line)   # la imprime
-    bad_lines.append(line)     # la guarda en una lista
-    return None 
+from gwas_metrics import add_rows, instrumented, stage
+
+AGES = [20, 30, 40, 50, 60]
+EMBEDDING_SIZE = 120
+COLUMNS = ["CHROM", "GENPOS", "ID", "ALLELE0", "ALLELE1", "A1FREQ", "INFO", "N", "BETA", "SE", "LOG10P"]
+
+_snps = None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Filter merged regenie outputs for a list of SNPs.")
+    parser.add_argument("embedding_dim", nargs="?", type=int)
+    parser.add_argument("age", nargs="?", type=int)
+    parser.add_argument("--embeddings", nargs="+", type=int, default=None)
+    parser.add_argument("--ages", nargs="+", type=int, default=None)
+    parser.add_argument("--all", action="store_true", help="Process every (embedding, age) pair.")
+    parser.add_argument("--indir", default="$NB/merged_retry")
+    parser.add_argument("--outdir", default="$NB/merged_retry/subsetted")
+    parser.add_argument("--snplist", default="$HOME/signif_snps.txt", help="Whitespace-delimited file, SNP IDs in the 3rd column.")
+    parser.add_argument("--output_file", default="merged_embeddings.filtered", help="Combined output (relative to --outdir).")
+    parser.add_argument("--columns", nargs="+", default=COLUMNS)
+    parser.add_argument("--chunksize", default=10**6, type=int)
+    parser.add_argument("--workers", default=os.cpu_count(), type=int)
+    args = parser.parse_args()
+
+    if args.embedding_dim is not None and args.age is None:
+        parser.error("<age> is required together with <embedding_dim>")
+    if args.embedding_dim is None and not args.all and args.embeddings is None and args.ages is None:
+        parser.error("give <embedding_dim> <age>, --all, or --embeddings/--ages")
+
+    return args
+
+
+def pheno_name(embedding_dim, age):
+    return f"embedding_{embedding_dim:03d}_{age}"
+
+
+def read_snplist(snplist):
+    return pd.Index(pd.read_csv(snplist, header=None, sep=r"\s+", usecols=[2]).iloc[:, 0].astype(str).unique())
+
+
+def _init_worker(snps):
+    global _snps
+    _snps = snps
+
+
+@instrumented()
+def filter_file(infile, embedding_dim, age, columns, chunksize, snps=None):
+    """
+    Stream `infile` in chunks, keeping only rows whose ID is in `snps`.
+    Returns the filtered DataFrame and a list of (file, message) for malformed lines.
+    """
+    snps = _snps if snps is None else snps
+    kept = []
+    bad_lines = []
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always", pd.errors.ParserWarning)
+        # No `usecols` here: with it, pandas stops detecting lines with a wrong field count
+        reader = pd.read_csv(infile, sep=r"\s+", dtype={"ID": str},
+                             chunksize=chunksize, on_bad_lines="warn", engine="c")
+        for chunk in reader:
+            add_rows(len(chunk))
+            kept.append(chunk.loc[chunk["ID"].isin(snps), columns])
+
+    for w in caught:
+        if issubclass(w.category, pd.errors.ParserWarning):
+            bad_lines.extend((infile, msg) for msg in str(w.message).strip().splitlines() if msg.strip())
+
+    df = pd.concat(kept, ignore_index=True) if kept else pd.DataFrame(columns=columns)
+    df = df.assign(embedding=f"embedding_{embedding_dim:03d}", age=age)
+    return df, bad_lines
+
+
+def main():
+    args = parse_args()
+
+    indir = os.path.expandvars(args.indir)
+    outdir = os.path.expandvars(args.outdir)
+    os.makedirs(outdir, exist_ok=True)
 
-if len(sys.argv) != 3:
-    sys.stderr.write("Usage: filter_regenie_snps.py <embedding_dim> <age>\n")
-    sys.exit(1)
+    snps = read_snplist(os.path.expandvars(args.snplist))
 
-embedding_dim = int(sys.argv[1])
-age = int(sys.argv[2])
+    # Single phenotype file (original behaviour)
+    if args.embedding_dim is not None:
+        pheno = pheno_name(args.embedding_dim, args.age)
+        infile = os.path.join(indir, f"{pheno}.regenie")
+        outfile = os.path.join(outdir, f"{pheno}.filtered")
 
-indir = os.path.expandvars("$NB/merged_retry")
-outdir = os.path.expandvars("$NB/merged_retry/subsetted")
-snplist = os.path.expandvars("$HOME/Delphi/gwas/data/signif_snps.txt")
-snplist = os.path.expandvars("$HOME/signif_snps2.txt")
+        df_filt, bad_lines = filter_file(infile, args.embedding_dim, args.age, args.columns, args.chunksize, snps)
+        df_filt.to_csv(outfile, sep="\t", index=False)
+        for _, msg in bad_lines:
+            print("Bad line:", msg)
+        print(f"Filtered {len(df_filt)} SNPs for {pheno} → {outfile}")
+        return
 
-os.makedirs(outdir, exist_ok=True)
+    embeddings = range(EMBEDDING_SIZE) if args.all or args.embeddings is None else args.embeddings
+    ages = AGES if args.all or args.ages is None else args.ages
+    jobs = [(e, a) for a in ages for e in embeddings]
 
-# File names
-pheno = f"embedding_{embedding_dim:03d}_{age}"
-infile = os.path.join(indir, f"{pheno}.regenie")
-outfile = os.path.join(outdir, f"{pheno}.filtered")
+    outfile = os.path.join(outdir, args.output_file)
+    badfile = os.path.join(outdir, f"{args.output_file}.bad_lines.txt")
 
-# Read list of SNPs
-snps = set(pd.read_csv(snplist, header=None, sep="\s+").iloc[:,2])
+    n_rows, n_missing = 0, 0
+    header = True
+    with stage("subset", n_files=len(jobs)), open(outfile, "w") as out, open(badfile, "w") as bad, \
+         ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=(snps,)) as pool:
 
-chunksize = 10**6
+        futures = []
+        for e, a in jobs:
+            infile = os.path.join(indir, f"{pheno_name(e, a)}.regenie")
+            if not os.path.exists(infile):
+                print(f"Missing input: {infile}")
+                n_missing += 1
+                continue
+            futures.append(pool.submit(filter_file, infile, e, a, args.columns, args.chunksize))
 
-dfs = []
-# for chunk in tqdm(pd.read_csv(infile, sep="\s+", chunksize=chunksize, on_bad_lines=log_bad_line, engine="python"), desc="Loading"):
-for chunk in tqdm(pd.read_csv(infile, sep="\s+", chunksize=chunksize, on_bad_lines='warn', engine="c"), desc="Loading"):
-    dfs.append(chunk)
-df = pd.concat(dfs, ignore_index=True)
+        # Written in job order (not completion order), so the output is the same on every run
+        for future in tqdm(futures, desc="Filtering"):
+            df_filt, bad_lines = future.result()
+            df_filt.to_csv(out, sep="\t", index=False, header=header)
+            header = False
+            n_rows += len(df_filt)
+            for infile, msg in bad_lines:
+                bad.write(f"{os.path.basename(infile)}\t{msg}\n")
 
-# Read REGENIE output
-# df = pd.read_csv(infile, sep="\s+", on_bad_lines=log_bad_line, engine="python")
-# print(f"Reading: {infile=}")
-# import ipdb; ipdb.set_trace()
+    print(f"Filtered {n_rows} rows from {len(futures)} files ({n_missing} missing) → {outfile}")
+    print(f"Malformed lines reported in {badfile}")
 
-# Filter
-df_filt = df[df["ID"].isin(snps)].copy().assign(embedding=f"embedding_{embedding_dim:03d}", age=age)
 
-# Save
-df_filt.to_csv(outfile, sep="\t", index=False)
-print(f"Filtered {len(df_filt)} SNPs for {pheno} → {outfile}")
+if __name__ == "__main__":
+    main()
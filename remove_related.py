@@ -1,28 +1,37 @@
 #!/usr/bin/env python3
 import argparse
+import hashlib
+import heapq
 import logging
 import os
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 
+from gwas_compressed_io import COMPRESSIONS, compressed_path, open_compressed
+from gwas_metrics import add_rows, instrumented, stage
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
 
 def parse_args():
     parser = argparse.ArgumentParser()
 
     # Archivos de entrada
-    parser.add_argument("-p", "--phenotype_file", required=True, help="Path to the (original) phenotype file.")
+    parser.add_argument("-p", "--phenotype_file", required=True, nargs="+", help="Path to the (original) phenotype file(s).")
     parser.add_argument("--phenotypes", default=None, nargs="+")
     parser.add_argument("--relatedness_file") 
     parser.add_argument("--keep_file", default=None, help="Optional file with list of individuals (FID IID) to keep")
     parser.add_argument("--bgen_sample_file") 
     parser.add_argument("--output_dir")
     parser.add_argument("--tmpdir", default="tmp/")
+    parser.add_argument("--kinship_threshold", default=KINSHIP_THRESHOLD, type=float)
     parser.add_argument("--seed", default=[42], nargs="+", type=int)
     parser.add_argument("--gzip_output", default=False, action="store_true")
+    parser.add_argument("--compression", default="gzip", choices=COMPRESSIONS, help="Format of the compressed output (with --gzip_output).")
+    parser.add_argument("--compression_threads", default=None, type=int, help="Threads compressing each output file.")
     parser.add_argument("--na_code", default="-999")
-    parser.add_argument("-o", "--output_file_prefix", required=True)
+    parser.add_argument("-o", "--output_file_prefix", required=True, nargs="+", help="One output prefix per phenotype file.")
+    parser.add_argument("--workers", default=4, type=int, help="Number of output files written in parallel.")
     parser.add_argument("--overwrite_output", default=False, action="store_true")
     parser.add_argument("--split", action="store_true", help="If set, partition into discovery and replication sets. Otherwise keep all together.")
 
@@ -37,69 +46,163 @@ def load_samples(sample_file: str) -> pd.DataFrame:
     return df
 
 
-def run_greedy_related(rel_df: pd.DataFrame, ids: list, tmpdir: str, frac: float=None, exec_path="GreedyRelated") -> list:
-    subset = rel_df.query("ID1 in @ids and ID2 in @ids").drop(
-        columns=["HetHet", "IBS0"], errors="ignore"
-    )
-    
-    if frac is None:
-        inter_file = f"{tmpdir}/GreedyRelated/greedy_all.dat"
-        excl_file = f"{tmpdir}/GreedyRelated/exclude_subjects.txt"
-    else:
-        part_suffix = f"{int(100*frac)}n{int(100*(1-frac))}"
-        inter_file = f"{tmpdir}/GreedyRelated/greedy_{part_suffix}.dat"
-        excl_file = f"{tmpdir}/GreedyRelated/exclude_subjects_{part_suffix}.txt"
-
-    os.makedirs(os.path.dirname(inter_file), exist_ok=True)
-    subset.to_csv(inter_file, sep="\t", index=False)
-
-    cmd = f"{exec_path} -r {inter_file} --seed 1 --id1 ID1 --id2 ID2 -f Kinship -t 0.0884 -o {excl_file}"
-    print("Running:\n\t", cmd)
-    subprocess.run(cmd, shell=True, check=True)
-
-    exclude_subjects = pd.read_csv(excl_file, header=None, sep='\t')[0].astype(str).tolist()
-    return list(set(ids) - set(exclude_subjects))
-
-
-def prepare_phenotypes(phenotype_file: str, na_code: str) -> pd.DataFrame:
+KINSHIP_THRESHOLD = 0.0884
+
+
+class KinshipGraph:
+    """
+    Integer-coded graph of related pairs (kinship above `threshold`), for greedy pruning
+    with the same semantics as GreedyRelated: repeatedly drop the individual with the most
+    relatives left in the subset (ties broken at random, reproducibly from `seed`) until
+    no related pair remains.
+    """
+
+    def __init__(self, rel_df: pd.DataFrame, threshold: float = KINSHIP_THRESHOLD):
+        rel_df = rel_df[rel_df["Kinship"] > threshold]
+        codes, self.ids = pd.factorize(pd.concat([rel_df["ID1"], rel_df["ID2"]], ignore_index=True).astype(str))
+        self.ids = pd.Index(self.ids)
+        self.i, self.j = codes[:len(rel_df)], codes[len(rel_df):]
+
+    def keep_mask(self, ids, seed: int = 1) -> np.ndarray:
+        """Boolean mask over `ids`: False for the individuals removed by greedy pruning."""
+        n = len(self.ids)
+        in_subset = np.zeros(n, dtype=bool)
+        idx = self.ids.get_indexer(ids)
+        in_subset[idx[idx >= 0]] = True
+
+        mask = in_subset[self.i] & in_subset[self.j] & (self.i != self.j)
+        i, j = self.i[mask], self.j[mask]
+        if len(i) == 0:
+            return np.ones(len(ids), dtype=bool)
+
+        # Adjacency lists (CSR) and degrees
+        src = np.concatenate([i, j])
+        dst = np.concatenate([j, i])
+        order = np.argsort(src, kind="stable")
+        dst = dst[order]
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(src, minlength=n))])
+        degree = np.diff(indptr)
+
+        # Plain Python lists: the loop below touches single elements only
+        tiebreak = np.random.default_rng(seed).random(n).tolist()
+        degree = degree.tolist()
+        indptr = indptr.tolist()
+        dst = dst.tolist()
+        heap = [(-degree[k], tiebreak[k], k) for k in range(n) if degree[k] > 0]
+        heapq.heapify(heap)
+
+        removed = [False] * n
+        while heap:
+            d, _, k = heapq.heappop(heap)
+            if removed[k] or -d != degree[k]:
+                continue
+            removed[k] = True
+            for m in dst[indptr[k]:indptr[k + 1]]:
+                if not removed[m]:
+                    degree[m] -= 1
+                    if degree[m] > 0:
+                        heapq.heappush(heap, (-degree[m], tiebreak[m], m))
+
+        removed = np.array(removed)
+        return ~((idx >= 0) & removed[idx])
+
+
+@instrumented("greedy_related")
+def run_greedy_related(graph: KinshipGraph, ids: list, seed: int = 1) -> list:
+    """IDs retained after removing related individuals (in the order of `ids`)."""
+    ids = pd.Index(ids).astype(str)
+    add_rows(len(ids))
+    return ids[graph.keep_mask(ids, seed)].tolist()
+
+
+class PruningCache:
+    """
+    Memoises `run_greedy_related` by a hash of the input ID set and the seed, in memory and
+    (if `cache_dir` is given) on disk, so that runs sharing the same sample universe prune once.
+    `tag` should identify the relatedness input (e.g. file, mtime and threshold).
+    """
+
+    def __init__(self, graph: KinshipGraph, cache_dir: str = None, tag: str = ""):
+        self.graph = graph
+        self.cache_dir = cache_dir
+        self.tag = tag
+        self._cache = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _key(self, ids, seed):
+        h = hashlib.sha1(f"{self.tag}|seed={seed}|".encode())
+        h.update("\n".join(sorted(ids)).encode())
+        return h.hexdigest()
+
+    def retained(self, ids: list, seed: int = 1) -> list:
+        ids = [str(i) for i in ids]
+        key = self._key(ids, seed)
+        if key not in self._cache:
+            cache_file = None if self.cache_dir is None else os.path.join(self.cache_dir, f"{key}.txt")
+            if cache_file is not None and os.path.exists(cache_file):
+                retained = set(pd.read_csv(cache_file, header=None, dtype=str)[0])
+                self._cache[key] = [i for i in ids if i in retained]
+            else:
+                self._cache[key] = run_greedy_related(self.graph, ids, seed)
+                if cache_file is not None:
+                    pd.DataFrame(self._cache[key]).to_csv(cache_file, index=False, header=False)
+        return self._cache[key]
+
+
+@instrumented()
+def prepare_phenotypes(phenotype_file: str) -> pd.DataFrame:
+    """Phenotypes indexed by ID; repeated IDs are masked (NaN, written as the NA code) under placeholder IDs."""
     df = pd.read_csv(phenotype_file, sep=",")    
+    add_rows(len(df))
     assert "ID" in df.columns, "The phenotype file must contain an 'ID' column. First row is: " + str(df.columns)
     dup_mask = df["ID"].duplicated()
-    df.loc[dup_mask, :] = na_code
-    df.loc[dup_mask, "ID"] = [-100 * (i + 1) for i in range(dup_mask.sum())]
     df["ID"] = df["ID"].astype(str)
+    if dup_mask.any():
+        df.loc[dup_mask, df.columns != "ID"] = np.nan
+        df.loc[dup_mask, "ID"] = [str(-100 * (i + 1)) for i in range(dup_mask.sum())]
     return df.set_index("ID")
 
 
+@instrumented()
 def save_pheno(ids: list, samples_df: pd.DataFrame, pheno_df: pd.DataFrame,
-               out_file: str, na_code: str, gzip: bool):
-    df = pheno_df.loc[[str(i) for i in ids]].reset_index()
+               out_file: str, na_code: str, gzip: bool, compression: str = "gzip", threads: int = None):
+    """Write the phenotypes of `ids` in sample-file order, streamed through a parallel compressor if `gzip`."""
+    df = pheno_df.reindex(pd.Index(ids).astype(str)).rename_axis("ID").reset_index()
     df = samples_df.merge(df, on="ID", how="left").drop(
         columns=["id_2", "missing"], errors="ignore"
     )
-    df.to_csv(out_file, sep="\t", index=False, na_rep=na_code)
-    if gzip:
-        subprocess.run(f"gzip {out_file}", shell=True)
+    add_rows(len(df))
+    compression = compression if gzip else None
+    with open_compressed(compressed_path(out_file, compression), compression, threads) as f:
+        df.to_csv(f, sep="\t", index=False, na_rep=na_code)
 
 
 def main():
     args = parse_args()
 
+    if len(args.phenotype_file) != len(args.output_file_prefix):
+        raise ValueError("One output prefix is required per phenotype file")
+
     args.bgen_sample_file = os.path.expanduser(args.bgen_sample_file)
     args.output_dir = os.path.expanduser(args.output_dir)
 
-    GreedyExec = "GreedyRelated"
-
-    samples_df = load_samples(args.bgen_sample_file)
-    all_ids = samples_df["ID"].tolist()
-
-    rel_df = pd.read_csv(args.relatedness_file, sep="\s+")
-    rel_df["ID1"] = rel_df["ID1"].astype(str)
-    rel_df["ID2"] = rel_df["ID2"].astype(str)
+    # Sample and relatedness inputs are shared by all phenotype files: load them once
+    with stage("load_samples_kinship") as st:
+        samples_df = load_samples(args.bgen_sample_file)
+        all_ids = samples_df["ID"].tolist()
 
-    pheno_df = prepare_phenotypes(args.phenotype_file, args.na_code)
+        rel_df = pd.read_csv(args.relatedness_file, sep="\s+", usecols=["ID1", "ID2", "Kinship"])
+        graph = KinshipGraph(rel_df, threshold=args.kinship_threshold)
+        st.add_rows(len(samples_df) + len(rel_df))
+    pruning = PruningCache(
+        graph,
+        cache_dir=f"{args.tmpdir}/GreedyRelated/cache",
+        tag=f"{os.path.abspath(args.relatedness_file)}|{os.path.getmtime(args.relatedness_file)}|{args.kinship_threshold}",
+    )
 
-    os.makedirs(args.tmpdir, exist_ok=True)
+    os.makedirs(f"{args.tmpdir}/GreedyRelated", exist_ok=True)
+    os.makedirs(args.output_dir, exist_ok=True)
 
     if args.keep_file:
         keep_df = pd.read_csv(args.keep_file, sep="\s+", header=None, names=["ID"])
@@ -107,53 +210,60 @@ def main():
         samples_df = samples_df[samples_df["ID"].isin(keep_ids)]
         all_ids = samples_df["ID"].tolist()
         logging.info(f"Restricting to {len(all_ids)} individuals from keep file")
- 
 
-    if args.split:
-        
-        fracs_replication = [0.0]
-        SEEDS = args.seed
+    writes = []
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for phenotype_file, prefix in zip(args.phenotype_file, args.output_file_prefix):
+            pheno_df = prepare_phenotypes(phenotype_file)
+
+            if args.split:
+
+                fracs_replication = [0.0]
+                SEEDS = args.seed
+
+                for SEED in SEEDS:
+                    out_seed_dir = f"{args.output_dir}/seed_{SEED}/"
+                    os.makedirs(out_seed_dir, exist_ok=True)
+                    for frac in fracs_replication:
+                        np.random.seed(SEED)
 
-        for SEED in SEEDS:
-            out_seed_dir = f"{args.output_dir}/seed_{SEED}/"
-            os.makedirs(out_seed_dir, exist_ok=True)
-            for frac in fracs_replication:
-                np.random.seed(SEED)
+                        ids_discovery = samples_df.sample(frac=1-frac)["ID"].tolist()
+                        ids_discovery = pruning.retained(ids_discovery)
 
-                ids_discovery = samples_df.sample(frac=1-frac)["ID"].tolist()
-                ids_discovery = run_greedy_related(rel_df, ids_discovery, frac, args.tmpdir, GreedyExec)
+                        ids_replication = pd.Index(all_ids)
+                        ids_replication = ids_replication[~ids_replication.isin(ids_discovery)].tolist()
+                        ids_replication = pruning.retained(ids_replication)
 
-                ids_replication = list(set(all_ids) - set(ids_discovery))
-                ids_replication = run_greedy_related(rel_df, ids_replication, frac, args.tmpdir, GreedyExec)
+                        part_suffix = f"{int(100*frac)}n{int(100*(1-frac))}"
 
-                part_suffix = f"{int(100*frac)}n{int(100*(1-frac))}"
+                        pd.DataFrame(ids_discovery).to_csv(
+                            f"{args.tmpdir}/GreedyRelated/ids_discovery_{part_suffix}.txt",
+                            index=False, header=False)
+                        pd.DataFrame(ids_replication).to_csv(
+                            f"{args.tmpdir}/GreedyRelated/ids_replication_{part_suffix}.txt",
+                            index=False, header=False)
 
-                pd.DataFrame(ids_discovery).to_csv(
-                    f"{args.tmpdir}/GreedyRelated/ids_discovery_{part_suffix}.txt",
-                    index=False, header=False)
-                pd.DataFrame(ids_replication).to_csv(
-                    f"{args.tmpdir}/GreedyRelated/ids_replication_{part_suffix}.txt",
-                    index=False, header=False)
+                        disc_file = f"{out_seed_dir}/{prefix}-discovery_{part_suffix}.csv"
+                        repl_file = f"{out_seed_dir}/{prefix}-replication_{part_suffix}.csv"
 
-                disc_file = f"{out_seed_dir}/{args.output_file_prefix}-discovery_{part_suffix}.csv"
-                repl_file = f"{out_seed_dir}/{args.output_file_prefix}-replication_{part_suffix}.csv"
+                        writes.append(pool.submit(save_pheno, ids_discovery, samples_df, pheno_df, disc_file, args.na_code, args.gzip_output, args.compression, args.compression_threads))
+                        writes.append(pool.submit(save_pheno, ids_replication, samples_df, pheno_df, repl_file, args.na_code, args.gzip_output, args.compression, args.compression_threads))
 
-                save_pheno(ids_discovery, samples_df, pheno_df, disc_file, args.na_code, args.gzip_output)
-                save_pheno(ids_replication, samples_df, pheno_df, repl_file, args.na_code, args.gzip_output)
+                        logging.info(f"{prefix}: Seed={SEED}, frac={frac}: {len(ids_discovery)} discovery, {len(ids_replication)} replication")
+            else:
 
-                logging.info(f"Seed={SEED}, frac={frac}: {len(ids_discovery)} discovery, {len(ids_replication)} replication")
-    else:
+                ids_final = pruning.retained(all_ids)
 
-        out_dir = args.output_dir
-        ids_final = run_greedy_related(rel_df, all_ids, tmpdir=args.tmpdir, exec_path=GreedyExec)
+                out_file = f"{args.output_dir}/{prefix}.csv"
+                writes.append(pool.submit(save_pheno, ids_final, samples_df, pheno_df, out_file, args.na_code, args.gzip_output, args.compression, args.compression_threads))
 
-        out_file = f"{out_dir}/{args.output_file_prefix}.csv"
-        save_pheno(ids_final, samples_df, pheno_df, out_file, args.na_code, args.gzip_output)
+                pd.DataFrame(ids_final).to_csv(f"{args.tmpdir}/GreedyRelated/ids_all.txt", index=False, header=False)
 
-        pd.DataFrame(ids_final).to_csv(f"{args.tmpdir}/GreedyRelated/ids_all.txt", index=False, header=False)
+                logging.info(f"{prefix}: Seed={args.seed}, no split: {len(ids_final)} individuals retained after relatedness filtering")
+                logging.info(f"Phenotype file will be saved to {out_file=}")
 
-        logging.info(f"Seed={args.seed}, no split: {len(ids_final)} individuals retained after relatedness filtering")
-        logging.info(f"Phenotype file saved to {out_file=}")
+        for future in writes:
+            future.result()
 
     # for SEED in SEEDS:
 
@@ -1,7 +1,14 @@
-AGE=$1
+AGES=${@:-20 30 40 50 60}
+
+PHENO_FILES=()
+PREFIXES=()
+for AGE in $AGES; do
+  PHENO_FILES+=(/home/bonazzola/Delphi/embeddings/data/embedding_120/embeddings_${AGE}.csv)
+  PREFIXES+=(embeddings_${AGE}_excl_rel)
+done
 
 python remove_related.py \
-  --phenotype_file /home/bonazzola/Delphi/embeddings/data/embedding_120/embeddings_${AGE}.csv \
+  --phenotype_file "${PHENO_FILES[@]}" \
   --relatedness_file /home/bonazzola/Delphi/data/geno/ukb_rel_a49978_s488237.dat \
   --bgen_sample_file /home/bonazzola/Delphi/data/geno/sample/ukb22828_c1_b0_v3_s487276.sample \
   --keep_file /home/bonazzola/Delphi/data/datasets/genetic_white_ids.txt \
@@ -10,4 +17,4 @@ python remove_related.py \
   --tmpdir /home/bonazzola/Delphi/gwas/tmp_pheno \
   --seed 42 \
   --gzip_output \
-  --output_file_prefix embeddings_${AGE}_excl_rel
+  --output_file_prefix "${PREFIXES[@]}"
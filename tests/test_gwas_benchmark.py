@@ -0,0 +1,41 @@
+"""End-to-end run of the benchmark harness on tiny synthetic data."""
+import os
+import subprocess
+import sys
+
+import pandas as pd
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_script(name, *args):
+    return subprocess.run([sys.executable, os.path.join(HERE, name), *map(str, args)], capture_output=True, text=True)
+
+
+def test_benchmark_runs_every_stage(tmp_path):
+    data = tmp_path / "data"
+    generated = run_script("gwas_synthetic_data.py", "--outdir", data, "--n_samples", 300, "--n_variants", 3000,
+                           "--n_embeddings", 2, "--ages", 20, 30, "--n_regions", 4, "--n_signals", 3, "--workers", 2)
+    assert generated.returncode == 0, generated.stderr
+
+    results = tmp_path / "results.tsv"
+    bench = run_script("gwas_benchmark.py", "--data", data, "--results", results, "--workers", 2)
+    assert bench.returncode == 0, bench.stderr
+
+    df = pd.read_csv(results, sep="\t")
+    assert set(df["stage"]) == {"gather", "signif_snps", "subset", "qc", "remove_related", "adj_covariates",
+                                "compress_index", "browser_region", "browser_overview"}
+    assert (df["returncode"] == 0).all()
+
+
+def test_benchmark_fails_on_a_failed_stage(tmp_path):
+    data = tmp_path / "data"
+    generated = run_script("gwas_synthetic_data.py", "--outdir", data, "--n_samples", 200, "--n_variants", 1000,
+                           "--n_embeddings", 1, "--kinds", "sample", "kinship", "phenotypes", "--workers", 1)
+    assert generated.returncode == 0, generated.stderr
+    os.remove(data / "rel.dat")
+
+    results = tmp_path / "results.tsv"
+    bench = run_script("gwas_benchmark.py", "--data", data, "--results", results, "--stages", "remove_related")
+    assert bench.returncode != 0
+    assert (pd.read_csv(results, sep="\t")["returncode"] != 0).all()